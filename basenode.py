@@ -10,6 +10,13 @@ class BaseNode(object):
     count = 0
     name_to_node = {}
     node_to_name = {}
+    # Message class -> name of the method that handles it.  Subclasses fill this
+    # in; anything without an entry goes to process_msg().
+    msg_handlers = {}
+    # Per node class caches, built on first use: see handler_for() and
+    # expects_response_timer().
+    _dispatch_tables = {}
+    _rsp_timer_classes = {}
 
     @classmethod
     def reset(cls):
@@ -19,14 +26,12 @@ class BaseNode(object):
 
     @classmethod
     def next_name(cls):
-        if cls.count < 26:
-            name = chr(ord('A') + cls.count)
-        elif cls.count < (26 * 26):
-            hi = cls.count / 26
-            lo = cls.count % 26
-            name = chr(ord('A') + hi - 1) + chr(ord('A') + lo)
-        else:
-            raise NotImplemented
+        # Spreadsheet-style column names: A..Z, AA..ZZ, AAA..
+        name = ''
+        value = cls.count + 1
+        while value > 0:
+            value, digit = divmod(value - 1, 26)
+            name = chr(ord('A') + digit) + name
         cls.count = cls.count + 1
         return name
 
@@ -74,6 +79,43 @@ class BaseNode(object):
         self.next_sequence_number = self.next_sequence_number + 1
         return self.next_sequence_number
 
+    @classmethod
+    def handler_for(cls, msg_class):
+        """Return the function handling msg_class for this node class, or None to
+        fall back to process_msg().  A message class inherits the handler of its
+        nearest registered base class."""
+        table = BaseNode._dispatch_tables.get(cls)
+        if table is None:
+            table = BaseNode._dispatch_tables[cls] = {}
+        try:
+            return table[msg_class]
+        except KeyError:
+            handler = None
+            for klass in msg_class.__mro__:
+                if klass in cls.msg_handlers:
+                    handler = getattr(cls, cls.msg_handlers[klass])
+                    break
+            table[msg_class] = handler
+            return handler
+
+    @classmethod
+    def expects_response_timer(cls):
+        """Whether requests sent by this node class get a response timer, i.e. the
+        class itself defines a callable rsp_timer_pop()."""
+        try:
+            return BaseNode._rsp_timer_classes[cls]
+        except KeyError:
+            result = callable(cls.__dict__.get('rsp_timer_pop'))
+            BaseNode._rsp_timer_classes[cls] = result
+            return result
+
+    def deliver(self, msg):
+        handler = self.handler_for(msg.__class__)
+        if handler is None:
+            self.process_msg(msg)
+        else:
+            handler(self, msg)
+
     def process_msg(self, msg):
         raise NotImplemented
 
@@ -0,0 +1,41 @@
+"""Messages and bytes exchanged by one Merkle anti-entropy round, against the number of divergent keys."""
+import sys
+import random
+
+import emulation
+import dynamo
+from emulation import Emulation
+from history import History
+from messages import SyncRequestMessage, SyncResponseMessage
+from vectorclock import VectorClock
+
+
+def bench_sync(store_size, divergent):
+    emulation.reset_all()
+    dynamo.Node.reset()
+    nodes = [dynamo.Node() for _ in range(dynamo.Node.N)]
+    metadata = VectorClock().update('X', 1)
+    keys = ["K%d" % ii for ii in range(store_size)]
+    for node in nodes:
+        for key in keys:
+            node.put(key, key, metadata)
+    newer = VectorClock().update('X', 2)
+    for key in random.sample(keys, divergent):
+        nodes[0].put(key, "new", newer)
+
+    History.reset()
+    nodes[0].sync_with(nodes[1])
+    Emulation.run(timers_to_process=0)
+    syncs = [msg for (action, msg) in History.history
+             if action == "send" and isinstance(msg, (SyncRequestMessage, SyncResponseMessage))]
+    assert nodes[0].local_store.root_digests() == nodes[1].local_store.root_digests()
+    return len(syncs), sum(msg.payload_size() for msg in syncs)
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    print("%10s %10s %10s %12s" % ("store", "divergent", "messages", "bytes"))
+    for size in sizes:
+        for divergent in (0, 1, 10, 100, 1000):
+            print("%10d %10d %10d %12d" % ((size, divergent) + bench_sync(size, divergent)))
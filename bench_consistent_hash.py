@@ -0,0 +1,117 @@
+"""Benchmarks for ConsistentHashTable maintenance and cluster bring-up."""
+import sys
+import time
+import random
+
+from consistent_hash import ConsistentHashTable
+
+REPEAT = 10
+
+
+def bench_rebuild(num_nodes, repeat=REPEAT):
+    """Old behaviour: rebuild the whole ring every time a node joins."""
+    nodes = []
+    start = time.perf_counter()
+    for ii in range(num_nodes):
+        nodes.append("N%d" % ii)
+        ConsistentHashTable(nodes, repeat)
+    return time.perf_counter() - start
+
+
+def bench_incremental(num_nodes, repeat=REPEAT):
+    tbl = ConsistentHashTable([], repeat)
+    start = time.perf_counter()
+    for ii in range(num_nodes):
+        tbl.add_node("N%d" % ii)
+    return time.perf_counter() - start
+
+
+def _uncached_find_nodes(tbl, key, count, avoid):
+    return tbl._walk(tbl.segment(key), count, avoid)
+
+
+def bench_lookups(num_nodes, num_failed, numkeys=100000, count=3, repeat=REPEAT):
+    nodes = ["N%d" % ii for ii in range(num_nodes)]
+    tbl = ConsistentHashTable(nodes, repeat)
+    avoid = frozenset(random.sample(nodes, num_failed))
+    keys = ["K%d" % random.randint(0, 10 * numkeys) for _ in range(numkeys)]
+    results = []
+    for lookup in (_uncached_find_nodes, ConsistentHashTable.find_nodes):
+        start = time.perf_counter()
+        for key in keys:
+            lookup(tbl, key, count, avoid)
+        results.append(numkeys / (time.perf_counter() - start))
+    return results
+
+
+def bench_rolling(num_nodes, num_sets, numkeys=100000, count=3, repeat=REPEAT):
+    """Lookups cycling through num_sets different avoid sets, as when suspicions come and go."""
+    nodes = ["N%d" % ii for ii in range(num_nodes)]
+    tbl = ConsistentHashTable(nodes, repeat)
+    sets = [frozenset(random.sample(nodes, 2)) for _ in range(num_sets)]
+    keys = ["K%d" % random.randint(0, 10 * numkeys) for _ in range(numkeys)]
+    results = []
+    for lookup in (_uncached_find_nodes, ConsistentHashTable.find_nodes):
+        start = time.perf_counter()
+        for ii, key in enumerate(keys):
+            lookup(tbl, key, count, sets[ii % num_sets])
+        results.append(numkeys / (time.perf_counter() - start))
+    return results
+
+
+def bench_bulk(numkeys, num_nodes=50, count=3, repeat=REPEAT):
+    tbl = ConsistentHashTable(["N%d" % ii for ii in range(num_nodes)], repeat)
+    keys = ["K%d" % ii for ii in range(numkeys)]
+    start = time.perf_counter()
+    for key in keys[:min(numkeys, 100000)]:
+        tbl.find_nodes(key, count)
+    per_key = (time.perf_counter() - start) / min(numkeys, 100000)
+    start = time.perf_counter()
+    tbl.find_nodes_bulk(keys, count)
+    return per_key * numkeys, time.perf_counter() - start
+
+
+def bench_bringup(num_nodes):
+    """Full dynamo.Node() construction, including the per-node local store."""
+    import emulation
+    import dynamo
+    emulation.reset_all()
+    dynamo.Node.reset()
+    start = time.perf_counter()
+    for _ in range(num_nodes):
+        dynamo.Node()
+    elapsed = time.perf_counter() - start
+    emulation.reset_all()
+    dynamo.Node.reset()
+    return elapsed
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 250, 500, 1000, 2000]
+    print("Ring construction, %d tokens per node" % REPEAT)
+    print("%8s %14s %14s" % ("nodes", "rebuild(s)", "add_node(s)"))
+    for size in sizes:
+        print("%8d %14.3f %14.3f" % (size, bench_rebuild(size), bench_incremental(size)))
+    print("")
+    print("find_nodes(count=3) lookups/sec")
+    print("%8s %8s %14s %14s" % ("nodes", "failed", "uncached", "cached"))
+    for size in sizes:
+        for num_failed in (0, max(1, size // 10)):
+            print("%8d %8d %14.0f %14.0f" % ((size, num_failed) + tuple(bench_lookups(size, num_failed))))
+    print("")
+    print("find_nodes(count=3) lookups/sec, cycling through avoid sets of 2 nodes")
+    print("%8s %8s %14s %14s" % ("nodes", "sets", "uncached", "cached"))
+    for size in sizes:
+        for num_sets in (4, 64, 1024):
+            print("%8d %8d %14.0f %14.0f" % ((size, num_sets) + tuple(bench_rolling(size, num_sets))))
+    print("")
+    print("Placing keys on a 50-node ring (per-key time extrapolated from 10^5 keys)")
+    print("%10s %14s %14s" % ("keys", "find_nodes(s)", "bulk(s)"))
+    for numkeys in (10 ** 5, 10 ** 6, 10 ** 7):
+        print("%10d %14.2f %14.2f" % ((numkeys,) + bench_bulk(numkeys)))
+    print("")
+    print("dynamo.Node() bring-up")
+    print("%8s %14s" % ("nodes", "total(s)"))
+    for size in sizes:
+        print("%8d %14.3f" % (size, bench_bringup(size)))
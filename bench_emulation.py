@@ -0,0 +1,81 @@
+"""Throughput of Emulation.run on a 6-node put/get workload, at different log levels and with many cut links."""
+import sys
+import time
+import random
+import logging
+
+import emulation
+import dynamo
+import logconfig
+from emulation import Emulation
+from history import History
+
+LOG_MODES = [("DEBUG", False), ("DEBUG", True), ("INFO", True), ("WARNING", True)]
+
+
+def bench_run(num_ops, num_nodes=6, num_cuts=0):
+    emulation.reset_all()
+    dynamo.Node.reset()
+    for _ in range(num_nodes):
+        dynamo.Node()
+    client = dynamo.Client('a')
+    # Cut links between bystanders, which every reachability check still has to consider.
+    bystanders = [dynamo.Client('x%d' % ii) for ii in range(100)]
+    for _ in range(num_cuts):
+        Emulation.disconnect(random.sample(bystanders, 3), random.sample(bystanders, 3))
+    for ii in range(num_ops):
+        key = "K%d" % random.randint(0, num_ops // 4)
+        if ii % 2:
+            client.get(key)
+        else:
+            client.put(key, None, ii)
+    start = time.perf_counter()
+    Emulation.run(msgs_to_process=-1, timers_to_process=0)
+    elapsed = time.perf_counter() - start
+    delivered = len([action for (action, _) in History.history if action == "deliver"])
+    return delivered, delivered / elapsed
+
+
+def bench_logging(num_ops, level, async_writes):
+    """messages/sec during the run, and including the time to write out any queued log records."""
+    random.seed(42)
+    logconfig.configure_logging(level, async_writes)
+    start = time.perf_counter()
+    delivered, rate = bench_run(num_ops)
+    logconfig.stop_logging()
+    return delivered, rate, delivered / (time.perf_counter() - start)
+
+
+def linear_is_reachable(from_node, to_node):
+    """The scan is_reachable() used before it was indexed, for comparison."""
+    for (from_nodes, to_nodes) in Emulation.unreachable_nodes:
+        if from_node in from_nodes and to_node in to_nodes:
+            return False
+    return True
+
+
+def bench_partitions(num_ops, num_cuts, lookups=100000):
+    """messages/sec with num_cuts cuts in place, then microseconds per reachability check, indexed and by scanning."""
+    random.seed(42)
+    delivered, rate = bench_run(num_ops, num_cuts=num_cuts)
+    nodes = list(dynamo.Node.node_list)
+    results = [delivered, rate]
+    for check in (Emulation.is_reachable, linear_is_reachable):
+        start = time.perf_counter()
+        for ii in range(lookups):
+            check(nodes[ii % 6], nodes[(ii + 1) % 6])
+        results.append((time.perf_counter() - start) / lookups * 1e6)
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    print("%10s %8s %6s %12s %14s %14s" % ("ops", "level", "async", "messages", "messages/sec", "incl. flush"))
+    for size in sizes:
+        for level, async_writes in LOG_MODES:
+            print("%10d %8s %6s %12d %14.0f %14.0f" % ((size, level, async_writes) + bench_logging(size, level, async_writes)))
+    logconfig.configure_logging(logging.WARNING, False)
+    print("")
+    print("%10s %8s %12s %14s %14s %14s" % ("ops", "cuts", "messages", "messages/sec", "indexed(us)", "scan(us)"))
+    for num_cuts in (0, 100, 1000, 10000):
+        print("%10d %8d %12d %14.0f %14.3f %14.3f" % ((sizes[0], num_cuts) + tuple(bench_partitions(sizes[0], num_cuts))))
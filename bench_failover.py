@@ -0,0 +1,85 @@
+"""
+Cost of cancelling the response timers towards a failed node against the number
+of requests in flight, and of preference-list lookups during a long outage.
+"""
+import sys
+import time
+import random
+import logging
+
+import emulation
+import dynamo
+from emulation import Emulation
+from history import History
+from timer import TimerManager
+from messages import GetRequestMessage, PutRequestMessage
+
+
+def scan_cancel_timers_for_node(dest):
+    """cancel_timers_for_node() as it was before timers were indexed by destination, for comparison."""
+    failed_requests = []
+    for timer_msg in list(Emulation.pending_timers.keys()):
+        if timer_msg.to_node == dest:
+            TimerManager.cancel_timer(Emulation.pending_timers[timer_msg])
+            del Emulation.pending_timers[timer_msg]
+            failed_requests.append(timer_msg)
+    return failed_requests
+
+
+def bench_failover(in_flight, cancel, num_nodes=20):
+    """Send in_flight get requests spread over the nodes, then time cancelling those towards one of them."""
+    emulation.reset_all()
+    dynamo.Node.reset()
+    nodes = [dynamo.Node() for _ in range(num_nodes)]
+    for ii in range(in_flight):
+        from_node, to_node = random.sample(nodes, 2)
+        Emulation.send_message(GetRequestMessage(from_node, to_node, "K%d" % ii, msg_id=ii))
+    start = time.perf_counter()
+    failed = cancel(nodes[0])
+    return len(failed), time.perf_counter() - start
+
+
+def bench_outage(num_puts, num_nodes=8, lookups=20000):
+    """
+    Fail one node and keep writing; then time find_nodes() with the busiest node's
+    failed_nodes, and with the list of duplicates it would have built before they were deduplicated.
+    """
+    emulation.reset_all()
+    dynamo.Node.reset()
+    nodes = [dynamo.Node() for _ in range(num_nodes)]
+    client = dynamo.Client('a')
+    nodes[0].fail()
+    for ii in range(num_puts):
+        client.put("K%d" % random.randint(0, 1000), None, ii, destnode=random.choice(nodes[1:]))
+        Emulation.run(msgs_to_process=-1, timers_to_process=2)
+    hints = dict([(node, []) for node in nodes])
+    for action, msg in History.history:
+        if action == "deliver" and isinstance(msg, PutRequestMessage) and msg.handoff is not None:
+            hints[msg.to_node].extend(msg.handoff)
+    busiest = max(nodes[1:], key=lambda node: len(hints[node]))
+    results = [len(busiest.failed_nodes), len(hints[busiest])]
+    tbl = dynamo.Node.consistent_hash_tbl
+    for avoid in (busiest.failed_nodes.frozen, lambda: hints[busiest]):
+        start = time.perf_counter()
+        for ii in range(lookups):
+            tbl.find_nodes("K%d" % (ii % 1000), dynamo.Node.N, avoid())
+        results.append((time.perf_counter() - start) / lookups * 1e6)
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print("%10s %10s %14s %14s" % ("in flight", "to failed", "indexed(ms)", "scan(ms)"))
+    for size in sizes:
+        random.seed(42)
+        cancelled, indexed = bench_failover(size, Emulation.cancel_timers_for_node)
+        random.seed(42)
+        _, scan = bench_failover(size, scan_cancel_timers_for_node)
+        print("%10d %10d %14.3f %14.3f" % (size, cancelled, indexed * 1000, scan * 1000))
+    print("")
+    print("One of 8 nodes down while writing; find_nodes() cost on the node holding most hints")
+    print("%10s %10s %14s %14s %14s" % ("puts", "suspects", "old list len", "set(us)", "old list(us)"))
+    for size in (1000, 5000, 20000):
+        random.seed(42)
+        print("%10d %10d %14d %14.2f %14.2f" % ((size,) + tuple(bench_outage(size))))
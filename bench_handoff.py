@@ -0,0 +1,73 @@
+"""Replaying hinted handoffs to a recovered node: messages, peak response timers and time, against outstanding hints."""
+import sys
+import time
+import random
+import logging
+
+import emulation
+import dynamo
+from emulation import Emulation
+from history import History
+from latency import Constant
+
+# (batch size, window); batches of one with no window behave like the old one put per key.
+SETTINGS = [(1, 10 ** 9), (16, 4), (64, 4), (256, 4), (64, 16)]
+
+
+def _replaying(nodes, victim):
+    for node in nodes:
+        if victim in node.pending_handoffs or node.handoff_queues or node.handoff_in_flight:
+            return True
+    return False
+
+
+def bench_handoff(num_hints, batch, window, num_nodes=8):
+    """
+    Write num_hints keys owned by a failed node, recover it, and from the first handoff to the last ack return
+    the hints outstanding, messages delivered, peak response timers pending, and virtual and wall-clock time.
+    """
+    (dynamo.Node.handoff_batch, dynamo.Node.handoff_window) = (batch, window)
+    emulation.reset_all()
+    dynamo.Node.reset()
+    Emulation.set_virtual_time(True, Constant(1.0))
+    nodes = [dynamo.Node() for _ in range(num_nodes)]
+    client = dynamo.Client('a')
+    victim = nodes[0]
+    victim.fail()
+    tbl = dynamo.Node.consistent_hash_tbl
+    ii = 0
+    while sum([len(node.pending_handoffs.get(victim, ())) for node in nodes]) < num_hints:
+        key = "K%d" % ii
+        ii = ii + 1
+        if victim in tbl.find_nodes(key, dynamo.Node.N)[0]:
+            client.put(key, None, ii, destnode=tbl.find_nodes(key, 1, [victim])[0][0])
+            Emulation.run(msgs_to_process=-1, timers_to_process=-1, until=Emulation.now() + 5)
+    hints = sum([len(node.pending_handoffs.get(victim, ())) for node in nodes])
+
+    History.configure(limit=0)
+    victim.recover()
+    while not any([node.handoff_in_flight for node in nodes]):
+        Emulation.run(msgs_to_process=1, timers_to_process=-1)
+    start, steps, wall_start = Emulation.now(), Emulation.steps, time.perf_counter()
+    peak = 0
+    while _replaying(nodes, victim):
+        Emulation.run(msgs_to_process=-1, timers_to_process=-1, until=Emulation.now() + 0.5)
+        peak = max(peak, len(Emulation.pending_timers))
+    results = (hints, Emulation.steps - steps, peak, Emulation.now() - start, time.perf_counter() - wall_start)
+    History.configure()
+    Emulation.set_virtual_time(False)
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    saved = (dynamo.Node.handoff_batch, dynamo.Node.handoff_window)
+    print("%8s %8s %8s %10s %12s %10s %10s" % ("hints", "batch", "window", "messages", "peak timers", "time", "wall(s)"))
+    for size in sizes:
+        for batch, window in SETTINGS:
+            random.seed(42)
+            results = bench_handoff(size, batch, window)
+            print("%8d %8d %8s %10d %12d %10.1f %10.3f" % ((results[0], batch, window if window < 10 ** 9 else "-") +
+                                                           results[1:]))
+    (dynamo.Node.handoff_batch, dynamo.Node.handoff_window) = saved
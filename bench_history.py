@@ -0,0 +1,92 @@
+"""Cost of History bookkeeping, queries and ladder rendering on put/get runs."""
+import gc
+import sys
+import time
+import tracemalloc
+import random
+import logging
+
+import emulation
+import dynamo
+from emulation import Emulation
+from history import History
+
+
+def run_ops(num_ops, num_nodes=6):
+    emulation.reset_all()
+    dynamo.Node.reset()
+    nodes = [dynamo.Node() for _ in range(num_nodes)]
+    client = dynamo.Client('a')
+    start = time.perf_counter()
+    for ii in range(num_ops):
+        key = "K%d" % random.randint(0, num_ops // 4)
+        if ii % 2:
+            client.get(key)
+        else:
+            client.put(key, None, ii)
+        Emulation.run(msgs_to_process=-1, timers_to_process=0)
+    return nodes, time.perf_counter() - start
+
+
+def bench_query(num_ops, indexed, limit=None):
+    """Run time, then best-of-3 query times for one key's events and for one node's later deliveries."""
+    History.configure(limit=limit, indexed=indexed)
+    nodes, elapsed = run_ops(num_ops)
+    results = [History.count, elapsed]
+    gc.collect()
+    for query in (lambda: History.query(key="K7"), lambda: History.query(node=nodes[0], action="deliver", start=History.count // 2)):
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            found = query()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.extend([len(found), best])
+    History.configure()
+    return results
+
+
+def _render(lines):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = 0
+    for line in lines():
+        count = count + 1
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+def bench_ladder(num_nodes, num_ops, window=10000, subset=10):
+    """Render the last `window` events of a num_nodes-node run: whole ladder(), streamed, streamed on a node subset."""
+    random.seed(42)
+    nodes, _ = run_ops(num_ops, num_nodes)
+    start = History.count - window
+    results = [History.count]
+    results.append(_render(lambda: History.ladder(start_line=start).split('\n')))
+    results.append(_render(lambda: History.ladder_lines(start=start)))
+    results.append(_render(lambda: History.ladder_lines(start=start, nodes=nodes[:subset])))
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    print("%8s %8s %8s %10s %8s %8s %12s %8s %12s" % ("ops", "window", "indexed", "events", "run(s)", "key hits", "key(ms)",
+                                                      "node hits", "node(ms)"))
+    for size in sizes:
+        for limit in (None, 100000):
+            for indexed in (False, True):
+                random.seed(42)
+                events, elapsed, key_hits, key_time, node_hits, node_time = bench_query(size, indexed, limit)
+                print("%8d %8s %8s %10d %8.2f %8d %12.3f %8d %12.3f" % (size, limit or "all", indexed, events, elapsed,
+                                                                         key_hits, key_time * 1000, node_hits, node_time * 1000))
+    print("")
+    print("Rendering the last 10k events of a 200-node run")
+    events, full, streamed, subset = bench_ladder(200, 2000)
+    print("%d events" % events)
+    print("%28s %8s %10s %12s" % ("", "lines", "time(s)", "peak(MiB)"))
+    for name, (lines, elapsed, peak) in (("ladder(start_line)", full), ("ladder_lines(start)", streamed),
+                                         ("ladder_lines(start, nodes)", subset)):
+        print("%28s %8d %10.2f %12.1f" % (name, lines, elapsed, peak / 1048576.0))
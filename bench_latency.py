@@ -0,0 +1,78 @@
+"""Simulated put/get latency (virtual time) for different N/R/W settings and link latencies, as seen by the client and by the coordinators."""
+import sys
+import random
+import logging
+
+import emulation
+import dynamo
+from emulation import Emulation
+from latency import Constant, Exponential, LogNormal
+from messages import ClientPutRequestMessage
+from utils import Stats
+
+
+class TimedClient(dynamo.Client):
+    """Client that records how long each request took to be answered."""
+    rsp_timer_pop = dynamo.Client.rsp_timer_pop
+
+    def __init__(self, name=None):
+        super(TimedClient, self).__init__(name)
+        self.sent_at = {}
+        self.put_latency = Stats(streaming=True)
+        self.get_latency = Stats(streaming=True)
+
+    def request(self, key, value=None):
+        if value is None:
+            msg = self.get(key)
+        else:
+            msg = self.put(key, None, value)
+        self.sent_at[msg] = Emulation.now()
+
+    def process_msg(self, msg):
+        super(TimedClient, self).process_msg(msg)
+        req = getattr(msg.response_to, 'original_msg', msg.response_to)
+        if req in self.sent_at:
+            elapsed = Emulation.now() - self.sent_at.pop(req)
+            if isinstance(req, ClientPutRequestMessage):
+                self.put_latency.record(elapsed)
+            else:
+                self.get_latency.record(elapsed)
+
+
+def bench_latency(num_ops, n, r, w, latency, num_nodes=8, interval=0.5):
+    """Issue one request every `interval` time units; return the client and the nodes' merged request metrics."""
+    (dynamo.Node.N, dynamo.Node.R, dynamo.Node.W) = (n, r, w)
+    emulation.reset_all()
+    dynamo.Node.reset()
+    Emulation.set_virtual_time(True, latency)
+    for _ in range(num_nodes):
+        dynamo.Node()
+    client = TimedClient('a')
+    for ii in range(num_ops):
+        key = "K%d" % random.randint(0, num_ops // 4)
+        client.request(key, ii if ii % 2 == 0 else None)
+        Emulation.run(msgs_to_process=-1, timers_to_process=-1, until=Emulation.now() + interval)
+    Emulation.run(msgs_to_process=-1, timers_to_process=-1, until=Emulation.now() + 1000)
+    Emulation.set_virtual_time(False)
+    return client, dynamo.Node.cluster_metrics()
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    num_ops = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    saved = (dynamo.Node.N, dynamo.Node.R, dynamo.Node.W)
+    print("Client latency, then coordinators' wait for W put acks and for every replica's ack, retries and late responses")
+    print("%-36s %7s %8s %8s %8s %8s %9s %9s %8s %8s" % ("link latency", "N/R/W", "put p50", "put p99", "get p50", "get p99",
+                                                       "W p99", "all p99", "retries", "late"))
+    for latency in (Constant(1.0), Exponential(1.0, minimum=0.5), LogNormal(1.0, 1.0)):
+        for n, r, w in ((3, 1, 1), (3, 2, 2), (3, 3, 3), (5, 3, 3)):
+            client, metrics = bench_latency(num_ops, n, r, w, latency)
+            print("%-36s %7s %8.2f %8.2f %8.2f %8.2f %9.2f %9.2f %8d %8d" % (
+                latency, "%d/%d/%d" % (n, r, w),
+                client.put_latency.percentile(50), client.put_latency.percentile(99),
+                client.get_latency.percentile(50), client.get_latency.percentile(99),
+                metrics.quorum_wait['put'].percentile(99), metrics.completion['put'].percentile(99),
+                metrics.retries['put'].total + metrics.retries['get'].total,
+                metrics.late_responses['put'] + metrics.late_responses['get']))
+    (dynamo.Node.N, dynamo.Node.R, dynamo.Node.W) = saved
@@ -0,0 +1,132 @@
+"""Benchmarks for the Merkle tree backing each node's local store."""
+import gc
+import sys
+import time
+import hashlib
+import tracemalloc
+
+import emulation
+import dynamo
+from merkle_tree import MerkleTree, CompactMerkleTree, STR_DIGEST, MULTISET_DIGEST, md5string, md5int
+from vectorclock import VectorClock
+
+
+class EagerBranch(object):
+    """Branch of the tree as it was before hashing was made lazy, for comparison."""
+    def __init__(self, left, right):
+        self.parent = None
+        self.left = left
+        left.parent = self
+        self.right = right
+        right.parent = self
+        self.recalc_node_val()
+
+    def recalc_node_val(self):
+        self.value = hashlib.md5(self.left.value.digest() + self.right.value.digest())
+        if self.parent is not None:
+            self.parent.recalc_node_val()
+
+
+class EagerLeaf(object):
+    def __init__(self):
+        self.parent = None
+        self._data = {}
+        self.value = md5string(self._data)
+
+    def recalc_node_val(self):
+        self.value = md5string(self._data)
+        self.parent.recalc_node_val()
+
+
+class EagerMerkleTree(object):
+    """The original tree: every branch is hashed at construction and every write rehashes leaf to root."""
+    def __init__(self, depth=12):
+        self.leaf_size = (2 ** 128 - 1 + 2 ** depth - 1) // 2 ** depth
+        self.nodes = [[EagerLeaf() for _ in range(2 ** depth)]]
+        while len(self.nodes[-1]) > 1:
+            below = self.nodes[-1]
+            self.nodes.append([EagerBranch(below[2 * ii], below[2 * ii + 1]) for ii in range(len(below) // 2)])
+        self.root = self.nodes[-1][0]
+
+    def __setitem__(self, key, value):
+        leaf = self.nodes[0][md5int(key) // self.leaf_size]
+        leaf._data[key] = value
+        leaf.recalc_node_val()
+
+    def root_digest(self):
+        return self.root.value.digest()
+
+
+def _root_digest(tree):
+    if isinstance(tree, MerkleTree):
+        return tree.root.value.digest()
+    return tree.root_digest()
+
+
+def bench_writes(numkeys, tree_class, depth=12):
+    """Seconds to build a tree, then writes/sec with the root hash read once at the end."""
+    metadata = VectorClock().update('A', 1)
+    keys = ["K%d" % ii for ii in range(numkeys)]
+    gc.collect()
+    start = time.perf_counter()
+    tree = tree_class(depth)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    for ii, key in enumerate(keys):
+        tree[key] = (ii, metadata)
+    _root_digest(tree)
+    return built, numkeys / (time.perf_counter() - start)
+
+
+def bench_leaf_digest(numkeys, leaf_digest, depth=4):
+    """Writes/sec into a shallow tree (so leaves grow large), reading the root after every write."""
+    tree = CompactMerkleTree(depth, leaf_digest=leaf_digest)
+    metadata = VectorClock().update('A', 1)
+    start = time.perf_counter()
+    for ii in range(numkeys):
+        tree["K%d" % ii] = (ii, metadata)
+        tree.root_digest()
+    return numkeys / (time.perf_counter() - start)
+
+
+def _measure(factory, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = [factory() for _ in range(count)]
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return elapsed / count, memory / count
+
+
+def bench_construction(num_nodes):
+    """Time and traced memory per node for bringing up a cluster of num_nodes nodes."""
+    emulation.reset_all()
+    dynamo.Node.reset()
+    return _measure(dynamo.Node, num_nodes)
+
+
+if __name__ == "__main__":
+    print("Construction cost (time includes tracemalloc overhead)")
+    print("%8s %20s %14s %14s" % ("count", "object", "ms each", "KiB each"))
+    for count in (10, 100, 1000):
+        elapsed, memory = bench_construction(count)
+        print("%8d %20s %14.3f %14.1f" % (count, "Node()", elapsed * 1000, memory / 1024.0))
+    for count in (10, 100):
+        for store_class in (MerkleTree, CompactMerkleTree):
+            elapsed, memory = _measure(store_class, count)
+            print("%8d %20s %14.3f %14.1f" % (count, store_class.__name__ + "()", elapsed * 1000, memory / 1024.0))
+    print("")
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print("Depth-12 trees: build time, then writes/sec with the root hash read once at the end")
+    print("%10s %20s %14s %14s" % ("writes", "tree", "build(ms)", "writes/sec"))
+    for size in sizes:
+        for tree_class in (EagerMerkleTree, MerkleTree, CompactMerkleTree):
+            built, rate = bench_writes(size, tree_class)
+            print("%10d %20s %14.1f %14.0f" % (size, tree_class.__name__, built * 1000, rate))
+    print("")
+    print("Writes/sec with a root read per write, depth-4 tree")
+    print("%10s %14s %14s" % ("writes", STR_DIGEST, MULTISET_DIGEST))
+    for size in (1000, 10000):
+        print("%10d %14.0f %14.0f" % (size, bench_leaf_digest(size, STR_DIGEST), bench_leaf_digest(size, MULTISET_DIGEST)))
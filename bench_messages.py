@@ -0,0 +1,67 @@
+"""
+Memory taken by messages: bytes per message, and peak RSS of a put/get run.
+
+Usage: bench_messages.py [ops] [history limit, or "off"]; by default the run keeps full History.
+"""
+import sys
+import random
+import logging
+import resource
+import tracemalloc
+
+import emulation
+import dynamo
+from emulation import Emulation
+from history import History
+from messages import PutRequestMessage, GetResponseMessage, TimerMessage
+
+
+def bytes_per_message(count=10000):
+    emulation.reset_all()
+    dynamo.Node.reset()
+    a, b = dynamo.Node(), dynamo.Node()
+    factories = [("PutRequestMessage", lambda ii: PutRequestMessage(a, b, "K", ii, None, msg_id=ii)),
+                 ("GetResponseMessage", lambda ii: GetResponseMessage(PutRequestMessage(a, b, "K", ii, None), ii, None)),
+                 ("TimerMessage", lambda ii: TimerMessage(a, "reason"))]
+    results = []
+    for name, factory in factories:
+        tracemalloc.start()
+        msgs = [factory(ii) for ii in range(count)]
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del msgs
+        results.append((name, memory / float(count)))
+    return results
+
+
+def run_ops(num_ops, num_nodes=6):
+    emulation.reset_all()
+    dynamo.Node.reset()
+    for _ in range(num_nodes):
+        dynamo.Node()
+    client = dynamo.Client('a')
+    for ii in range(num_ops):
+        key = "K%d" % random.randint(0, num_ops // 4)
+        if ii % 2:
+            client.get(key)
+        else:
+            client.put(key, None, ii)
+        Emulation.run(msgs_to_process=-1, timers_to_process=0)
+    return len(History.history), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    print("%20s %14s" % ("message", "bytes each"))
+    for name, size in bytes_per_message():
+        print("%20s %14.1f" % (name, size))
+    print("")
+    num_ops = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if len(sys.argv) > 2:
+        if sys.argv[2] == "off":
+            History.configure(enabled=False)
+        else:
+            History.configure(limit=int(sys.argv[2]))
+    events, rss = run_ops(num_ops)
+    print("%d ops: %d history events retained, peak RSS %.1f MiB" % (num_ops, events, rss))
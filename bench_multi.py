@@ -0,0 +1,53 @@
+"""Messages per key for multi_put/multi_get against the batch size, compared with one put/get per key."""
+import sys
+import time
+import random
+import logging
+
+import emulation
+import dynamo
+from emulation import Emulation
+
+BATCH_SIZES = [1, 4, 16, 64, 256]
+
+
+def _measure(requests):
+    """Messages delivered and seconds taken to run each request to completion."""
+    steps, start = Emulation.steps, time.perf_counter()
+    for request in requests:
+        request()
+        Emulation.run(msgs_to_process=-1, timers_to_process=0)
+    return Emulation.steps - steps, time.perf_counter() - start
+
+
+def bench_multi(num_keys, batch, num_nodes=16):
+    """Write then read num_keys keys, batch keys per request (None: single-key put and get)."""
+    emulation.reset_all()
+    dynamo.Node.reset()
+    for _ in range(num_nodes):
+        dynamo.Node()
+    client = dynamo.Client('a')
+    keys = ["K%d" % ii for ii in range(num_keys)]
+    if batch is None:
+        puts = [lambda key=key: client.put(key, None, 1) for key in keys]
+        gets = [lambda key=key: client.get(key) for key in keys]
+    else:
+        groups = [keys[ii:ii + batch] for ii in range(0, num_keys, batch)]
+        puts = [lambda group=group: client.multi_put([(key, None, 1) for key in group]) for group in groups]
+        gets = [lambda group=group: client.multi_get(group) for group in groups]
+    results = []
+    for requests in (puts, gets):
+        messages, elapsed = _measure(requests)
+        results.extend([messages / float(num_keys), num_keys / elapsed])
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    print("%d keys on 16 nodes, N=%d R=%d W=%d" % (num_keys, dynamo.Node.N, dynamo.Node.R, dynamo.Node.W))
+    print("%10s %12s %12s %12s %12s" % ("batch", "put msgs/key", "put keys/s", "get msgs/key", "get keys/s"))
+    for batch in [None] + BATCH_SIZES:
+        random.seed(42)
+        print("%10s %12.2f %12.0f %12.2f %12.0f" % (("single" if batch is None else batch,) +
+                                                    tuple(bench_multi(num_keys, batch))))
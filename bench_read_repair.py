@@ -0,0 +1,75 @@
+"""How quickly read repair brings a recovered node's stale replicas up to date under a uniform read load."""
+import sys
+import random
+import logging
+
+import emulation
+import dynamo
+from emulation import Emulation
+from vectorclock import VectorClock
+
+
+def stale_replicas(node, keys):
+    """Keys for which node holds a version that another replica's version supersedes."""
+    tbl = dynamo.Node.consistent_hash_tbl
+    count = 0
+    for key in keys:
+        replicas = tbl.find_nodes(key, dynamo.Node.N)[0]
+        if node in replicas:
+            mine = node.get(key)[1] or VectorClock()
+            for replica in replicas:
+                theirs = replica.get(key)[1]
+                if theirs is not None and mine < theirs and mine != theirs:
+                    count = count + 1
+                    break
+    return count
+
+
+def bench_read_repair(num_keys, num_reads, read_repair, step, num_nodes=8):
+    """
+    Rewrite every key while one node is down and drop its hints, then read random keys;
+    every step reads, note (reads, stale replicas, repairs sent, conflicting reads).
+    """
+    dynamo.Node.read_repair = read_repair
+    emulation.reset_all()
+    dynamo.Node.reset()
+    nodes = [dynamo.Node() for _ in range(num_nodes)]
+    client = dynamo.Client('a')
+    keys = ["K%d" % ii for ii in range(num_keys)]
+    metadata = {}
+    for key in keys:
+        client.put(key, None, 1)
+        Emulation.run(timers_to_process=0)
+        metadata[key] = client.prev_msg.metadata
+    victim = nodes[0]
+    victim.fail()
+    for key in keys:
+        client.put(key, [metadata[key]], 2)
+        Emulation.run(timers_to_process=3)
+    victim.recover()
+    for node in nodes:
+        node.pending_handoffs = {}
+    Emulation.run(timers_to_process=5 * num_nodes)
+    results = []
+    for ii in range(num_reads + 1):
+        if ii % step == 0:
+            metrics = dynamo.Node.cluster_metrics()
+            results.append((ii, stale_replicas(victim, keys), metrics.read_repairs, metrics.read_repair_conflicts))
+        client.get(random.choice(keys))
+        Emulation.run(timers_to_process=0)
+    dynamo.Node.read_repair = False
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_reads = 4 * num_keys
+    random.seed(42)
+    without = bench_read_repair(num_keys, num_reads, False, num_keys // 2)
+    random.seed(42)
+    with_repair = bench_read_repair(num_keys, num_reads, True, num_keys // 2)
+    print("Stale replicas on a recovered node, %d keys rewritten while it was down" % num_keys)
+    print("%8s %12s %12s %10s %10s" % ("reads", "no repair", "repair", "repairs", "conflicts"))
+    for (reads, stale, _, _), (_, stale_repaired, repairs, conflicts) in zip(without, with_repair):
+        print("%8d %12d %12d %10d %10d" % (reads, stale, stale_repaired, repairs, conflicts))
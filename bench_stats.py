@@ -0,0 +1,39 @@
+"""Memory, time and percentile error of utils.Stats keeping every value versus streaming."""
+import sys
+import math
+import time
+import random
+import tracemalloc
+
+from utils import Stats
+
+PERCENTS = (50, 90, 99, 99.9)
+
+
+def bench_stats(num_values, streaming):
+    values = [random.lognormvariate(0.0, 1.0) for _ in range(num_values)]
+    start = time.perf_counter()
+    stats = Stats(streaming=streaming)
+    for value in values:
+        stats.add(value)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    stats = Stats(streaming=streaming)
+    for value in values:
+        stats.add(value)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    values.sort()
+    exact = [values[max(1, int(math.ceil(percent / 100.0 * num_values))) - 1] for percent in PERCENTS]
+    error = max([abs(stats.percentile(percent) - value) / value for percent, value in zip(PERCENTS, exact)])
+    return elapsed, peak, error
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    print("%10s %10s %10s %12s %16s" % ("values", "streaming", "add(s)", "peak(KiB)", "max pct error"))
+    for size in sizes:
+        for streaming in (False, True):
+            random.seed(42)
+            elapsed, peak, error = bench_stats(size, streaming)
+            print("%10d %10s %10.2f %12.1f %15.3f%%" % (size, streaming, elapsed, peak / 1024.0, error * 100))
@@ -0,0 +1,57 @@
+"""Micro-benchmark of TimerManager start/cancel/pop cost against the number of pending timers."""
+import sys
+import time
+import random
+
+from history import History
+from timer import TimerManager
+
+
+class _BenchNode(object):
+    failed = False
+
+    def timer_pop(self, reason=None):
+        pass
+
+
+def _noop(_):
+    pass
+
+
+def bench(pending, ops=10000):
+    ops = min(ops, pending // 2)
+    TimerManager.reset()
+    History.reset()
+    node = _BenchNode()
+    tmsgs = [TimerManager.start_timer(node, reason=ii, callback=_noop, priority=random.randint(0, 20))
+             for ii in range(pending)]
+    History.reset()
+
+    start = time.perf_counter()
+    new_tmsgs = [TimerManager.start_timer(node, reason=ii, callback=_noop, priority=random.randint(0, 20))
+                 for ii in range(ops)]
+    start_cost = (time.perf_counter() - start) / ops
+
+    victims = random.sample(tmsgs, ops)
+    start = time.perf_counter()
+    for tmsg in victims:
+        TimerManager.cancel_timer(tmsg)
+    cancel_cost = (time.perf_counter() - start) / ops
+
+    for tmsg in new_tmsgs:
+        TimerManager.cancel_timer(tmsg)
+    History.reset()
+    start = time.perf_counter()
+    for _ in range(ops):
+        TimerManager.pop_timer()
+    pop_cost = (time.perf_counter() - start) / ops
+    return start_cost, cancel_cost, pop_cost
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+    print("%10s %12s %12s %12s" % ("pending", "start(us)", "cancel(us)", "pop(us)"))
+    for size in sizes:
+        costs = bench(size)
+        print("%10d %12.2f %12.2f %12.2f" % ((size,) + tuple(cost * 1e6 for cost in costs)))
@@ -0,0 +1,88 @@
+"""Cost of writing and filtering binary History traces."""
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+import emulation
+import dynamo
+from emulation import Emulation
+from history import History
+from messages import PutRequestMessage, GetResponseMessage, TimerMessage
+from tracefile import TraceSink, TraceReader
+
+
+def bench_write(filename, num_events, num_keys=100000):
+    """Write num_events events built from a small pool of real messages."""
+    emulation.reset_all()
+    dynamo.Node.reset()
+    nodes = [dynamo.Node() for _ in range(6)]
+    pool = []
+    for ii in range(1000):
+        req = PutRequestMessage(random.choice(nodes), random.choice(nodes), "K%d" % random.randint(0, num_keys), ii, None, msg_id=ii)
+        pool.extend([("send", req), ("deliver", req), ("start", TimerMessage(req.from_node, req)),
+                     ("send", GetResponseMessage(req, ii, None))])
+    sink = TraceSink(filename)
+    start = time.perf_counter()
+    for ii in range(num_events):
+        action, msg = pool[ii % len(pool)]
+        sink.write(ii, action, msg)
+    sink.close()
+    return (time.perf_counter() - start) / num_events, os.path.getsize(filename) / float(num_events)
+
+
+def bench_select(filename):
+    reader = TraceReader(filename)
+    key = reader.record(1).key
+    start = time.perf_counter()
+    found = len(list(reader.select(key=key, action="deliver")))
+    elapsed = time.perf_counter() - start
+    reader.close()
+    return len(reader), found, elapsed
+
+
+def bench_run(num_ops, filename=None):
+    """Seconds for a 6-node put/get run streaming History to a trace (or to nothing)."""
+    sinks = [TraceSink(filename)] if filename else []
+    History.configure(limit=0, sinks=sinks)
+    emulation.reset_all()
+    dynamo.Node.reset()
+    for _ in range(6):
+        dynamo.Node()
+    client = dynamo.Client('a')
+    start = time.perf_counter()
+    for ii in range(num_ops):
+        key = "K%d" % random.randint(0, num_ops // 4)
+        if ii % 2:
+            client.get(key)
+        else:
+            client.put(key, None, ii)
+        Emulation.run(msgs_to_process=-1, timers_to_process=0)
+    elapsed = time.perf_counter() - start
+    events = History.count
+    History.configure()
+    return events, elapsed
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 7
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, "trace")
+    try:
+        per_event, size = bench_write(filename, num_events)
+        print("Write %d events: %.2f us/event, %.1f bytes/event" % (num_events, per_event * 1e6, size))
+        records, found, elapsed = bench_select(filename)
+        print("select(key, action) over %d records: %d matches in %.3fs" % (records, found, elapsed))
+        print("")
+        print("%10s %10s %14s %14s" % ("ops", "events", "no trace(s)", "trace(s)"))
+        for num_ops in (10000, 50000):
+            events, plain = bench_run(num_ops)
+            _, traced = bench_run(num_ops, filename)
+            print("%10d %10d %14.2f %14.2f" % (num_ops, events, plain, traced))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -1,39 +1,203 @@
 import hashlib
 import binascii
 import bisect
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Number of distinct (count, avoid) preference tables kept at once; the least recently used goes first.
+MAX_CACHED_TABLES = 16
 
 
 class ConsistentHashTable(object):
     def __init__(self, nodelist, repeat):
+        self.repeat = repeat
         baselist = []
         for node in nodelist:
-            for i in range(repeat):
-                nodestring = "%s:%d" % (node, i)
-                baselist.append((hashlib.md5(nodestring.encode("utf-8")).digest(), node))
+            baselist.extend(self._tokens(node))
         self.nodelist = sorted(baselist, key=lambda x: x[0])
         self.hashlist = [hashnode[0] for hashnode in self.nodelist]
+        self.version = 0
+        self._invalidate()
+
+    def _invalidate(self):
+        self._unavoided = {}
+        self._tables = OrderedDict()
+        self._recent = (None, None)  # (tblkey, table) last returned by _segment_table
+        self._token_words = None
+        self._bounds = None
+        self._owners = {}
+        self._peers = {}
+        self.version = self.version + 1
+
+    def _tokens(self, node):
+        return [(hashlib.md5(("%s:%d" % (node, i)).encode("utf-8")).digest(), node)
+                for i in range(self.repeat)]
+
+    def add_node(self, node):
+        """Insert the virtual tokens for node, leaving the rest of the ring untouched."""
+        for hv, _ in self._tokens(node):
+            index = bisect.bisect(self.hashlist, hv)
+            self.hashlist.insert(index, hv)
+            self.nodelist.insert(index, (hv, node))
+        self._invalidate()
+
+    def remove_node(self, node):
+        """Delete the virtual tokens for node from the ring."""
+        for hv, _ in self._tokens(node):
+            index = bisect.bisect_left(self.hashlist, hv)
+            while index < len(self.hashlist) and self.hashlist[index] == hv:
+                if self.nodelist[index][1] == node:
+                    del self.hashlist[index]
+                    del self.nodelist[index]
+                    break
+                index = index + 1
+            else:
+                raise ValueError("Node %s not present in consistent hash table" % node)
+        self._invalidate()
+
+    def segment(self, key):
+        """Index of the ring segment (first token at or after the key's hash) that key falls into."""
+        hv = hashlib.md5(str(key).encode("utf-8")).digest()
+        return bisect.bisect(self.hashlist, hv) % len(self.nodelist)
 
     def find_nodes(self, key, count=1, avoid=None):
+        if not self.nodelist:
+            return [], []
+        avoid = frozenset(avoid) if avoid else frozenset()
+        entry = self._preference(self.segment(key), count, avoid)
+        return list(entry[0]), list(entry[1])
+
+    def find_nodes_bulk(self, keys, count=1, avoid=None):
+        """
+        Preference lists for a whole batch of keys.
+
+        Returns one (results, avoided) pair per key, holding the same nodes in the same order
+        as find_nodes(key, count, avoid).  The pairs are tuples shared between keys that fall
+        into the same ring segment, so callers must not modify them.
+        """
+        if not self.nodelist:
+            return [((), ())] * len(keys)
+        avoid = frozenset(avoid) if avoid else frozenset()
+        segments = self.segments(keys)
+        entries = dict([(segment, self._preference(segment, count, avoid)) for segment in set(segments)])
+        return [entries[segment] for segment in segments]
+
+    def segments(self, keys):
+        """Ring segment for each of keys; uses numpy for the search when it is available."""
+        md5 = hashlib.md5
+        digests = [md5(str(key).encode("utf-8")).digest() for key in keys]
+        if numpy is None:
+            return [bisect.bisect(self.hashlist, hv) % len(self.nodelist) for hv in digests]
+
+        words = numpy.frombuffer(b"".join(digests), dtype=">u8").reshape(-1, 2)
+        token_hi = self._token_prefixes()
+        index = numpy.searchsorted(token_hi, words[:, 0], side="right")
+        index = index.astype(numpy.int64)
+        # Keys sharing their top 64 bits with a token need the full 128-bit comparison.
+        ties = numpy.nonzero(numpy.searchsorted(token_hi, words[:, 0], side="left") != index)[0]
+        for ii in ties.tolist():
+            index[ii] = bisect.bisect(self.hashlist, digests[ii])
+        return (index % len(self.nodelist)).tolist()
+
+    def _token_prefixes(self):
+        """Top 64 bits of every token hash, as a sorted native-endian integer array."""
+        if self._token_words is None:
+            words = numpy.frombuffer(b"".join(self.hashlist), dtype=">u8").reshape(-1, 2)
+            self._token_words = words[:, 0].astype(numpy.uint64)
+        return self._token_words
+
+    def peers(self, node, count):
+        """Nodes sharing at least one preference list of length count with node, in ring order."""
+        peers = self._peers.get(count)
+        if peers is None:
+            # Anti-entropy asks on every sync timer, so one walk of the ring serves every node until it changes.
+            peers = self._peers[count] = {}
+            for segment in range(len(self.nodelist)):
+                preference_list = self._preference(segment, count, frozenset())[0]
+                for member in preference_list:
+                    results = peers.setdefault(member, OrderedDict())
+                    for other in preference_list:
+                        if other != member:
+                            results[other] = None
+            for member in peers:
+                peers[member] = list(peers[member])
+        return peers.get(node, [])
+
+    def boundaries(self):
+        """
+        Sorted integer boundaries splitting the 128-bit hash space at every token.  Consecutive
+        boundaries delimit [min_key, max_key) ranges; the segment before the first token wraps around
+        the ring, so it appears as both the first and the last range.
+        """
+        if self._bounds is None:
+            self._bounds = [0] + [int(binascii.hexlify(hv), 16) for hv in self.hashlist] + [2 ** 128]
+        return self._bounds
+
+    def owned_ranges(self, node, count):
+        """The (min_key, max_key) ranges whose preference list of length count includes node."""
+        if not self.nodelist:
+            return []
+        owners = self._owners.get(count)
+        if owners is None:
+            owners = self._owners[count] = {}
+            bounds = self.boundaries()
+            for ii in range(len(bounds) - 1):
+                for owner in self._preference(ii % len(self.nodelist), count, frozenset())[0]:
+                    owners.setdefault(owner, []).append((bounds[ii], bounds[ii + 1]))
+        return owners.get(node, [])
+
+    def _preference(self, segment, count, avoid):
+        """The (results, avoided) pair for segment, from the caches or by walking the ring."""
+        table = self._unavoided.get(count)
+        if table is None:
+            table = self._unavoided[count] = {}
+        entry = table.get(segment)
+        if entry is None:
+            entry = table[segment] = self._walk(segment, count, None)
+        if avoid and not avoid.isdisjoint(entry[0]):
+            # Only segments whose usual preference list has an avoided node differ, so only those
+            # are walked and cached for this avoid set.
+            table = self._segment_table(count, avoid)
+            entry = table.get(segment)
+            if entry is None:
+                entry = table[segment] = self._walk(segment, count, avoid)
+        return entry
+
+    def _segment_table(self, count, avoid):
+        """Segment -> (results, avoided) for this (count, avoid frozenset) pair, filled in lazily."""
+        tblkey = (count, avoid)
+        if self._recent[0] == tblkey:
+            return self._recent[1]
+        table = self._tables.get(tblkey)
+        if table is None:
+            if len(self._tables) >= MAX_CACHED_TABLES:
+                self._tables.popitem(last=False)
+            table = self._tables[tblkey] = {}
+        else:
+            self._tables.move_to_end(tblkey)
+        self._recent = (tblkey, table)
+        return table
+
+    def _walk(self, initial_index, count, avoid):
         if avoid is None:
             avoid = set()
-        hv = hashlib.md5(str(key).encode("utf-8")).digest()
-        initial_index = bisect.bisect(self.hashlist, hv)
-        next_index = initial_index
         results = []
         avoided = []
-        while len(results) < count:
-            if next_index == len(self.nodelist):
-                next_index = 0
-            node = self.nodelist[next_index][1]
+        for ii in range(len(self.nodelist)):
+            if len(results) >= count:
+                break
+            node = self.nodelist[(initial_index + ii) % len(self.nodelist)][1]
             if node in avoid:
                 if node not in avoided:
                     avoided.append(node)
             elif node not in results:
                 results.append(node)
-            next_index = next_index + 1
-            if next_index == initial_index:
-                break
-        return results, avoided
+        return tuple(results), tuple(avoided)
 
     def __str__(self):
         return ",".join(["(%s, %s)" %
@@ -46,6 +210,12 @@ import unittest
 from utils import random_3str, Stats
 
 NODE_REPEAT = 10
+NUM_KEYS = 10000
+
+
+def _hashint(key):
+    """A key's position on the ring, as an integer comparable with boundaries()."""
+    return int(binascii.hexlify(hashlib.md5(str(key).encode("utf-8")).digest()), 16)
 
 
 class HashMultipleTestCase(unittest.TestCase):
@@ -83,24 +253,119 @@ class HashMultipleTestCase(unittest.TestCase):
         self.assertEqual(result, [])
         self.assertEqual(set(avoided), set(['A', 'B', 'C']))
 
+    def testAddRemove(self):
+        c3 = ConsistentHashTable(('A', 'B'), 2)
+        c3.add_node('C')
+        self.assertEqual(str(c3), str(self.c1))
+        c3.remove_node('B')
+        self.assertEqual(str(c3), str(ConsistentHashTable(('A', 'C'), 2)))
+        self.assertRaises(ValueError, c3.remove_node, 'B')
+
+        c4 = ConsistentHashTable((), NODE_REPEAT)
+        for node in self.nodeset:
+            c4.add_node(node)
+        self.assertEqual(c4.nodelist, self.c2.nodelist)
+        self.assertEqual(c4.hashlist, self.c2.hashlist)
+
+    def testCache(self):
+        for _ in range(200):
+            key = random_3str()
+            avoid = random.sample(sorted(self.nodeset), random.randint(0, 5))
+            segment = self.c2.segment(key)
+            self.assertEqual(self.c2.find_nodes(key, 3, avoid),
+                             tuple(list(x) for x in self.c2._walk(segment, 3, set(avoid))))
+        result, _ = self.c1.find_nodes('splurg', 2)
+        result.append('Z')
+        self.assertEqual(self.c1.find_nodes('splurg', 2)[0], ['A', 'C'])
+        self.c1.add_node('D')
+        self.assertTrue('D' in self.c1.find_nodes('splurg', 4)[0])
+        self.c1.remove_node('D')
+        self.assertEqual(self.c1.find_nodes('splurg', 4)[0], ['A', 'C', 'B'])
+
+    def testCacheEviction(self):
+        nodes = sorted(self.nodeset)
+        keys = [key for key in [random_3str() for _ in range(2000)] if nodes[0] in self.c2.find_nodes(key, 3)[0]]
+        for ii in range(3 * MAX_CACHED_TABLES):
+            # The set in use throughout stays cached while one-off sets come and go.
+            for avoid in ((nodes[0],), (nodes[ii % len(nodes)], nodes[(ii + 1) % len(nodes)])):
+                for key in (keys[ii % len(keys)], random_3str()):
+                    self.assertEqual(self.c2.find_nodes(key, 3, avoid),
+                                     tuple(list(x) for x in self.c2._walk(self.c2.segment(key), 3, set(avoid))))
+            self.assertTrue(len(self.c2._tables) <= MAX_CACHED_TABLES)
+            self.assertTrue((3, frozenset([nodes[0]])) in self.c2._tables)
+
+    def testExhaustedRing(self):
+        for ii in range(len(self.c1.nodelist)):
+            result, avoided = self.c1._walk(ii, 3, ('A', 'B', 'C'))
+            self.assertEqual(result, ())
+            self.assertEqual(set(avoided), set(['A', 'B', 'C']))
+
+    def testBulk(self):
+        keys = [random_3str() for _ in range(2000)] + [17, None, 'splurg']
+        for avoid in (None, random.sample(sorted(self.nodeset), 5)):
+            bulk = self.c2.find_nodes_bulk(keys, 3, avoid)
+            self.assertEqual(len(bulk), len(keys))
+            for key, (results, avoided) in zip(keys, bulk):
+                self.assertEqual(self.c2.find_nodes(key, 3, avoid), (list(results), list(avoided)))
+        self.assertEqual(self.c1.find_nodes_bulk(['splurg'], 2, avoid=('A',)), [(('C', 'B'), ('A',))])
+
+    def testPeers(self):
+        self.assertEqual(set(self.c1.peers('A', 2)), set(['B', 'C']))
+        self.assertEqual(self.c1.peers('A', 1), [])
+        for node in self.nodeset:
+            peers = self.c2.peers(node, 3)
+            self.assertFalse(node in peers)
+            for segment in range(len(self.c2.nodelist)):
+                preference_list = self.c2._walk(segment, 3, None)[0]
+                if node in preference_list:
+                    self.assertTrue(set(preference_list) - set([node]) <= set(peers))
+        node = next(iter(self.nodeset))
+        peers = self.c2.peers(node, 3)
+        self.assertIs(self.c2.peers(node, 3), peers)
+        self.c2.add_node('ZZZZ')
+        self.assertIsNot(self.c2.peers(node, 3), peers)
+        self.assertFalse('ZZZZ' in self.c2.peers('ZZZZ', 3))
+        self.assertTrue(len(self.c2.peers('ZZZZ', 3)) > 0)
+        self.c2.remove_node('ZZZZ')
+        self.assertEqual(self.c2.peers(node, 3), peers)
+
+    def testRanges(self):
+        bounds = self.c2.boundaries()
+        self.assertEqual(len(bounds), len(self.c2.nodelist) + 2)
+        self.assertEqual(bounds, sorted(bounds))
+        owners = {}
+        for node in self.nodeset:
+            for key_range in self.c2.owned_ranges(node, 3):
+                owners.setdefault(key_range, set()).add(node)
+        for _ in range(1000):
+            key = random_3str()
+            ii = bisect.bisect(bounds, _hashint(key)) - 1
+            self.assertEqual(owners[(bounds[ii], bounds[ii + 1])], set(self.c2.find_nodes(key, 3)[0]))
+        version = self.c2.version
+        self.c2.add_node('ZZZZ')
+        self.assertTrue(self.c2.version > version)
+        # One token may own the wrap-around segment, which is split into two ranges.
+        self.assertTrue(len(self.c2.owned_ranges('ZZZZ', 1)) in (NODE_REPEAT, NODE_REPEAT + 1))
+
     def testLarge(self):
         x = self.c2.find_nodes('splurg', 15)[0]
         self.assertEqual(len(x), 15)
 
     def testDistribution(self):
         nodecount = dict([(node, 0) for node in self.nodeset])
-        numkeys = 10000
-        for _ in range(numkeys):
-            node = self.c2.find_nodes(random_3str(), 1)[0][0]
-            nodecount[node] = nodecount[node] + 1
-        stats = Stats()
+        numkeys = NUM_KEYS
+        for results, _ in self.c2.find_nodes_bulk([random_3str() for _ in range(numkeys)], 1):
+            nodecount[results[0]] = nodecount[results[0]] + 1
+        stats = Stats(streaming=True)
         for node, count in nodecount.items():
             stats.add(count)
         print ("%d random hash keys assigned to %d nodes "
                "each repeated %d times "
                "are distributed across the nodes "
-               "with a standard deviation of %0.2f (compared to a mean of %d)." %
-               (numkeys, len(self.nodeset), NODE_REPEAT, stats.stddev(), numkeys / len(self.nodeset)))
+               "with a standard deviation of %0.2f (compared to a mean of %d); "
+               "the busiest node has %d keys and 90%% have at most %d." %
+               (numkeys, len(self.nodeset), NODE_REPEAT, stats.stddev(), numkeys / len(self.nodeset),
+                stats.max, stats.percentile(90)))
 
     def testFailover(self):
         transfer = {}
@@ -108,12 +373,10 @@ class HashMultipleTestCase(unittest.TestCase):
             transfer[from_node] = {}
             for to_node in self.nodeset:
                 transfer[from_node][to_node] = 0
-        numkeys = 10000
-        for _ in range(numkeys):
-            key = random_3str()
-            node_pair = self.c2.find_nodes(key, 2)[0]
+        numkeys = NUM_KEYS
+        for node_pair, _ in self.c2.find_nodes_bulk([random_3str() for _ in range(numkeys)], 2):
             transfer[node_pair[0]][node_pair[1]] = transfer[node_pair[0]][node_pair[1]] + 1
-        stats = Stats()
+        stats = Stats(streaming=True)
         for from_node in self.nodeset:
             num_dest_nodes = 0
             for to_node in self.nodeset:
@@ -135,6 +398,9 @@ if __name__ == "__main__":
         elif arg == "-r" or arg == "--repeat":
             NODE_REPEAT = int(sys.argv[ii + 1])
             del sys.argv[ii:ii + 2]
+        elif arg == "-k" or arg == "--keys":
+            NUM_KEYS = int(sys.argv[ii + 1])
+            del sys.argv[ii:ii + 2]
         else:
             ii += 1
     unittest.main()
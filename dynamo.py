@@ -1,5 +1,7 @@
 import copy
 import random
+import itertools
+from collections import OrderedDict
 import logging
 
 import logconfig
@@ -8,27 +10,106 @@ from timer import TimerManager
 from emulation import Emulation
 from consistent_hash import ConsistentHashTable
 from messages import DynamoRequestMessage, ClientPutRequestMessage, ClientPutResponseMessage, PutRequestMessage, PutResponseMessage, ClientGetRequestMessage, ClientGetResponseMessage, \
-    GetRequestMessage, GetResponseMessage, PingRequestMessage, PingResponseMessage
-from merkle_tree import MerkleTree
+    GetRequestMessage, GetResponseMessage, PingRequestMessage, PingResponseMessage, SyncRequestMessage, SyncResponseMessage, \
+    HandoffRequestMessage, HandoffResponseMessage, ReadRepairMessage, ClientMultiPutRequestMessage, ClientMultiPutResponseMessage, \
+    ClientMultiGetRequestMessage, ClientMultiGetResponseMessage, MultiPutRequestMessage, MultiPutResponseMessage, \
+    MultiGetRequestMessage, MultiGetResponseMessage
+from metrics import RequestMetrics
+from merkle_tree import PartitionedMerkleStore, MULTISET_DIGEST, entry_hash, empty_digest
 from vectorclock import VectorClock
 
 logconfig.init_logging()
 _logger = logging.getLogger('dynamo')
 
 
+class FailedNodes(object):
+    """
+    The nodes a Node believes have failed, without duplicates.  frozen() gives them
+    as a frozenset to pass to find_nodes(), and next_to_retry() cycles through them
+    round-robin, starting with the first suspected, by moving each node it returns
+    to the back of the order.
+    """
+    def __init__(self):
+        self.nodes = OrderedDict()  # node -> None, in the order they will next be retried
+        self._frozen = frozenset()
+
+    def add(self, node):
+        if node not in self.nodes:
+            self.nodes[node] = None
+            self._frozen = None
+
+    def discard(self, node):
+        if node in self.nodes:
+            del self.nodes[node]
+            self._frozen = None
+
+    def frozen(self):
+        if self._frozen is None:
+            self._frozen = frozenset(self.nodes)
+        return self._frozen
+
+    def next_to_retry(self):
+        if not self.nodes:
+            return None
+        node = next(iter(self.nodes))
+        self.nodes.move_to_end(node)
+        return node
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+
+class MultiRequest(object):
+    """
+    Coordinator's state for a client multi_put or multi_get.  Each key completes
+    its own quorum of `required` responses; the client is answered once all have.
+    A key with no replica to ask fails at once, with a result of None.
+    """
+    def __init__(self, msg, required):
+        self.msg = msg
+        self.required = required
+        self.entries = {}  # key -> (key, value, metadata, handoff) for a put, (key,) for a get
+        self.asked = {}  # key -> nodes sent a request for the key
+        self.responses = {}  # key -> [(node, value, metadata)]
+        self.results = {}
+
+    def add(self, key, node, entry):
+        self.entries[key] = entry
+        self.asked.setdefault(key, set()).add(node)
+        self.responses.setdefault(key, [])
+
+    def fail(self, key, entry):
+        self.entries[key] = entry
+        self.results[key] = None
+
+
 class Node(BaseNode):
     timer_priority = 20
     T = 10  # Repeats in consistent hash circle
     N = 3  # Replication factor
     R = 2  # Read acks
     W = 2  # Write acks
+    anti_entropy = False  # Periodically reconcile local_store with replica peers
+    read_repair = False  # After a get, bring replicas that answered with an older version up to date
+    read_repair_limit = 1024  # Gets held open for late responses; past this the oldest is repaired as it stands
+    merkle_depth = 8  # Depth of the Merkle tree kept for each ring range
+    handoff_batch = 64  # Keys per hinted-handoff message to a recovered node
+    handoff_window = 4  # Unacknowledged hinted-handoff messages allowed per recovered node
 
     node_list = []
     consistent_hash_tbl = ConsistentHashTable(node_list, T)
 
     def __init__(self):
         super(Node, self).__init__()
-        self.local_store = MerkleTree()
+        self.local_store = PartitionedMerkleStore(Node.merkle_depth, leaf_digest=MULTISET_DIGEST)
+        self.ring = None
+        self.ring_version = None
 
         self.pending_put_msg = {}
         self.pending_put_rsp = {}
@@ -36,18 +117,42 @@ class Node(BaseNode):
         self.pending_get_rsp = {}
 
         self.pending_requests = {PutRequestMessage: {}, GetRequestMessage: {}}
-        self.failed_nodes = []
-        self.pending_handoffs = {}
+        self.failed_nodes = FailedNodes()
+        self.pending_handoffs = {}  # failed node -> {key: None} of hints held for it
+        self.handoff_queues = {}  # recovered node -> {key: None} of hints still to send
+        self.handoff_in_flight = {}  # recovered node -> handoff messages awaiting a response
+        self.pending_multi = {}  # seqno -> MultiRequest
+        self.read_repairs = OrderedDict()  # seqno -> (key, responses so far, nodes yet to answer), after quorum
+        self.sync_cursor = 0
+        self.metrics = RequestMetrics()
 
         Node.node_list.append(self)
-        Node.consistent_hash_tbl = ConsistentHashTable(Node.node_list, Node.T)
+        Node.consistent_hash_tbl.add_node(self)
 
         self.retry_failed_node("retry")
+        if Node.anti_entropy:
+            TimerManager.start_timer(self, reason="sync", priority=15, callback=self.sync_replicas)
+
+    def check_ranges(self):
+        """Re-split local_store into the current ring ranges if membership has changed since last time."""
+        tbl = Node.consistent_hash_tbl
+        if self.ring is not tbl or self.ring_version != tbl.version:
+            self.local_store.repartition(tbl.boundaries(), keep=tbl.owned_ranges(self, Node.N))
+            self.ring = tbl
+            self.ring_version = tbl.version
+
+    def shared_ranges(self, peer):
+        self.check_ranges()
+        tbl = Node.consistent_hash_tbl
+        peer_ranges = set(tbl.owned_ranges(peer, Node.N))
+        return [key_range for key_range in tbl.owned_ranges(self, Node.N) if key_range in peer_ranges]
 
     def put(self, key, value, metadata):
+        self.check_ranges()
         self.local_store[key] = (value, metadata)
 
     def get(self, key):
+        self.check_ranges()
         if key in self.local_store:
             return self.local_store[key]
 
@@ -58,9 +163,19 @@ class Node(BaseNode):
         cls.node_list = []
         cls.consistent_hash_tbl = ConsistentHashTable(cls.node_list, cls.T)
 
+    @classmethod
+    def cluster_metrics(cls, nodes=None):
+        """Request metrics of nodes (by default every node created, removed or not) merged together."""
+        if nodes is None:
+            nodes = [node for node in BaseNode.node_to_name if isinstance(node, cls)]
+        results = RequestMetrics()
+        for node in nodes:
+            results.merge(node.metrics)
+        return results
+
     def retry_failed_node(self, _):
-        if self.failed_nodes:
-            node = self.failed_nodes.pop(0)
+        node = self.failed_nodes.next_to_retry()
+        if node is not None:
             pingmsg = PingRequestMessage(self, node)
             Emulation.send_message(pingmsg)
         TimerManager.start_timer(self, reason="retry", priority=15, callback=self.retry_failed_node)
@@ -71,40 +186,101 @@ class Node(BaseNode):
 
     def process_PingResp(self, pingmsg):
         recovered_node = pingmsg.from_node
-        while recovered_node in self.failed_nodes:
-            self.failed_nodes.remove(recovered_node)
+        self.failed_nodes.discard(recovered_node)
         if recovered_node in self.pending_handoffs:
-            for key in self.pending_handoffs[recovered_node]:
+            self.handoff_queues.setdefault(recovered_node, {}).update(self.pending_handoffs.pop(recovered_node))
+            self.send_handoffs(recovered_node)
+
+    def send_handoffs(self, node):
+        """Send node the hints queued for it in batches, with at most handoff_window batches unacknowledged."""
+        queue = self.handoff_queues.get(node)
+        while queue and self.handoff_in_flight.get(node, 0) < Node.handoff_window:
+            entries = []
+            for key in list(itertools.islice(queue, Node.handoff_batch)):
+                del queue[key]
                 (value, metadata) = self.get(key)
-                putmsg = PutRequestMessage(self, recovered_node, key, value, metadata)
-                Emulation.send_message(putmsg)
-            del self.pending_handoffs[recovered_node]
+                entries.append((key, value, metadata))
+            self.handoff_in_flight[node] = self.handoff_in_flight.get(node, 0) + 1
+            Emulation.send_message(HandoffRequestMessage(self, node, entries))
+        if node in self.handoff_queues and not queue:
+            del self.handoff_queues[node]
+
+    def process_HandoffReq(self, handoffmsg):
+        _logger.info("%s: store %d handed-off keys", self, len(handoffmsg.entries))
+        for key, value, metadata in handoffmsg.entries:
+            self.put(key, value, metadata)
+        Emulation.send_message(HandoffResponseMessage(handoffmsg))
+
+    def process_HandoffResp(self, handoffrsp):
+        node = handoffrsp.from_node
+        self._handoff_answered(node)
+        self.send_handoffs(node)
+
+    def _handoff_answered(self, node):
+        count = self.handoff_in_flight.get(node, 0) - 1
+        if count > 0:
+            self.handoff_in_flight[node] = count
+        else:
+            self.handoff_in_flight.pop(node, None)
+
+    def requeue_handoff(self, handoffmsg):
+        """A handoff batch went unanswered: hold its keys, and any not yet sent, until the node answers a ping again."""
+        node = handoffmsg.to_node
+        self._handoff_answered(node)
+        self.failed_nodes.add(node)
+        hints = self.pending_handoffs.setdefault(node, {})
+        for key, _, _ in handoffmsg.entries:
+            hints[key] = None
+        hints.update(self.handoff_queues.pop(node, {}))
 
     def rsp_timer_pop(self, reqmsg):
         _logger.info("Node %s now treating node %s as failed", self, reqmsg.to_node)
-        self.failed_nodes.append(reqmsg.to_node)
+        self.failed_nodes.add(reqmsg.to_node)
         failed_requests = Emulation.cancel_timers_for_node(reqmsg.to_node)
         failed_requests.append(reqmsg)
         for failedmsg in failed_requests:
             self.retry_request(failedmsg)
 
     def retry_request(self, reqmsg):
+        if isinstance(reqmsg, HandoffRequestMessage):
+            # cancel_timers_for_node() returns every node's requests to the failed node, not just ours.
+            reqmsg.from_node.requeue_handoff(reqmsg)
+            return
+        if isinstance(reqmsg, (MultiPutRequestMessage, MultiGetRequestMessage)):
+            if reqmsg.msg_id in reqmsg.from_node.pending_multi:
+                reqmsg.from_node.retry_multi(reqmsg)
+            return
         if not isinstance(reqmsg, DynamoRequestMessage):
             return
+        if reqmsg.from_node is not self:
+            # Another coordinator's request, whose seqno may clash with ours: that node retries it.
+            if isinstance(reqmsg.from_node, Node) and not reqmsg.from_node.failed:
+                reqmsg.from_node.retry_request(reqmsg)
+            return
 
-        preference_list = Node.consistent_hash_tbl.find_nodes(reqmsg.key, Node.N, self.failed_nodes)[0]
+        # Another node's timer may have been the one to give up on the request.
+        self.failed_nodes.add(reqmsg.to_node)
+        if isinstance(reqmsg, (PutRequestMessage, GetRequestMessage)):
+            self.metrics.timed_out(reqmsg.msg_id)
+            if isinstance(reqmsg, GetRequestMessage) and reqmsg.msg_id in self.read_repairs:
+                awaited = self.read_repairs[reqmsg.msg_id][2]
+                awaited.discard(reqmsg.to_node)
+                if not awaited:
+                    self.finish_read_repair(reqmsg.msg_id)
+        preference_list = Node.consistent_hash_tbl.find_nodes(reqmsg.key, Node.N, self.failed_nodes.frozen())[0]
         kls = reqmsg.__class__
 
         if kls in self.pending_requests and reqmsg.msg_id in self.pending_requests[kls]:
             for node in preference_list:
                 if node not in [req.to_node for req in self.pending_requests[kls][reqmsg.msg_id]]:
-                    newreqmsg = copy.copy(reqmsg)
+                    newreqmsg = reqmsg.clone()
                     newreqmsg.to_node = node
                     self.pending_requests[kls][reqmsg.msg_id].add(newreqmsg)
+                    self.metrics.sent(reqmsg.msg_id, retry=True)
                     Emulation.send_message(newreqmsg)
 
     def process_ClientPutReq(self, msg):
-        preference_list, avoided = Node.consistent_hash_tbl.find_nodes(msg.key, Node.N, self.failed_nodes)
+        preference_list, avoided = Node.consistent_hash_tbl.find_nodes(msg.key, Node.N, self.failed_nodes.frozen())
         avoided = avoided[:Node.N]
         non_extra_count = Node.N - len(avoided)
         if self not in preference_list:
@@ -119,6 +295,7 @@ class Node(BaseNode):
             self.pending_requests[PutRequestMessage][seqno] = set()
             self.pending_put_rsp[seqno] = set()
             self.pending_put_msg[seqno] = msg
+            self.metrics.start('put', seqno)
             reqcount = 0
             for ii, node in enumerate(preference_list):
                 if ii >= non_extra_count:
@@ -127,13 +304,14 @@ class Node(BaseNode):
                     handoff = None
                 putmsg = PutRequestMessage(self, node, msg.key, msg.value, metadata, msg_id=seqno, handoff=handoff)
                 self.pending_requests[PutRequestMessage][seqno].add(putmsg)
+                self.metrics.sent(seqno)
                 Emulation.send_message(putmsg)
                 reqcount = reqcount + 1
                 if reqcount >= Node.N:
                     break
 
     def process_ClientGetReq(self, msg):
-        preference_list = Node.consistent_hash_tbl.find_nodes(msg.key, Node.N, self.failed_nodes)[0]
+        preference_list = Node.consistent_hash_tbl.find_nodes(msg.key, Node.N, self.failed_nodes.frozen())[0]
         if self not in preference_list:
             _logger.info("get(%s=?) maps to %s", msg.key, preference_list)
             coordinator = preference_list[0]
@@ -143,10 +321,12 @@ class Node(BaseNode):
             self.pending_requests[GetRequestMessage][seqno] = set()
             self.pending_get_rsp[seqno] = set()
             self.pending_get_msg[seqno] = msg
+            self.metrics.start('get', seqno)
             reqcount = 0
             for node in preference_list:
                 getmsg = GetRequestMessage(self, node, msg.key, msg_id=seqno)
                 self.pending_requests[GetRequestMessage][seqno].add(getmsg)
+                self.metrics.sent(seqno)
                 Emulation.send_message(getmsg)
                 reqcount = reqcount + 1
                 if reqcount >= Node.N:
@@ -154,23 +334,141 @@ class Node(BaseNode):
 
     def process_PutReq(self, putmsg):
         _logger.info("%s: store %s=%s", self, putmsg.key, putmsg.value)
-        self.put(putmsg.key, putmsg.value, putmsg.metadata)
-        if putmsg.handoff is not None:
-            for failed_node in putmsg.handoff:
-                self.failed_nodes.append(failed_node)
-                if failed_node not in self.pending_handoffs:
-                    self.pending_handoffs[failed_node] = set()
-                self.pending_handoffs[failed_node].add(putmsg.key)
+        self.store(putmsg.key, putmsg.value, putmsg.metadata, putmsg.handoff)
         putrsp = PutResponseMessage(putmsg)
         Emulation.send_message(putrsp)
 
+    def store(self, key, value, metadata, handoff):
+        """Store a replica's copy of key, holding it as a hint for the failed nodes in handoff too."""
+        self.put(key, value, metadata)
+        if handoff is not None:
+            for failed_node in handoff:
+                self.failed_nodes.add(failed_node)
+                self.pending_handoffs.setdefault(failed_node, {})[key] = None
+
+    def process_ClientMultiPutReq(self, msg):
+        seqno = self.get_next_sequence_number()
+        _logger.info("%s, %d: put %d keys", self, seqno, len(msg.entries))
+        request = self.pending_multi[seqno] = MultiRequest(msg, Node.W)
+        batches = {}
+        # A key given more than once is written once, with its last value.
+        for key, (value, metadata) in OrderedDict([(key, (value, metadata)) for key, value, metadata in msg.entries]).items():
+            metadata = copy.deepcopy(metadata)
+            metadata.update(self.node_to_name, seqno)
+            preference_list, avoided = Node.consistent_hash_tbl.find_nodes(key, Node.N, self.failed_nodes.frozen())
+            avoided = avoided[:Node.N]
+            non_extra_count = Node.N - len(avoided)
+            if not preference_list:
+                request.fail(key, (key, value, metadata, avoided))
+            for ii, node in enumerate(preference_list[:Node.N]):
+                if ii >= non_extra_count:
+                    handoff = avoided
+                else:
+                    handoff = None
+                entry = (key, value, metadata, handoff)
+                request.add(key, node, entry)
+                batches.setdefault(node, []).append(entry)
+        for node, entries in batches.items():
+            Emulation.send_message(MultiPutRequestMessage(self, node, entries, msg_id=seqno))
+        if not batches:
+            self.finish_multi(seqno, ClientMultiPutResponseMessage)
+
+    def process_ClientMultiGetReq(self, msg):
+        seqno = self.get_next_sequence_number()
+        _logger.info("%s, %d: get %d keys", self, seqno, len(msg.keys))
+        request = self.pending_multi[seqno] = MultiRequest(msg, Node.R)
+        batches = {}
+        for key in OrderedDict.fromkeys(msg.keys):
+            preference_list = Node.consistent_hash_tbl.find_nodes(key, Node.N, self.failed_nodes.frozen())[0]
+            if not preference_list:
+                request.fail(key, (key,))
+            for node in preference_list[:Node.N]:
+                request.add(key, node, (key,))
+                batches.setdefault(node, []).append(key)
+        for node, keys in batches.items():
+            Emulation.send_message(MultiGetRequestMessage(self, node, keys, msg_id=seqno))
+        if not batches:
+            self.finish_multi(seqno, ClientMultiGetResponseMessage)
+
+    def retry_multi(self, reqmsg):
+        """Re-send the keys of an unanswered batch that still lack a quorum to the next nodes in their preference lists."""
+        request = self.pending_multi[reqmsg.msg_id]
+        # Another node's timer may have been the one to give up on the batch.
+        self.failed_nodes.add(reqmsg.to_node)
+        if isinstance(reqmsg, MultiPutRequestMessage):
+            keys = [entry[0] for entry in reqmsg.entries]
+        else:
+            keys = reqmsg.keys
+        batches = {}
+        for key in keys:
+            if key in request.results:
+                continue
+            for node in Node.consistent_hash_tbl.find_nodes(key, Node.N, self.failed_nodes.frozen())[0]:
+                if node not in request.asked[key]:
+                    request.asked[key].add(node)
+                    batches.setdefault(node, []).append(request.entries[key])
+        for node, entries in batches.items():
+            if isinstance(reqmsg, MultiPutRequestMessage):
+                retrymsg = MultiPutRequestMessage(self, node, entries, msg_id=reqmsg.msg_id)
+            else:
+                retrymsg = MultiGetRequestMessage(self, node, [entry[0] for entry in entries], msg_id=reqmsg.msg_id)
+            Emulation.send_message(retrymsg)
+
+    def process_MultiPutReq(self, putmsg):
+        _logger.info("%s: store %d keys", self, len(putmsg.entries))
+        for key, value, metadata, handoff in putmsg.entries:
+            self.store(key, value, metadata, handoff)
+        Emulation.send_message(MultiPutResponseMessage(putmsg))
+
+    def process_MultiGetReq(self, getmsg):
+        _logger.info("%s: retrieve %d keys", self, len(getmsg.keys))
+        entries = [(key,) + tuple(self.get(key)) for key in getmsg.keys]
+        Emulation.send_message(MultiGetResponseMessage(getmsg, entries))
+
+    def process_MultiPutResp(self, putrsp):
+        self.multi_responses(putrsp, [(key, value, metadata) for key, value, metadata, _ in putrsp.response_to.entries])
+
+    def process_MultiGetResp(self, getrsp):
+        self.multi_responses(getrsp, getrsp.entries)
+
+    def multi_responses(self, rsp, entries):
+        """Count a replica's batch of responses towards each key's quorum, and answer the client when every key has one."""
+        request = self.pending_multi.get(rsp.msg_id)
+        if request is None:
+            return
+        for key, value, metadata in entries:
+            if key in request.results:
+                continue
+            responses = request.responses[key]
+            responses.append((rsp.from_node, value, metadata))
+            if len(responses) >= request.required:
+                if isinstance(rsp, MultiPutResponseMessage):
+                    request.results[key] = metadata
+                else:
+                    results = VectorClock.coalesce2([(value, metadata) for (_, value, metadata) in responses])
+                    request.results[key] = ([value for (value, _) in results], [metadata for (_, metadata) in results])
+                del request.responses[key]
+        if len(request.results) == len(request.entries):
+            if isinstance(rsp, MultiPutResponseMessage):
+                self.finish_multi(rsp.msg_id, ClientMultiPutResponseMessage)
+            else:
+                self.finish_multi(rsp.msg_id, ClientMultiGetResponseMessage)
+
+    def finish_multi(self, seqno, rsp_class):
+        request = self.pending_multi.pop(seqno)
+        _logger.info("%s: %d keys done", self, len(request.results))
+        Emulation.send_message(rsp_class(request.msg, request.results))
+
     def process_PutResp(self, putrsp):
         seqno = putrsp.msg_id
+        self.metrics.responded(seqno)
         if seqno in self.pending_put_rsp:
             self.pending_put_rsp[seqno].add(putrsp.from_node)
             if len(self.pending_put_rsp[seqno]) >= Node.W:
+                self.metrics.reached_quorum(seqno)
                 _logger.info("%s: written %d copies of %s=%s so done", self, Node.W, putrsp.key, putrsp.value)
-                _logger.debug("  copies at %s", [node.node_to_name for node in self.pending_put_rsp[seqno]])
+                if _logger.isEnabledFor(logging.DEBUG):
+                    _logger.debug("  copies at %s", [node.node_to_name for node in self.pending_put_rsp[seqno]])
                 original_msg = self.pending_put_msg[seqno]
                 del self.pending_requests[PutRequestMessage][seqno]
                 del self.pending_put_rsp[seqno]
@@ -188,15 +486,20 @@ class Node(BaseNode):
 
     def process_GetResp(self, getrsp):
         seqno = getrsp.msg_id
+        self.metrics.responded(seqno)
         if seqno in self.pending_get_rsp:
             self.pending_get_rsp[seqno].add((getrsp.from_node, getrsp.value, getrsp.metadata))
             if len(self.pending_get_rsp[seqno]) >= Node.R:
+                self.metrics.reached_quorum(seqno)
                 _logger.info("%s: read %d copies of %s=? so done", self, Node.R, getrsp.key)
-                _logger.debug("  copies at %s", [(node.node_to_name, value) for (node, value, _) in self.pending_get_rsp[seqno]])
+                if _logger.isEnabledFor(logging.DEBUG):
+                    _logger.debug("  copies at %s", [(node.node_to_name, value) for (node, value, _) in self.pending_get_rsp[seqno]])
 
                 results = VectorClock.coalesce2([(value, metadata) for (node, value, metadata) in self.pending_get_rsp[seqno]])
 
                 original_msg = self.pending_get_msg[seqno]
+                if Node.read_repair:
+                    self.start_read_repair(seqno, getrsp.key)
                 del self.pending_requests[GetRequestMessage][seqno]
                 del self.pending_get_rsp[seqno]
                 del self.pending_get_msg[seqno]
@@ -205,28 +508,134 @@ class Node(BaseNode):
                                                          [value for (value, metadata) in results],
                                                          [metadata for (value, metadata) in results])
                 Emulation.send_message(client_getrsp)
-        else:
-            pass
+        elif seqno in self.read_repairs:
+            (key, responses, awaited) = self.read_repairs[seqno]
+            responses.append((getrsp.from_node, getrsp.value, getrsp.metadata))
+            awaited.discard(getrsp.from_node)
+            if not awaited:
+                self.finish_read_repair(seqno)
+
+    def start_read_repair(self, seqno, key):
+        """Hold on to a get's responses until every replica asked has answered or been given up on."""
+        responses = list(self.pending_get_rsp[seqno])
+        answered = set([node for (node, _, _) in responses])
+        awaited = set([req.to_node for req in self.pending_requests[GetRequestMessage][seqno]
+                       if req.to_node not in answered and req.to_node not in self.failed_nodes])
+        self.read_repairs[seqno] = (key, responses, awaited)
+        if not awaited:
+            self.finish_read_repair(seqno)
+        elif len(self.read_repairs) > Node.read_repair_limit:
+            self.finish_read_repair(next(iter(self.read_repairs)))
+
+    def finish_read_repair(self, seqno):
+        """Send the newest version to the replicas that returned one it supersedes; concurrent versions are left alone."""
+        (key, responses, _) = self.read_repairs.pop(seqno)
+        results = VectorClock.coalesce2([(value, metadata) for (node, value, metadata) in responses])
+        if len(results) > 1:
+            self.metrics.read_repair_conflicts = self.metrics.read_repair_conflicts + 1
+            return
+        (value, metadata) = results[0]
+        for (node, _, node_metadata) in responses:
+            if (node_metadata or VectorClock()) != metadata:
+                _logger.info("%s: read repair of %s at %s", self, key, node)
+                repairmsg = ReadRepairMessage(self, node, key, value, metadata)
+                Emulation.send_message(repairmsg, expect_reply=False)
+                self.metrics.read_repairs = self.metrics.read_repairs + 1
+
+    def process_ReadRepair(self, repairmsg):
+        self.reconcile(repairmsg.key, repairmsg.value, repairmsg.metadata)
+
+    def sync_replicas(self, _):
+        peers = [node for node in Node.consistent_hash_tbl.peers(self, Node.N) if node not in self.failed_nodes]
+        if peers:
+            peer = peers[self.sync_cursor % len(peers)]
+            self.sync_cursor = self.sync_cursor + 1
+            self.sync_with(peer)
+        TimerManager.start_timer(self, reason="sync", priority=15, callback=self.sync_replicas)
+
+    def sync_with(self, peer):
+        """Start an anti-entropy exchange with peer, comparing the roots of every range both own."""
+        digests = [(key_range, 1, self.local_store.tree(key_range).root_digest())
+                   for key_range in self.shared_ranges(peer)]
+        if digests:
+            # A peer already in sync sends nothing back, so no response timer: an exchange that is
+            # lost is simply retried on a later round rather than treated as a failure.
+            syncmsg = SyncRequestMessage(self, peer, digests)
+            Emulation.send_message(syncmsg, expect_reply=False)
+
+    def process_Sync(self, syncmsg):
+        # Each step descends one level into the subtrees whose digests differ; once leaves differ the
+        # two sides swap per-key entry hashes and then ship only the keys that disagree.  A range the
+        # other side holds nothing of is shipped whole.
+        self.check_ranges()
+        digests = []
+        summaries = {}
+        entries = []
+        for key_range, pos, digest in syncmsg.digests:
+            tree = self.local_store.tree(key_range, create=True)
+            mine = tree.digest(pos)
+            if mine == digest:
+                continue
+            empty = empty_digest(tree.height(pos), tree.leaf_digest)
+            if pos == 1 and digest == empty:
+                entries.extend([(key, value, metadata) for key, (value, metadata) in tree.items()])
+            elif pos == 1 and mine == empty:
+                digests.append((key_range, pos, mine))
+            elif pos >= tree.num_leaves:
+                summaries[(key_range, pos)] = self._leaf_summary(tree, pos)
+            else:
+                digests.extend([(key_range, child, tree.digest(child)) for child in (2 * pos, 2 * pos + 1)])
+        wanted = []
+        for (key_range, pos), theirs in syncmsg.summaries.items():
+            mine = self._leaf_summary(self.local_store.tree(key_range, create=True), pos)
+            entries.extend([self._sync_entry(key) for key in mine if theirs.get(key) != mine[key]])
+            wanted.extend([key for key in theirs if mine.get(key) != theirs[key]])
+        for key, value, metadata in syncmsg.entries:
+            self.reconcile(key, value, metadata)
+        entries.extend([self._sync_entry(key) for key in syncmsg.wanted if key in self.local_store])
+        if digests or summaries or entries or wanted:
+            syncrsp = SyncResponseMessage(syncmsg, digests, summaries, entries, wanted)
+            Emulation.send_message(syncrsp)
+
+    def _leaf_summary(self, tree, pos):
+        return dict([(key, entry_hash(key, value)) for key, value in tree.leaf_items(pos)])
+
+    def _sync_entry(self, key):
+        (value, metadata) = self.get(key)
+        return (key, value, metadata)
+
+    def reconcile(self, key, value, metadata):
+        """Adopt a replica's version of key if it supersedes ours; concurrent versions are left alone."""
+        (local_value, local_metadata) = self.get(key)
+        results = VectorClock.coalesce2([(local_value, local_metadata), (value, metadata)])
+        if len(results) == 1 and results[0][1] != (local_metadata or VectorClock()):
+            self.put(key, value, metadata)
+
+    msg_handlers = {ClientPutRequestMessage: 'process_ClientPutReq',
+                    PutRequestMessage: 'process_PutReq',
+                    PutResponseMessage: 'process_PutResp',
+                    ClientGetRequestMessage: 'process_ClientGetReq',
+                    GetRequestMessage: 'process_GetReq',
+                    GetResponseMessage: 'process_GetResp',
+                    PingRequestMessage: 'process_PingReq',
+                    PingResponseMessage: 'process_PingResp',
+                    SyncRequestMessage: 'process_Sync',
+                    SyncResponseMessage: 'process_Sync',
+                    HandoffRequestMessage: 'process_HandoffReq',
+                    HandoffResponseMessage: 'process_HandoffResp',
+                    ReadRepairMessage: 'process_ReadRepair',
+                    ClientMultiPutRequestMessage: 'process_ClientMultiPutReq',
+                    ClientMultiGetRequestMessage: 'process_ClientMultiGetReq',
+                    MultiPutRequestMessage: 'process_MultiPutReq',
+                    MultiPutResponseMessage: 'process_MultiPutResp',
+                    MultiGetRequestMessage: 'process_MultiGetReq',
+                    MultiGetResponseMessage: 'process_MultiGetResp'}
 
     def process_msg(self, msg):
-        if isinstance(msg, ClientPutRequestMessage):
-            self.process_ClientPutReq(msg)
-        elif isinstance(msg, PutRequestMessage):
-            self.process_PutReq(msg)
-        elif isinstance(msg, PutResponseMessage):
-            self.process_PutResp(msg)
-        elif isinstance(msg, ClientGetRequestMessage):
-            self.process_ClientGetReq(msg)
-        elif isinstance(msg, GetRequestMessage):
-            self.process_GetReq(msg)
-        elif isinstance(msg, GetResponseMessage):
-            self.process_GetResp(msg)
-        elif isinstance(msg, PingRequestMessage):
-            self.process_PingReq(msg)
-        elif isinstance(msg, PingResponseMessage):
-            self.process_PingResp(msg)
-        else:
-            raise TypeError("Unexpected message type %s", msg.__class__)
+        handler = self.handler_for(msg.__class__)
+        if handler is None:
+            raise TypeError("Unexpected message type %s" % msg.__class__)
+        handler(self, msg)
 
     def content_to_str(self):
         results = []
@@ -261,6 +670,28 @@ class Client(BaseNode):
         Emulation.send_message(getmsg)
         return getmsg
 
+    def multi_put(self, entries, destnode=None):
+        """Put several keys in one request: entries are (key, metadata, value), as the arguments to put()."""
+        if destnode is None:
+            destnode = random.choice(Node.node_list)
+        msg_entries = []
+        for key, metadata, value in entries:
+            if not metadata or (len(metadata) == 1 and metadata[0] is None):
+                metadata = VectorClock()
+            else:
+                metadata = VectorClock.converge(metadata)
+            msg_entries.append((key, value, metadata))
+        putmsg = ClientMultiPutRequestMessage(self, destnode, msg_entries)
+        Emulation.send_message(putmsg)
+        return putmsg
+
+    def multi_get(self, keys, destnode=None):
+        if destnode is None:
+            destnode = random.choice(Node.node_list)
+        getmsg = ClientMultiGetRequestMessage(self, destnode, list(keys))
+        Emulation.send_message(getmsg)
+        return getmsg
+
     def rsp_timer_pop(self, reqmsg):
         if isinstance(reqmsg, ClientPutRequestMessage):
             _logger.info("Put request timed out; retrying")
@@ -268,6 +699,12 @@ class Client(BaseNode):
         elif isinstance(reqmsg, ClientGetRequestMessage):
             _logger.info("Get request timed out; retrying")
             self.get(reqmsg.key)
+        elif isinstance(reqmsg, ClientMultiPutRequestMessage):
+            _logger.info("Multi-key put request timed out; retrying")
+            self.multi_put([(key, [metadata], value) for key, value, metadata in reqmsg.entries])
+        elif isinstance(reqmsg, ClientMultiGetRequestMessage):
+            _logger.info("Multi-key get request timed out; retrying")
+            self.multi_get(reqmsg.keys)
 
     def process_msg(self, msg):
         self.prev_msg = msg
@@ -1,11 +1,13 @@
-import copy
+import heapq
 import logging
+import itertools
 from collections import deque
 
 from basenode import BaseNode
 from history import History
 from timer import TimerManager
-from messages import ResponseMessage
+from messages import ResponseMessage, TimerMessage
+from latency import Constant
 import logconfig
 
 logconfig.init_logging()
@@ -13,100 +15,201 @@ _logger = logging.getLogger('dynamo')
 
 
 class Emulation(object):
-    unreachable_nodes = []
+    unreachable_nodes = []  # (from_nodes, to_nodes) pairs cut by disconnect()
+    # from node -> set of nodes it cannot reach, indexed from unreachable_nodes.  Change
+    # unreachable_nodes through disconnect() and reconnect() or by assigning a new list;
+    # the index is rebuilt when the list is replaced, but not if it is edited in place.
+    blocked = {}
+    blocked_source = None
     pending_msg_queue = deque([])
-    pending_timers = {}
+    pending_timers = {}  # request -> its response timer
+    timers_by_dest = {}  # destination node -> {request: None}, the requests to it in pending_timers
+    # Virtual time (see set_virtual_time): messages in flight and timers share one
+    # heap of [due time, sequence, message or timer], and clock is the time of the
+    # event being processed.
+    virtual_time = False
+    latency = Constant(1.0)  # Default link latency distribution
+    link_latency = {}  # (from node, to node) -> latency distribution
+    clock = 0.0
+    events = []
+    event_sequence = itertools.count()
+    in_flight = 0
+    steps = 0  # Messages processed, the clock under FIFO delivery
 
     @classmethod
     def reset(cls):
         cls.unreachable_nodes = []
         cls.pending_msg_queue = deque([])
         cls.pending_timers = {}
+        cls.timers_by_dest = {}
+        cls.link_latency = {}
+        cls.clock = 0.0
+        cls.events = []
+        cls.event_sequence = itertools.count()
+        cls.in_flight = 0
+        cls.steps = 0
+        cls.set_virtual_time(False, Constant(1.0))
+
+    @classmethod
+    def set_virtual_time(cls, enabled=True, latency=None):
+        """
+        Switch between FIFO delivery (timers only pop when no messages are queued) and
+        a simulated clock, where each message takes its link's latency to arrive and
+        each timer pops after its duration.  Switch before a run, with nothing pending.
+        """
+        cls.virtual_time = enabled
+        if latency is not None:
+            cls.latency = latency
+        if enabled:
+            TimerManager.scheduler = cls
+        else:
+            TimerManager.scheduler = None
+
+    @classmethod
+    def set_latency(cls, latency, from_nodes, to_nodes):
+        for from_node in from_nodes:
+            for to_node in to_nodes:
+                cls.link_latency[(from_node, to_node)] = latency
+
+    @classmethod
+    def now(cls):
+        """Virtual time, or under FIFO delivery the number of messages processed so far."""
+        if cls.virtual_time:
+            return cls.clock
+        return float(cls.steps)
+
+    @classmethod
+    def schedule(cls, obj, delay):
+        entry = [cls.clock + delay, next(cls.event_sequence), obj]
+        heapq.heappush(cls.events, entry)
+        return entry
 
     @classmethod
     def disconnect(cls, from_nodes, to_nodes):
         History.add("announce", "Cut %s -> %s" % ([str(x) for x in from_nodes], [str(x) for x in to_nodes]))
         cls.unreachable_nodes.append((from_nodes, to_nodes))
+        if cls.blocked_source is cls.unreachable_nodes:
+            cls._block(from_nodes, to_nodes)
 
     @classmethod
-    def is_reachable(cls, from_node, to_node):
+    def reconnect(cls, from_nodes=None, to_nodes=None):
+        """
+        Restore the links from from_nodes to to_nodes that disconnect() cut.  None on either
+        side stands for every node, so reconnect(to_nodes=[node]) restores every link into
+        node, and with no arguments every link is restored.
+        """
+        if from_nodes is None and to_nodes is None:
+            History.add("announce", "Reconnect all")
+            cls.unreachable_nodes = []
+            return
+        History.add("announce", "Reconnect %s -> %s" % (_names(from_nodes), _names(to_nodes)))
+        remaining = []
+        for (cut_from, cut_to) in cls.unreachable_nodes:
+            for from_node in cut_from:
+                if from_nodes is None or from_node in from_nodes:
+                    if to_nodes is None:
+                        continue
+                    still_cut = tuple([to_node for to_node in cut_to if to_node not in to_nodes])
+                    if still_cut:
+                        remaining.append(((from_node,), still_cut))
+                else:
+                    remaining.append(((from_node,), cut_to))
+        cls.unreachable_nodes = remaining
+
+    @classmethod
+    def _block(cls, from_nodes, to_nodes):
+        for from_node in from_nodes:
+            cls.blocked.setdefault(from_node, set()).update(to_nodes)
+
+    @classmethod
+    def _index_unreachable(cls):
+        cls.blocked = {}
+        cls.blocked_source = cls.unreachable_nodes
         for (from_nodes, to_nodes) in cls.unreachable_nodes:
-            if from_node in from_nodes and to_node in to_nodes:
-                return False
-        return True
+            cls._block(from_nodes, to_nodes)
+
+    @classmethod
+    def is_reachable(cls, from_node, to_node):
+        if cls.blocked_source is not cls.unreachable_nodes:
+            cls._index_unreachable()
+        blocked = cls.blocked.get(from_node)
+        return blocked is None or to_node not in blocked
 
     @classmethod
     def send_message(cls, msg, expect_reply=True):
         _logger.info("Enqueue %s->%s: %s", msg.from_node, msg.to_node, msg)
-        cls.pending_msg_queue.append(msg)
+        cls._transmit(msg, msg.from_node)
         History.add("send", msg)
         if (expect_reply and
             not isinstance(msg, ResponseMessage) and
-            'rsp_timer_pop' in msg.from_node.__class__.__dict__ and
-            callable(msg.from_node.__class__.__dict__['rsp_timer_pop'])):
-            cls.pending_timers[msg] = TimerManager.start_timer(msg.from_node, reason=msg, callback=Emulation.rsp_timer_pop)
+            msg.from_node.expects_response_timer()):
+            tmsg = TimerManager.start_timer(msg.from_node, reason=msg, callback=Emulation.rsp_timer_pop)
+            cls.pending_timers[msg] = tmsg
+            cls.timers_by_dest.setdefault(msg.to_node, {})[msg] = None
 
     @classmethod
     def cancel_req_timer(cls, timer_msg):
         if timer_msg in cls.pending_timers:
-            TimerManager.cancel_timer(cls.pending_timers[timer_msg])
-            del cls.pending_timers[timer_msg]
+            TimerManager.cancel_timer(cls.pending_timers.pop(timer_msg))
+            cls._unindex_timer(timer_msg)
 
     @classmethod
     def cancel_timers_for_node(cls, dest):
-        failed_requests = []
-        pending_timers_keys = list(cls.pending_timers.keys())
-        for timer_msg in pending_timers_keys:
-            if timer_msg.to_node == dest:
-                TimerManager.cancel_timer(cls.pending_timers[timer_msg])
-                del cls.pending_timers[timer_msg]
-                failed_requests.append(timer_msg)
+        """Cancel the response timers of every request sent to dest and return those requests, oldest first."""
+        failed_requests = list(cls.timers_by_dest.pop(dest, ()))
+        for timer_msg in failed_requests:
+            TimerManager.cancel_timer(cls.pending_timers.pop(timer_msg))
         return failed_requests
 
+    @classmethod
+    def _unindex_timer(cls, timer_msg):
+        requests = cls.timers_by_dest[timer_msg.to_node]
+        del requests[timer_msg]
+        if not requests:
+            del cls.timers_by_dest[timer_msg.to_node]
+
     @classmethod
     def rsp_timer_pop(cls, timer_msg):
         del cls.pending_timers[timer_msg]
-        _logger.debug("Call on to rsp_timer_pop() for node %s" % timer_msg.from_node)
+        cls._unindex_timer(timer_msg)
+        _logger.debug("Call on to rsp_timer_pop() for node %s", timer_msg.from_node)
         timer_msg.from_node.rsp_timer_pop(timer_msg)
 
     @classmethod
     def forward_message(cls, msg, to_node):
         _logger.info("Enqueue(fwd) %s->%s: %s", msg.to_node, to_node, msg)
-        fwd_msg = copy.copy(msg)
+        fwd_msg = msg.clone()
         fwd_msg.intermediate_node = fwd_msg.to_node
         fwd_msg.original_msg = msg
         fwd_msg.to_node = to_node
-        cls.pending_msg_queue.append(fwd_msg)
+        cls._transmit(fwd_msg, fwd_msg.intermediate_node)
         History.add("forward", fwd_msg)
 
     @classmethod
-    def run(cls, msgs_to_process=None, timers_to_process=None):
+    def _transmit(cls, msg, from_node):
+        if cls.virtual_time:
+            cls.schedule(msg, cls.link_latency.get((from_node, msg.to_node), cls.latency)())
+            cls.in_flight = cls.in_flight + 1
+        else:
+            cls.pending_msg_queue.append(msg)
+
+    @classmethod
+    def run(cls, msgs_to_process=None, timers_to_process=None, until=None):
+        """Process messages and timers until none are left or a limit is reached; until (virtual time only) stops the clock."""
         if msgs_to_process is None:
             msgs_to_process = 32768
         if timers_to_process is None:
             timers_to_process = 32768
+        log_info = _logger.isEnabledFor(logging.INFO)
+        if cls.virtual_time:
+            cls._run_virtual(msgs_to_process, timers_to_process, until, log_info)
+            return
 
         while cls._msgs_remaining():
             _logger.info("Start of schedule: %d (limit %d) pending messages, %d (limit %d) pending timers",
                          len(cls.pending_msg_queue), msgs_to_process, TimerManager.pending_count(), timers_to_process)
             while cls.pending_msg_queue:
-                msg = cls.pending_msg_queue.popleft()
-                if msg.to_node.failed:
-                    _logger.info("Drop %s->%s: %s as destination down", msg.from_node, msg.to_node, msg)
-                    History.add("drop", msg)
-                elif not Emulation.is_reachable(msg.from_node, msg.to_node):
-                    _logger.info("Drop %s->%s: %s as route down", msg.from_node, msg.to_node, msg)
-                    History.add("cut", msg)
-                else:
-                    _logger.info("Dequeue %s->%s: %s", msg.from_node, msg.to_node, msg)
-                    if isinstance(msg, ResponseMessage):
-                        try:
-                            reqmsg = msg.response_to.original_msg
-                        except Exception:
-                            reqmsg = msg.response_to
-                        cls.cancel_req_timer(reqmsg)
-                    History.add("deliver", msg)
-                    msg.to_node.process_msg(msg)
+                cls._receive(cls.pending_msg_queue.popleft(), log_info)
                 msgs_to_process = msgs_to_process - 1
                 if msgs_to_process == 0:
                     return
@@ -117,13 +220,71 @@ class Emulation(object):
             if timers_to_process == 0:
                 return
 
+    @classmethod
+    def _run_virtual(cls, msgs_to_process, timers_to_process, until, log_info):
+        events = cls.events
+        while events:
+            due, _, obj = events[0]
+            if obj is None:  # cancelled timer
+                heapq.heappop(events)
+                continue
+            if until is not None and due > until:
+                cls.clock = until
+                return
+            if isinstance(obj, TimerMessage):
+                if timers_to_process == 0:
+                    return
+                heapq.heappop(events)
+                cls.clock = due
+                if TimerManager.fire(obj):
+                    timers_to_process = timers_to_process - 1
+            else:
+                if msgs_to_process == 0:
+                    return
+                heapq.heappop(events)
+                cls.clock = due
+                cls.in_flight = cls.in_flight - 1
+                cls._receive(obj, log_info)
+                msgs_to_process = msgs_to_process - 1
+        if until is not None:
+            cls.clock = until
+
+    @classmethod
+    def _receive(cls, msg, log_info):
+        cls.steps = cls.steps + 1
+        if msg.to_node.failed:
+            if log_info:
+                _logger.info("Drop %s->%s: %s as destination down", msg.from_node, msg.to_node, msg)
+            History.add("drop", msg)
+        elif not Emulation.is_reachable(msg.from_node, msg.to_node):
+            if log_info:
+                _logger.info("Drop %s->%s: %s as route down", msg.from_node, msg.to_node, msg)
+            History.add("cut", msg)
+        else:
+            if log_info:
+                _logger.info("Dequeue %s->%s: %s", msg.from_node, msg.to_node, msg)
+            if isinstance(msg, ResponseMessage):
+                try:
+                    reqmsg = msg.response_to.original_msg
+                except Exception:
+                    reqmsg = msg.response_to
+                cls.cancel_req_timer(reqmsg)
+            History.add("deliver", msg)
+            msg.to_node.deliver(msg)
+
     @classmethod
     def _msgs_remaining(cls):
-        if cls.pending_msg_queue or TimerManager.pending_count() > 0:
+        if cls.pending_msg_queue or cls.in_flight or TimerManager.pending_count() > 0:
             return True
         return False
 
 
+def _names(nodes):
+    if nodes is None:
+        return "all"
+    return [str(x) for x in nodes]
+
+
 def reset():
     Emulation.reset()
     TimerManager.reset()
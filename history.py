@@ -1,4 +1,6 @@
-from bisect import bisect
+from bisect import bisect, bisect_left
+from collections import deque
+from itertools import islice
 import logging
 
 _logger = logging.getLogger('dynamo')
@@ -49,21 +51,166 @@ class History(object):
       'add'      - node added to configuration
       'remove'   - node removed from configuration
       'announce' - overall message to be included in output
+
+    By default every event is kept in memory.  configure() can instead keep only
+    the last `limit` events, stream each event to a list of sinks as it happens,
+    or switch collection off altogether.  ladder() draws whatever is retained.
+
+    With indexed=True, add() also maintains lists of (seq, action, object) events
+    per action, node, key and msg_id, so query() and lifecycle() only visit events
+    that can match.  Timer events are indexed under the request they time.
     """
     history = []
+    limit = None  # Number of events retained in memory; None keeps everything
+    sinks = []  # Objects with write(index, action, obj) and close(), see below
+    enabled = True
+    count = 0  # Events added since the last reset(), retained or not
+    indexed = False
+    by_action = {}
+    by_node = {}
+    by_key = {}
+    by_msg_id = {}
+
+    @classmethod
+    def configure(cls, limit=None, sinks=None, enabled=True, indexed=False):
+        for sink in cls.sinks:
+            if sink not in (sinks or []):
+                sink.close()
+        cls.limit = limit
+        cls.sinks = list(sinks or [])
+        cls.enabled = enabled
+        cls.indexed = indexed and limit != 0
+        cls.reset()
 
     @classmethod
     def reset(cls):
-        cls.history = []
+        if cls.limit is None:
+            cls.history = []
+        else:
+            cls.history = deque(maxlen=cls.limit)
+        cls.count = 0
+        cls.by_action = {}
+        cls.by_node = {}
+        cls.by_key = {}
+        cls.by_msg_id = {}
 
     @classmethod
     def add(cls, action, obj):
+        if not cls.enabled:
+            return
         cls.history.append((action, obj))
+        for sink in cls.sinks:
+            sink.write(cls.count, action, obj)
+        if cls.indexed:
+            cls._index(cls.count, action, obj)
+        cls.count = cls.count + 1
+
+    @classmethod
+    def _index(cls, seq, action, obj):
+        # The same tuple goes into every list, so queries read events straight from the index.
+        event = (seq, action, obj)
+        _append(cls.by_action, action, event)
+        if hasattr(obj, 'from_node'):
+            from_node = obj.from_node
+            _append(cls.by_node, from_node, event)
+            if obj.to_node is not from_node:
+                _append(cls.by_node, obj.to_node, event)
+            intermediate = getattr(obj, 'intermediate_node', None)
+            if intermediate is not None:
+                _append(cls.by_node, intermediate, event)
+            subject = getattr(obj, 'reason', None)
+            if not hasattr(subject, 'msg_id'):
+                subject = obj
+            key = getattr(subject, 'key', None)
+            if key is not None:
+                _append(cls.by_key, key, event)
+            if subject.msg_id is not None:
+                _append(cls.by_msg_id, subject.msg_id, event)
+        if cls.limit and seq % cls.limit == 0:
+            cls._prune(seq - cls.limit + 1)
+
+    @classmethod
+    def _prune(cls, first):
+        """Drop index entries for events that have left the retained window."""
+        for index in (cls.by_action, cls.by_node, cls.by_key, cls.by_msg_id):
+            for value in list(index.keys()):
+                events = index[value]
+                if events[0][0] < first:
+                    del events[:bisect_left(events, (first,))]
+                    if not events:
+                        del index[value]
+
+    @classmethod
+    def event(cls, seq):
+        """The (action, object) pair for sequence number seq, which must still be retained."""
+        first = cls.count - len(cls.history)
+        if not first <= seq < cls.count:
+            raise IndexError("event %d is not retained" % seq)
+        return cls.history[seq - first]
+
+    @classmethod
+    def query(cls, action=None, node=None, key=None, msg_id=None, start=0, end=None):
+        """
+        Retained events matching every given criterion, with start <= sequence number < end,
+        as (seq, action, object) triples.  Without indexing this scans the retained events.
+        """
+        first = cls.count - len(cls.history)
+        start = max(start, first)
+        if end is None or end > cls.count:
+            end = cls.count
+        best = None
+        if cls.indexed:
+            # Walk the shortest matching run of an index; the criterion it belongs
+            # to then needs no further checking.
+            criteria = {'action': action, 'node': node, 'key': key, 'msg_id': msg_id}
+            for name, index in (('action', cls.by_action), ('node', cls.by_node),
+                                ('key', cls.by_key), ('msg_id', cls.by_msg_id)):
+                if criteria[name] is not None:
+                    events = index.get(criteria[name], [])
+                    lo, hi = bisect_left(events, (start,)), bisect_left(events, (end,))
+                    if hi - lo < end - start and (best is None or hi - lo < best[3] - best[2]):
+                        best = (name, events, lo, hi)
+        if best is not None:
+            name, events, lo, hi = best
+            candidates = events[lo:hi]
+            criteria[name] = None
+            action, node, key, msg_id = criteria['action'], criteria['node'], criteria['key'], criteria['msg_id']
+        else:
+            lo, events = cls._window(start, end)
+            candidates = ((seq, this_action, obj) for seq, (this_action, obj) in enumerate(events, lo))
+        results = []
+        for (seq, this_action, obj) in candidates:
+            if action is not None and this_action != action:
+                continue
+            if node is not None or key is not None or msg_id is not None:
+                nodes, this_key, this_msg_id = _index_terms(obj)
+                if ((node is not None and node not in nodes) or
+                    (key is not None and this_key != key) or
+                    (msg_id is not None and this_msg_id != msg_id)):
+                    continue
+            results.append((seq, this_action, obj))
+        return results
+
+    @classmethod
+    def lifecycle(cls, msg_id, coordinator, start=0, end=None):
+        """Requests coordinator sent as msg_id, with their forwards, responses and response timers."""
+        return [(seq, action, obj) for (seq, action, obj) in cls.query(node=coordinator, msg_id=msg_id, start=start, end=end)
+                if _origin(obj) is coordinator]
+
+    @classmethod
+    def _window(cls, start=None, end=None):
+        """Sequence number of the first retained event in [start, end), and an iterator over those events."""
+        first = cls.count - len(cls.history)
+        lo = first if start is None else max(start, first)
+        hi = cls.count if end is None else min(end, cls.count)
+        if hi <= lo:
+            return lo, iter([])
+        return lo, islice(cls.history, lo - first, hi - first)
 
     @classmethod
-    def nodelist(cls, force_include=None, key=lambda x: x.node_to_name):
+    def nodelist(cls, force_include=None, key=lambda x: x.node_to_name, start=None, end=None):
         nodeset = set()
-        for (action, msg) in cls.history:
+        for (action, msg) in cls._window(start, end)[1]:
             if action == "send" or action == "forward":
                 nodeset.add(msg.from_node)
                 nodeset.add(msg.to_node)
@@ -76,7 +223,21 @@ class History(object):
 
     @classmethod
     def ladder(cls, spacing=20, verbose_timers=False, start_line=0, force_include=None, key=lambda x: x.node_to_name):
-        nodelist = cls.nodelist(force_include, key=key)
+        return '\n'.join(cls.ladder_lines(spacing, verbose_timers, start_line, force_include, key))
+
+    @classmethod
+    def ladder_lines(cls, spacing=20, verbose_timers=False, start_line=0, force_include=None, key=lambda x: x.node_to_name,
+                     nodes=None, start=None, end=None):
+        """
+        Generate the lines of ladder() one at a time.  nodes restricts the diagram to those
+        nodes, leaving out messages to or from any other node, and start/end restrict it to
+        events with start <= sequence number < end.  Events before start_line are still
+        tracked but draw no lines.
+        """
+        if nodes is None:
+            nodelist = cls.nodelist(force_include, key=key, start=start, end=end)
+        else:
+            nodelist = sorted(nodes, key=key)
         num_nodes = len(nodelist)
         included_nodes = set()
 
@@ -88,23 +249,28 @@ class History(object):
 
         vertlines = {}
         failed_nodes = set()
-        lines = [_header_line(nodelist, spacing)]
-        lineno = 0
-
-        for ii in range(len(cls.history)):
-            action, msg = cls.history[ii]
+        yield _header_line(nodelist, spacing)
+        first, events = cls._window(start, end)
+        # Line numbers count from the first event since reset(), so start_line means
+        # the same thing whether or not earlier events have been discarded.
+        lineno = first
+        if lineno > 0:
+            # The add events for these nodes may have been discarded.
+            included_nodes.update(nodelist)
+
+        # Every line starts as a copy of base, which holds the node markers and the
+        # vertical lines of messages in flight and is updated as those change.
+        base = [GLYPHS.BLANK] * linelen
+        for node in included_nodes:
+            base[column[node]] = GLYPHS.OK_NODE
+        this_line = []
+
+        next_event = next(events, None)
+        while next_event is not None:
+            action, msg = next_event
+            next_event = next(events, None)
             lineno = lineno + 1
-            this_line = [GLYPHS.BLANK for jj in range(linelen)]
-            for node, nodecol in column.items():
-                if node in included_nodes:
-                    if node in failed_nodes:
-                        this_line[nodecol] = GLYPHS.FAILED_NODE
-                    else:
-                        this_line[nodecol] = GLYPHS.OK_NODE
-                else:
-                    this_line[nodecol] = GLYPHS.BLANK
-            for vertcol in vertlines.values():
-                this_line[vertcol] = GLYPHS.VERTICAL_LINE
+            this_line[:] = base
 
             if action == "send" or action == "forward":
                 if action == "forward":
@@ -113,9 +279,14 @@ class History(object):
                 else:
                     from_node = msg.from_node
                     start_marker = GLYPHS.MSG_START
+                if from_node not in column or msg.to_node not in column:
+                    continue
+                if msg in vertlines:
+                    base[vertlines[msg]] = GLYPHS.BLANK
                 vertcol = _pick_column(vertlines, column,
                                        column[from_node], column[msg.to_node])
                 vertlines[msg] = vertcol
+                base[vertcol] = GLYPHS.VERTICAL_LINE
                 left2right = (column[from_node] < vertcol)
                 if left2right:
                     end_marker = GLYPHS.MSG_SW
@@ -134,8 +305,10 @@ class History(object):
                     _write_text(this_line, vertcol - len(msgtext) - 1, msgtext + GLYPHS.BLANK)
 
             elif action == "deliver" or action == "drop":
-                vertcol = vertlines[msg]
-                del vertlines[msg]
+                if msg not in vertlines:
+                    continue  # sent before the window, or not drawn
+                vertcol = vertlines.pop(msg)
+                base[vertcol] = GLYPHS.BLANK
 
                 left2right = (vertcol < column[msg.to_node])
                 if left2right:
@@ -154,54 +327,50 @@ class History(object):
                             column[msg.to_node], end_marker)
 
             elif action == "cut":
-                vertcol = vertlines[msg]
-                del vertlines[msg]
+                if msg not in vertlines:
+                    continue
+                vertcol = vertlines.pop(msg)
+                base[vertcol] = GLYPHS.BLANK
                 this_line[vertcol] = GLYPHS.MSG_FAIL
 
-            elif action == "start":
-                if verbose_timers:
-                    _write_center(this_line, column[msg.from_node], "%s:Start" % msg)
-                else:
+            elif action == "start" or action == "pop" or action == "cancel":
+                if msg.from_node not in column:
                     continue
-            elif action == "pop":
-                if ((ii + 1 < len(cls.history) and cls.history[ii + 1][0] == "send") or
-                    verbose_timers):
+                if action == "start" and verbose_timers:
+                    _write_center(this_line, column[msg.from_node], "%s:Start" % msg)
+                elif action == "pop" and ((next_event is not None and next_event[0] == "send") or verbose_timers):
                     _write_center(this_line, column[msg.from_node], "%s:Pop" % msg)
-                else:
-                    continue
-            elif action == "cancel":
-                if verbose_timers:
+                elif action == "cancel" and verbose_timers:
                     _write_center(this_line, column[msg.from_node], "%s:Cancel" % msg)
                 else:
                     continue
-            elif action == "fail":
-                if msg.from_node in column:
+            elif action == "fail" or action == "recover":
+                if msg.from_node not in column:
+                    continue
+                if action == "fail":
                     _write_center(this_line, column[msg.from_node], "FAIL")
                     failed_nodes.add(msg.from_node)
                 else:
-                    continue
-            elif action == "recover":
-                if msg.from_node in column:
                     _write_center(this_line, column[msg.from_node], "RECOVER")
-                    failed_nodes.remove(msg.from_node)
+                    failed_nodes.discard(msg.from_node)
+                _set_node_marker(base, column, msg.from_node, included_nodes, failed_nodes)
+            elif action == "remove" or action == "add":
+                if action == "remove":
+                    included_nodes.discard(msg.from_node)
                 else:
-                    continue
-            elif action == "remove":
-                included_nodes.remove(msg.from_node)
-                continue
-            elif action == "add":
-                included_nodes.add(msg.from_node)
+                    included_nodes.add(msg.from_node)
+                _set_node_marker(base, column, msg.from_node, included_nodes, failed_nodes)
                 continue
             elif action == "announce":
                 indent = GLYPHS.COMMENT * ((linelen - len(msg) - 4) // 2)
                 if lineno > start_line:
-                    lines.append(' %s %s %s ' % (indent, msg, indent))
+                    yield ' %s %s %s ' % (indent, msg, indent)
                 continue
 
             if lineno > start_line:
-                lines.append(''.join(this_line))
+                yield ''.join(this_line)
 
-        lines.append(_header_line(nodelist, spacing))
+        yield _header_line(nodelist, spacing)
         contents = {}
         longest_conts = 0
         for node in column.keys():
@@ -211,12 +380,96 @@ class History(object):
                 longest_conts = len(node_conts)
 
         for ii in range(longest_conts):
-            this_line = [GLYPHS.BLANK for jj in range(linelen)]
+            this_line[:] = [GLYPHS.BLANK] * linelen
             for node, nodecol in column.items():
                 if ii < len(contents[node]):
                     _write_center(this_line, nodecol, str(contents[node][ii]))
-            lines.append(''.join(this_line))
-        return '\n'.join(lines)
+            yield ''.join(this_line)
+
+
+def _append(index, value, event):
+    try:
+        index[value].append(event)
+    except KeyError:
+        index[value] = [event]
+
+
+def _index_terms(obj):
+    """Nodes, key and msg_id an event is indexed under."""
+    if not hasattr(obj, 'from_node'):
+        return (), None, None
+    nodes = [obj.from_node]
+    if obj.to_node is not obj.from_node:
+        nodes.append(obj.to_node)
+    intermediate = getattr(obj, 'intermediate_node', None)
+    if intermediate is not None:
+        nodes.append(intermediate)
+    subject = getattr(obj, 'reason', None)
+    if not hasattr(subject, 'msg_id'):
+        subject = obj
+    return nodes, getattr(subject, 'key', None), subject.msg_id
+
+
+def _origin(obj):
+    """Node that issued the request an event belongs to."""
+    subject = getattr(obj, 'reason', None)
+    if not hasattr(subject, 'msg_id'):
+        subject = obj
+    if hasattr(subject, 'response_to'):
+        return subject.to_node
+    return subject.from_node
+
+
+class DiscardSink(object):
+    """Sink that throws events away."""
+    def write(self, index, action, obj):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySink(object):
+    """Sink that keeps an (index, action, text) record of every event, without holding on to the objects."""
+    def __init__(self):
+        self.events = []
+
+    def write(self, index, action, obj):
+        self.events.append((index, action, describe(obj)))
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """Sink that appends one line per event to a file."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.outfile = open(filename, 'a')
+
+    def write(self, index, action, obj):
+        self.outfile.write("%d %s %s\n" % (index, action, describe(obj)))
+
+    def close(self):
+        self.outfile.close()
+
+
+def describe(obj):
+    """Text for a history entry: sender, receiver and message, or the announcement itself."""
+    if hasattr(obj, 'from_node'):
+        return "%s->%s %s" % (obj.from_node, obj.to_node, obj)
+    return str(obj)
+
+
+def _set_node_marker(line, column, node, included_nodes, failed_nodes):
+    if node not in column:
+        return
+    if node not in included_nodes:
+        line[column[node]] = GLYPHS.BLANK
+    elif node in failed_nodes:
+        line[column[node]] = GLYPHS.FAILED_NODE
+    else:
+        line[column[node]] = GLYPHS.OK_NODE
 
 
 def _header_line(nodelist, m):
@@ -0,0 +1,55 @@
+"""
+Link latency distributions for Emulation's virtual clock.  Each is a callable
+returning the delay for one message, in the same units as timer durations.
+"""
+import math
+import random
+
+
+class Constant(object):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def __call__(self):
+        return self.delay
+
+    def __str__(self):
+        return "Constant(%s)" % self.delay
+
+
+class Uniform(object):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def __call__(self):
+        return random.uniform(self.low, self.high)
+
+    def __str__(self):
+        return "Uniform(%s, %s)" % (self.low, self.high)
+
+
+class Exponential(object):
+    """minimum plus an exponentially distributed extra delay with the given mean."""
+    def __init__(self, mean, minimum=0.0):
+        self.mean = mean
+        self.minimum = minimum
+
+    def __call__(self):
+        return self.minimum + random.expovariate(1.0 / self.mean)
+
+    def __str__(self):
+        return "Exponential(%s, minimum=%s)" % (self.mean, self.minimum)
+
+
+class LogNormal(object):
+    """Long-tailed delays: the median is `median`, and sigma sets the spread."""
+    def __init__(self, median, sigma):
+        self.median = median
+        self.sigma = sigma
+
+    def __call__(self):
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    def __str__(self):
+        return "LogNormal(%s, %s)" % (self.median, self.sigma)
@@ -1,3 +1,6 @@
+import os
+import queue
+import atexit
 import logging
 import logging.handlers
 
@@ -5,18 +8,141 @@ if not hasattr(logging, "framework_init_done"):
     logging.framework_init_done = False
 
 LOG_FILENAME = 'dynamo.log'
-LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = os.environ.get('DYNAMO_LOG_LEVEL', logging.DEBUG)
+# Write the log file from a background thread, via a queue.  This takes file I/O off
+# the emulation loop but not formatting, and the writer thread competes for the GIL.
+LOG_ASYNC = os.environ.get('DYNAMO_LOG_ASYNC', '') not in ('', '0')
+
+_listener = None
+
+
+def _level(level):
+    """A level name such as 'INFO' (in any case), or a number given as an int or a string of digits."""
+    if isinstance(level, int):
+        return level
+    name = str(level).strip()
+    if name.isdigit():
+        return int(name)
+    number = logging.getLevelName(name.upper())
+    if not isinstance(number, int):
+        raise ValueError("Unknown log level %r" % (level,))
+    return number
 
 
 def init_logging():
     if logging.framework_init_done:
         return
+    configure_logging()
+
+
+def configure_logging(level=None, async_writes=None):
+    """(Re)build the 'dynamo' logger's handlers; arguments default to LOG_LEVEL and LOG_ASYNC."""
+    global _listener
+    if level is None:
+        level = LOG_LEVEL
+    if async_writes is None:
+        async_writes = LOG_ASYNC
     logger = logging.getLogger('dynamo')
-    logger.setLevel(LOG_LEVEL)
+    stop_logging()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    logger.setLevel(_level(level))
     formatstring = ("%(asctime)s|%(levelname)-7s|"
                     "%(filename)15s|%(lineno)3s|%(message)s")
     formatter = logging.Formatter(formatstring)
     file_handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=1000000, backupCount=5)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    if async_writes:
+        log_queue = queue.Queue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, file_handler)
+        _listener.start()
+    else:
+        logger.addHandler(file_handler)
     logging.framework_init_done = True
+
+
+def set_level(level):
+    logging.getLogger('dynamo').setLevel(_level(level))
+
+
+def stop_logging():
+    """Write out anything still queued for the background writer and stop it."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+import shutil
+import tempfile
+import unittest
+
+
+class LogConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        global LOG_FILENAME
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = LOG_FILENAME
+        LOG_FILENAME = os.path.join(self.tmpdir, "test.log")
+        self.logger = logging.getLogger('dynamo')
+
+    def tearDown(self):
+        global LOG_FILENAME
+        LOG_FILENAME = self.saved
+        configure_logging()
+        shutil.rmtree(self.tmpdir)
+
+    def lines(self):
+        with open(LOG_FILENAME) as logfile:
+            return [line.rstrip().split('|')[-1] for line in logfile]
+
+    def testLevels(self):
+        self.assertEqual(_level('debug'), logging.DEBUG)
+        self.assertEqual(_level(' Warning '), logging.WARNING)
+        self.assertEqual(_level('15'), 15)
+        self.assertEqual(_level(logging.ERROR), logging.ERROR)
+        self.assertRaises(ValueError, _level, 'loud')
+
+    def testSync(self):
+        configure_logging('info', async_writes=False)
+        self.assertTrue(_listener is None)
+        self.logger.debug("hidden")
+        self.logger.info("shown")
+        set_level('debug')
+        self.logger.debug("detail")
+        for handler in self.logger.handlers:
+            handler.flush()
+        self.assertEqual(self.lines(), ["shown", "detail"])
+
+    def testAsync(self):
+        configure_logging('warning', async_writes=True)
+        listener = _listener
+        self.assertTrue(listener is not None and listener._thread.is_alive())
+        self.logger.info("hidden")
+        for ii in range(100):
+            self.logger.warning("queued %d", ii)
+        thread = listener._thread
+        stop_logging()
+        # Stopping drains the queue before the writer thread exits.
+        self.assertTrue(_listener is None)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.lines(), ["queued %d" % ii for ii in range(100)])
+        # Reconfiguring replaces a running listener rather than leaving it behind.
+        configure_logging('info', async_writes=True)
+        thread = _listener._thread
+        configure_logging('info', async_writes=False)
+        self.assertTrue(_listener is None)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
+import bisect
 import hashlib
-from collections import MutableMapping
+import binascii
+from collections.abc import MutableMapping
 
 
 def md5string(key):
@@ -11,14 +13,68 @@ def md5int(key):
     return int(hash_str.hexdigest(), 16)
 
 
+# Leaf digest modes.  STR_DIGEST hashes str() of the whole leaf dict, which costs O(leaf size) per
+# write and depends on insertion order.  MULTISET_DIGEST keeps a running sum (mod 2**128) of one hash
+# per (key, value) entry, updated in O(1) per write and independent of insertion order, so replicas
+# holding the same contents always agree.
+STR_DIGEST = 'str'
+MULTISET_DIGEST = 'multiset'
+_MULTISET_MODULUS = 2 ** 128
+
+
+def _canonical(value):
+    if isinstance(value, tuple):
+        return "(%s)" % ",".join([_canonical(item) for item in value])
+    return str(value)
+
+
+def entry_hash(key, value):
+    """Hash of a single (key, value) entry for MULTISET_DIGEST leaves."""
+    return md5int("%s=%s" % (key, _canonical(value)))
+
+
+def multiset_sum(data):
+    return sum(entry_hash(key, value) for key, value in data.items()) % _MULTISET_MODULUS
+
+
+def multiset_update(acc, data, key, value=None, remove=False):
+    """Accumulator after data[key] is set to value (or deleted if remove); data is not yet modified."""
+    if key in data:
+        acc = acc - entry_hash(key, data[key])
+    if not remove:
+        acc = acc + entry_hash(key, value)
+    return acc % _MULTISET_MODULUS
+
+
+def multiset_digest(acc):
+    return hashlib.md5(binascii.unhexlify("%032x" % acc))
+
+
 class MerkleTreeNode(object):
+    """
+    Node in a Merkle tree.  Hashes are computed lazily: a write only marks the affected leaf and its
+    ancestors as dirty, and the hash is recalculated when value is next read.
+    """
     def __init__(self):
-        self.value = None
+        self._value = None
         self.parent = None
 
-    def recalc_node_val(self):
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self.calc_node_val()
+        return self._value
+
+    def calc_node_val(self):
         raise NotImplementedError
 
+    def recalc_node_val(self):
+        # Stop at the first node that is already dirty; its ancestors are dirty too.
+        node = self
+        while node is not None and node._value is not None:
+            node._value = None
+            node = node.parent
+
 
 class MerkleBranchNode(MerkleTreeNode):
 
@@ -28,12 +84,9 @@ class MerkleBranchNode(MerkleTreeNode):
         left.parent = self
         self.right = right
         right.parent = self
-        self.recalc_node_val()
 
-    def recalc_node_val(self):
-        self.value = hashlib.md5(self.left.value.digest() + self.right.value.digest())
-        if self.parent is not None:
-            self.parent.recalc_node_val()
+    def calc_node_val(self):
+        return hashlib.md5(self.left.value.digest() + self.right.value.digest())
 
     def __str__(self):
         return self.value.hexdigest()[:6]
@@ -41,16 +94,17 @@ class MerkleBranchNode(MerkleTreeNode):
 
 class MerkleLeaf(MerkleTreeNode):
 
-    def __init__(self, min_key, max_key, initdata=None):
+    def __init__(self, min_key, max_key, initdata=None, leaf_digest=STR_DIGEST):
         super(MerkleLeaf, self).__init__()
         self.min_key = min_key
         self.max_key = max_key
+        self.leaf_digest = leaf_digest
 
         if initdata is None:
             self._data = {}
         else:
             self._data = dict([(key, value) for key, value in initdata.items() if self._inrange(key)])
-        self.value = md5string(self._data)
+        self._acc = multiset_sum(self._data) if leaf_digest == MULTISET_DIGEST else 0
 
     def __str__(self):
         return "[%s,%s)=>%s" % (self.min_key, self.max_key, self.value.hexdigest()[:6])
@@ -59,13 +113,26 @@ class MerkleLeaf(MerkleTreeNode):
         hashval = md5int(key)
         return hashval >= self.min_key and hashval < self.max_key
 
-    def recalc_node_val(self):
-        self.value = md5string(self._data)
-        self.parent.recalc_node_val()
+    def set(self, key, value):
+        if self.leaf_digest == MULTISET_DIGEST:
+            self._acc = multiset_update(self._acc, self._data, key, value)
+        self._data[key] = value
+        self.recalc_node_val()
+
+    def delete(self, key):
+        if self.leaf_digest == MULTISET_DIGEST and key in self._data:
+            self._acc = multiset_update(self._acc, self._data, key, remove=True)
+        del self._data[key]
+        self.recalc_node_val()
+
+    def calc_node_val(self):
+        if self.leaf_digest == MULTISET_DIGEST:
+            return multiset_digest(self._acc)
+        return md5string(self._data)
 
 
 class MerkleTree(MutableMapping):
-    def __init__(self, depth=12, min_key=0, max_key=(2 ** 128 - 1), initdata=None):
+    def __init__(self, depth=12, min_key=0, max_key=(2 ** 128 - 1), initdata=None, leaf_digest=STR_DIGEST):
         self.min_key = min_key
         self.max_key = max_key
         self.depth = depth
@@ -76,7 +143,7 @@ class MerkleTree(MutableMapping):
         self.nodes.append([MerkleLeaf(self.min_key + ii * self.leaf_size,
                                       min(self.min_key + (ii + 1) * self.leaf_size,
                                           max_key),
-                                      initdata)
+                                      initdata, leaf_digest)
                            for ii in range(self.num_leaves)])
         level = 1
         while level <= self.depth:
@@ -90,17 +157,15 @@ class MerkleTree(MutableMapping):
         hashval = md5int(key)
         if hashval < self.min_key or hashval >= self.max_key:
             raise KeyError("Key %s hashes to value outside range for this tree" % key)
-        return hashval // self.leaf_size
+        return (hashval - self.min_key) // self.leaf_size
 
     def __setitem__(self, key, value):
         leafidx = self._lookup(key)
-        self.nodes[0][leafidx]._data[key] = value
-        self.nodes[0][leafidx].recalc_node_val()
+        self.nodes[0][leafidx].set(key, value)
 
     def __delitem__(self, key):
         leafidx = self._lookup(key)
-        del self.nodes[0][leafidx]._data[key]
-        self.nodes[0][leafidx].recalc_node_val()
+        self.nodes[0][leafidx].delete(key)
 
     def __getitem__(self, key):
         leafidx = self._lookup(key)
@@ -127,7 +192,7 @@ class MerkleTree(MutableMapping):
                 yield key, value
 
     def __len__(self):
-        return self.num_leaves
+        return sum(len(leaf._data) for leaf in self.nodes[0])
 
     def __str__(self):
         result = ""
@@ -139,6 +204,240 @@ class MerkleTree(MutableMapping):
         return result
 
 
+_EMPTY_DIGESTS = {STR_DIGEST: [md5string({}).digest()],
+                  MULTISET_DIGEST: [multiset_digest(0).digest()]}
+
+
+def empty_digest(height, leaf_digest=STR_DIGEST):
+    """Digest of an empty subtree of the given height (0 for a leaf), as computed by MerkleTree."""
+    digests = _EMPTY_DIGESTS[leaf_digest]
+    while len(digests) <= height:
+        digests.append(hashlib.md5(digests[-1] + digests[-1]).digest())
+    return digests[height]
+
+
+class CompactMerkleTree(MutableMapping):
+    """
+    Merkle tree held in an implicit heap layout rather than as linked node objects.
+
+    Position 1 is the root and position p has children 2p and 2p+1, so the leaves occupy positions
+    num_leaves..2*num_leaves-1.  Digests live in one flat bytearray of 16-byte slots, and only the
+    non-empty leaf buckets are stored.  Nothing is allocated until the first write: until then every
+    subtree reports the shared empty digest for its height.  Digests match those of MerkleTree built
+    over the same contents.
+    """
+    DIGEST_SIZE = 16
+
+    def __init__(self, depth=12, min_key=0, max_key=(2 ** 128 - 1), initdata=None, leaf_digest=STR_DIGEST):
+        self.min_key = min_key
+        self.max_key = max_key
+        self.depth = depth
+        self.num_leaves = 2 ** self.depth
+        self.leaf_size = ((self.max_key - self.min_key) + self.num_leaves - 1) // self.num_leaves
+        self.leaf_digest = leaf_digest
+        self._buckets = {}
+        self._leaf_acc = {}
+        self._digests = None
+        self._dirty = None
+        if initdata is not None:
+            for key, value in initdata.items():
+                if self._inrange(md5int(key)):
+                    self[key] = value
+
+    def _inrange(self, hashval):
+        return hashval >= self.min_key and hashval < self.max_key
+
+    def _lookup(self, key):
+        hashval = md5int(key)
+        if not self._inrange(hashval):
+            raise KeyError("Key %s hashes to value outside range for this tree" % key)
+        return (hashval - self.min_key) // self.leaf_size
+
+    def _allocate(self):
+        slots = [b"\0" * self.DIGEST_SIZE]
+        for level in range(self.depth + 1):
+            slots.append(empty_digest(self.depth - level, self.leaf_digest) * (2 ** level))
+        self._digests = bytearray(b"".join(slots))
+        self._dirty = bytearray(2 * self.num_leaves)
+
+    def _mark_dirty(self, leafidx):
+        if self._digests is None:
+            self._allocate()
+        pos = self.num_leaves + leafidx
+        while pos >= 1 and not self._dirty[pos]:
+            self._dirty[pos] = 1
+            pos = pos >> 1
+
+    def height(self, pos):
+        """Height of the subtree rooted at heap position pos; leaves have height 0."""
+        return self.depth - (pos.bit_length() - 1)
+
+    def digest(self, pos=1):
+        """Digest (as bytes) of the subtree rooted at heap position pos, recomputing it if stale."""
+        if self._digests is None:
+            return empty_digest(self.height(pos), self.leaf_digest)
+        if self._dirty[pos]:
+            if pos >= self.num_leaves:
+                value = self._leaf_value(pos - self.num_leaves)
+            else:
+                value = hashlib.md5(self.digest(2 * pos) + self.digest(2 * pos + 1)).digest()
+            offset = pos * self.DIGEST_SIZE
+            self._digests[offset:offset + self.DIGEST_SIZE] = value
+            self._dirty[pos] = 0
+            return value
+        offset = pos * self.DIGEST_SIZE
+        return bytes(self._digests[offset:offset + self.DIGEST_SIZE])
+
+    def _leaf_value(self, leafidx):
+        bucket = self._buckets.get(leafidx)
+        if not bucket:
+            return empty_digest(0, self.leaf_digest)
+        if self.leaf_digest == MULTISET_DIGEST:
+            return multiset_digest(self._leaf_acc[leafidx]).digest()
+        return md5string(bucket).digest()
+
+    def root_digest(self):
+        return self.digest(1)
+
+    def leaf_items(self, pos):
+        """(key, value) pairs held in the leaf at heap position pos."""
+        return list(self._buckets.get(pos - self.num_leaves, {}).items())
+
+    def __setitem__(self, key, value):
+        leafidx = self._lookup(key)
+        bucket = self._buckets.get(leafidx)
+        if bucket is None:
+            bucket = self._buckets[leafidx] = {}
+        if self.leaf_digest == MULTISET_DIGEST:
+            self._leaf_acc[leafidx] = multiset_update(self._leaf_acc.get(leafidx, 0), bucket, key, value)
+        bucket[key] = value
+        self._mark_dirty(leafidx)
+
+    def __delitem__(self, key):
+        leafidx = self._lookup(key)
+        bucket = self._buckets.get(leafidx)
+        if bucket is None or key not in bucket:
+            raise KeyError(key)
+        if self.leaf_digest == MULTISET_DIGEST:
+            self._leaf_acc[leafidx] = multiset_update(self._leaf_acc[leafidx], bucket, key, remove=True)
+        del bucket[key]
+        if not bucket:
+            del self._buckets[leafidx]
+            self._leaf_acc.pop(leafidx, None)
+        self._mark_dirty(leafidx)
+
+    def __getitem__(self, key):
+        bucket = self._buckets.get(self._lookup(key))
+        if bucket is None:
+            raise KeyError(key)
+        return bucket[key]
+
+    def __contains__(self, key):
+        bucket = self._buckets.get(self._lookup(key))
+        return bucket is not None and key in bucket
+
+    def __iter__(self):
+        for leafidx in sorted(self._buckets):
+            for key in self._buckets[leafidx]:
+                yield key
+
+    def iteritems(self):
+        for leafidx in sorted(self._buckets):
+            for key, value in self._buckets[leafidx].items():
+                yield key, value
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def __str__(self):
+        result = ""
+        for level in range(self.depth + 1):
+            result = result + "[%d] " % (self.depth - level)
+            for pos in range(2 ** level, 2 ** (level + 1)):
+                result = result + binascii.hexlify(self.digest(pos))[:6].decode("ascii") + ' '
+            result = result + '\n'
+        return result
+
+
+class PartitionedMerkleStore(MutableMapping):
+    """
+    Mapping split across one CompactMerkleTree per [min_key, max_key) range of the 128-bit hash
+    space, so that individual ranges can be compared or shipped on their own.  The ranges are set by
+    repartition(); trees are created on first write to a range, or up front for ranges listed as kept.
+    """
+    def __init__(self, depth=8, leaf_digest=STR_DIGEST):
+        self.depth = depth
+        self.leaf_digest = leaf_digest
+        self.bounds = [0, 2 ** 128]
+        self.trees = {}
+
+    def repartition(self, bounds, keep=()):
+        """
+        Switch to the ranges delimited by the sorted list bounds.  Trees whose range survives are kept
+        as they are; the contents of the others are re-inserted into the new ranges.  Every range in
+        keep gets a tree, and empty trees for other ranges are dropped.
+        """
+        ranges = set(zip(bounds[:-1], bounds[1:]))
+        moved = []
+        for key_range in list(self.trees):
+            if key_range not in ranges:
+                moved.extend(self.trees.pop(key_range).items())
+        self.bounds = list(bounds)
+        keep = set(keep)
+        for key_range in keep:
+            self.tree(key_range, create=True)
+        for key_range in list(self.trees):
+            if key_range not in keep and not self.trees[key_range]:
+                del self.trees[key_range]
+        for key, value in moved:
+            self[key] = value
+
+    def key_range(self, key):
+        ii = bisect.bisect(self.bounds, md5int(key)) - 1
+        return (self.bounds[ii], self.bounds[ii + 1])
+
+    def tree(self, key_range, create=False):
+        """The tree holding key_range, or None if there is none and create is False."""
+        tree = self.trees.get(key_range)
+        if tree is None and create:
+            tree = self.trees[key_range] = CompactMerkleTree(self.depth, key_range[0], key_range[1],
+                                                             leaf_digest=self.leaf_digest)
+        return tree
+
+    def tree_for(self, key):
+        return self.tree(self.key_range(key), create=True)
+
+    def root_digests(self):
+        return dict([(key_range, tree.root_digest()) for key_range, tree in self.trees.items()])
+
+    def __setitem__(self, key, value):
+        self.tree_for(key)[key] = value
+
+    def __delitem__(self, key):
+        tree = self.tree(self.key_range(key))
+        if tree is None:
+            raise KeyError(key)
+        del tree[key]
+
+    def __getitem__(self, key):
+        tree = self.tree(self.key_range(key))
+        if tree is None:
+            raise KeyError(key)
+        return tree[key]
+
+    def __contains__(self, key):
+        tree = self.tree(self.key_range(key))
+        return tree is not None and key in tree
+
+    def __iter__(self):
+        for key_range in sorted(self.trees):
+            for key in self.trees[key_range]:
+                yield key
+
+    def __len__(self):
+        return sum(len(tree) for tree in self.trees.values())
+
+
 import sys
 import copy
 import random
@@ -147,12 +446,18 @@ import unittest
 from utils import random_3str
 
 
+def digest_of(tree):
+    if isinstance(tree, CompactMerkleTree):
+        return tree.root_digest()
+    return tree.root.value.digest()
+
+
 class MerkleTestCase(unittest.TestCase):
 
     def setUp(self):
         self.keystore = dict((random_3str(), random.randint(0, 99)) for _ in range(50))
-        self.keya = int(hashlib.md5('A').hexdigest(), 16)
-        self.keyb = int(hashlib.md5('B').hexdigest(), 16)
+        self.keya = int(hashlib.md5('A'.encode("utf-8")).hexdigest(), 16)
+        self.keyb = int(hashlib.md5('B'.encode("utf-8")).hexdigest(), 16)
         if self.keya < self.keyb:
             self.min_key = self.keya
             self.max_key = self.keyb
@@ -227,6 +532,99 @@ class MerkleTestCase(unittest.TestCase):
         self.assertFalse('b' in d2)
         self.assertFalse('c' in d2)
 
+    def testLazyHash(self):
+        d1 = MerkleTree(depth=4)
+        d2 = MerkleTree(depth=4)
+        for key in self.keystore:
+            d1[key] = self.keystore[key]
+        self.assertTrue(d1.root._value is None)
+        for key in self.keystore:
+            d2[key] = self.keystore[key]
+            d2.root.value
+        self.assertEqual(d1.root.value.hexdigest(), d2.root.value.hexdigest())
+        leaf = d1.nodes[0][d1._lookup('A')]
+        leaf.value
+        d1['A'] = 'xyzzy'
+        self.assertTrue(leaf._value is None)
+        self.assertTrue(d1.root._value is None)
+        d2['A'] = 'xyzzy'
+        self.assertEqual(d1.root.value.hexdigest(), d2.root.value.hexdigest())
+
+    def testCompact(self):
+        x0 = MerkleTree(4, initdata=self.keystore)
+        x1 = CompactMerkleTree(4, initdata=self.keystore)
+        self.assertEqual(x0.root.value.digest(), x1.root_digest())
+        self.assertEqual(CompactMerkleTree(4).root_digest(), MerkleTree(4).root.value.digest())
+        self.assertTrue(CompactMerkleTree()._digests is None)
+        for pos, node in enumerate(x0.nodes[1]):
+            self.assertEqual(node.value.digest(), x1.digest(2 ** 3 + pos))
+        x0['A'] = 'xyzzy'
+        x1['A'] = 'xyzzy'
+        self.assertEqual(x0.root.value.digest(), x1.root_digest())
+        del x1['A']
+        del x0['A']
+        self.assertEqual(x0.root.value.digest(), x1.root_digest())
+        self.assertEqual(dict(x0.items()), dict(x1.items()))
+        self.assertEqual(len(x1), len(self.keystore))
+        self.assertRaises(KeyError, x1.__getitem__, *('A',))
+        self.assertRaises(KeyError, x1.__delitem__, *('A',))
+
+    def testCompactRange(self):
+        x = CompactMerkleTree(3, self.min_key, self.max_key, self.keystore)
+        for key in x:
+            self.assertTrue(self.min_key <= md5int(key) < self.max_key)
+            self.assertTrue(0 <= x._lookup(key) < x.num_leaves)
+        self.assertEqual(x.root_digest(), MerkleTree(3, self.min_key, self.max_key, self.keystore).root.value.digest())
+
+    def testMultisetDigest(self):
+        items = list(self.keystore.items())
+        reordered = dict(reversed(items))
+        for tree_class in (MerkleTree, CompactMerkleTree):
+            x0 = tree_class(4, initdata=self.keystore, leaf_digest=MULTISET_DIGEST)
+            x1 = tree_class(4, initdata=reordered, leaf_digest=MULTISET_DIGEST)
+            x2 = tree_class(4, leaf_digest=MULTISET_DIGEST)
+            self.assertEqual(digest_of(x0), digest_of(x1))
+            self.assertNotEqual(digest_of(x0), digest_of(x2))
+            for key, value in reversed(items):
+                x2[key] = value
+            x2['A'] = 'xyzzy'
+            self.assertNotEqual(digest_of(x0), digest_of(x2))
+            x2['A'] = 'plugh'
+            del x2['A']
+            if 'A' in self.keystore:
+                x2['A'] = self.keystore['A']
+            self.assertEqual(digest_of(x0), digest_of(x2))
+            for key in self.keystore:
+                del x2[key]
+            self.assertEqual(digest_of(x2), digest_of(tree_class(4, leaf_digest=MULTISET_DIGEST)))
+        self.assertEqual(MerkleTree(4, initdata=self.keystore, leaf_digest=MULTISET_DIGEST).root.value.digest(),
+                         CompactMerkleTree(4, initdata=self.keystore, leaf_digest=MULTISET_DIGEST).root_digest())
+
+    def testPartitioned(self):
+        store = PartitionedMerkleStore(depth=3, leaf_digest=MULTISET_DIGEST)
+        store.update(self.keystore)
+        self.assertEqual(dict(store.items()), self.keystore)
+        whole = store.tree((0, 2 ** 128))
+        bounds = [0, self.min_key, self.max_key, 2 ** 128]
+        store.repartition(bounds, keep=[(self.min_key, self.max_key)])
+        self.assertEqual(dict(store.items()), self.keystore)
+        self.assertEqual(len(store), len(self.keystore))
+        middle = store.tree((self.min_key, self.max_key))
+        self.assertEqual(set(middle.keys()),
+                         set([key for key in self.keystore if self.min_key <= md5int(key) < self.max_key]))
+        self.assertEqual(middle.root_digest(),
+                         CompactMerkleTree(3, self.min_key, self.max_key, self.keystore, MULTISET_DIGEST).root_digest())
+        store.repartition(bounds)
+        self.assertTrue(store.tree((self.min_key, self.max_key)) is middle)
+        self.assertTrue(store.tree((0, 2 ** 128)) is None)
+        for key in self.keystore:
+            del store[key]
+        store.repartition(bounds)
+        self.assertEqual(store.trees, {})
+        store.repartition([0, 2 ** 128], keep=[(0, 2 ** 128)])
+        self.assertEqual(store.root_digests(), {(0, 2 ** 128): empty_digest(3, MULTISET_DIGEST)})
+        self.assertFalse(whole is store.tree((0, 2 ** 128)))
+
     def test002(self):
         d1 = MerkleTree(initdata={'a': 1, 'b': 2, 'c': 3})
         d2 = MerkleTree(initdata={'a': 1, 'b': 2, 'c': 3})
@@ -1,25 +1,63 @@
+_slot_names = {}
+
+
+def _all_slots(kls):
+    """Names of every slot declared along kls's MRO, computed once per class."""
+    try:
+        return _slot_names[kls]
+    except KeyError:
+        names = []
+        for base in reversed(kls.__mro__):
+            for name in base.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        _slot_names[kls] = tuple(names)
+        return _slot_names[kls]
+
+
 class BaseMessage(object):
+    # History keeps every message, so messages use slots rather than a per-instance __dict__.
+    # intermediate_node/original_msg are only set on forwarded copies (see Emulation.forward_message).
+    __slots__ = ('from_node', 'to_node', 'msg_id', 'intermediate_node', 'original_msg')
+
     def __init__(self, from_node, to_node, msg_id=None):
         self.from_node = from_node
         self.to_node = to_node
         self.msg_id = msg_id
 
+    def clone(self):
+        """Shallow copy of this message; unset slots stay unset."""
+        kls = self.__class__
+        result = kls.__new__(kls)
+        for name in _all_slots(kls):
+            try:
+                setattr(result, name, getattr(self, name))
+            except AttributeError:
+                pass
+        return result
+
     def __str__(self):
         return self.__class__.__name__
 
 
 class ResponseMessage(BaseMessage):
+    __slots__ = ('response_to',)
+
     def __init__(self, req):
         super(ResponseMessage, self).__init__(req.to_node, req.from_node, msg_id=req.msg_id)
         self.response_to = req
 
 
 class InternalNodeMessage(BaseMessage):
+    __slots__ = ()
+
     def __init__(self, node):
         super(InternalNodeMessage, self).__init__(node, node)
 
 
 class TimerMessage(BaseMessage):
+    __slots__ = ('reason', 'callback')
+
     def __init__(self, node, reason, callback=None):
         super(TimerMessage, self).__init__(node, node)
         self.reason = reason
@@ -27,6 +65,8 @@ class TimerMessage(BaseMessage):
 
 
 class DynamoRequestMessage(BaseMessage):
+    __slots__ = ('key',)
+
     def __init__(self, from_node, to_node, key, msg_id=None):
         super(DynamoRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
         self.key = key
@@ -36,6 +76,8 @@ class DynamoRequestMessage(BaseMessage):
 
 
 class DynamoResponseMessage(ResponseMessage):
+    __slots__ = ('key', 'value', 'metadata')
+
     def __init__(self, req, value, metadata):
         super(DynamoResponseMessage, self).__init__(req)
         self.key = req.key
@@ -47,6 +89,8 @@ class DynamoResponseMessage(ResponseMessage):
 
 
 class ClientPutRequestMessage(DynamoRequestMessage):
+    __slots__ = ('value', 'metadata')
+
     def __init__(self, from_node, to_node, key, value, metadata, msg_id=None):
         super(ClientPutRequestMessage, self).__init__(from_node, to_node, key, msg_id=msg_id)
         self.value = value
@@ -57,6 +101,8 @@ class ClientPutRequestMessage(DynamoRequestMessage):
 
 
 class ClientPutResponseMessage(DynamoResponseMessage):
+    __slots__ = ()
+
     def __init__(self, req, metadata=None):
         if metadata is None:
             metadata = req.metadata
@@ -64,6 +110,8 @@ class ClientPutResponseMessage(DynamoResponseMessage):
 
 
 class PutRequestMessage(DynamoRequestMessage):
+    __slots__ = ('value', 'metadata', 'handoff')
+
     def __init__(self, from_node, to_node, key, value, metadata, msg_id=None, handoff=None):
         super(PutRequestMessage, self).__init__(from_node, to_node, key, msg_id)
         self.value = value
@@ -81,37 +129,237 @@ class PutRequestMessage(DynamoRequestMessage):
 
 
 class PutResponseMessage(DynamoResponseMessage):
+    __slots__ = ()
+
     def __init__(self, req):
         super(PutResponseMessage, self).__init__(req, req.value, req.metadata)
 
 
 class ClientGetRequestMessage(DynamoRequestMessage):
-    pass
+    __slots__ = ()
 
 
 class ClientGetResponseMessage(DynamoResponseMessage):
-    pass
+    __slots__ = ()
 
 
 class GetRequestMessage(DynamoRequestMessage):
-    pass
+    __slots__ = ()
 
 
 class GetResponseMessage(DynamoResponseMessage):
-    pass
+    __slots__ = ()
 
 
 class PingRequestMessage(BaseMessage):
-    pass
+    __slots__ = ()
 
 
 class PingResponseMessage(ResponseMessage):
-    pass
+    __slots__ = ()
+
+
+class ClientMultiPutRequestMessage(BaseMessage):
+    """Client put of several keys at once: entries are (key, value, metadata)."""
+    __slots__ = ('entries',)
+
+    def __init__(self, from_node, to_node, entries, msg_id=None):
+        super(ClientMultiPutRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
+        self.entries = entries
+
+    def __str__(self):
+        return "ClientMultiPut(%s)" % _show_keys([key for key, _, _ in self.entries])
+
+
+class ClientMultiPutResponseMessage(ResponseMessage):
+    """results maps each key to the metadata it was written with, or to None if no replica could be reached."""
+    __slots__ = ('results',)
+
+    def __init__(self, req, results):
+        super(ClientMultiPutResponseMessage, self).__init__(req)
+        self.results = results
+
+    def __str__(self):
+        return "ClientMultiPutRsp(%s)" % _show_keys(self.results)
+
+
+class ClientMultiGetRequestMessage(BaseMessage):
+    __slots__ = ('keys',)
+
+    def __init__(self, from_node, to_node, keys, msg_id=None):
+        super(ClientMultiGetRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
+        self.keys = keys
+
+    def __str__(self):
+        return "ClientMultiGet(%s)" % _show_keys(self.keys)
+
+
+class ClientMultiGetResponseMessage(ResponseMessage):
+    """
+    results maps each key to (values, metadata), one of each per concurrent version, as in
+    ClientGetResponseMessage, or to None if no replica could be reached.
+    """
+    __slots__ = ('results',)
+
+    def __init__(self, req, results):
+        super(ClientMultiGetResponseMessage, self).__init__(req)
+        self.results = results
+
+    def __str__(self):
+        return "ClientMultiGetRsp(%s)" % _show_keys(self.results)
+
+
+class MultiPutRequestMessage(BaseMessage):
+    """Coordinator's put of several keys to one replica: entries are (key, value, metadata, handoff)."""
+    __slots__ = ('entries',)
+
+    def __init__(self, from_node, to_node, entries, msg_id=None):
+        super(MultiPutRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
+        self.entries = entries
+
+    def __str__(self):
+        return "MultiPutReq(%s)" % _show_keys([entry[0] for entry in self.entries])
+
+
+class MultiPutResponseMessage(ResponseMessage):
+    __slots__ = ()
+
+    def __str__(self):
+        return "MultiPutRsp(%s)" % _show_keys([entry[0] for entry in self.response_to.entries])
+
+
+class MultiGetRequestMessage(BaseMessage):
+    __slots__ = ('keys',)
+
+    def __init__(self, from_node, to_node, keys, msg_id=None):
+        super(MultiGetRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
+        self.keys = keys
+
+    def __str__(self):
+        return "MultiGetReq(%s)" % _show_keys(self.keys)
+
+
+class MultiGetResponseMessage(ResponseMessage):
+    """entries are (key, value, metadata) as held by the replica."""
+    __slots__ = ('entries',)
+
+    def __init__(self, req, entries):
+        super(MultiGetResponseMessage, self).__init__(req)
+        self.entries = entries
+
+    def __str__(self):
+        return "MultiGetRsp(%s)" % _show_keys([key for key, _, _ in self.entries])
+
+
+class ReadRepairMessage(DynamoRequestMessage):
+    """Newest version of key seen by a get, for a replica that returned an older one.  Not answered."""
+    __slots__ = ('value', 'metadata')
+
+    def __init__(self, from_node, to_node, key, value, metadata):
+        super(ReadRepairMessage, self).__init__(from_node, to_node, key)
+        self.value = value
+        self.metadata = metadata
+
+    def __str__(self):
+        return "ReadRepair(%s=%s)" % (self.key, _show_value(self.value, self.metadata))
+
+
+class HandoffRequestMessage(BaseMessage):
+    """A batch of hinted-handoff entries, (key, value, metadata), for a node that has recovered."""
+    __slots__ = ('entries',)
+
+    def __init__(self, from_node, to_node, entries, msg_id=None):
+        super(HandoffRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
+        self.entries = entries
+
+    def __str__(self):
+        if len(self.entries) > 3:
+            return "HandoffReq(%d keys)" % len(self.entries)
+        return "HandoffReq(%s)" % ", ".join(["%s=%s" % (key, _show_value(value, metadata))
+                                             for key, value, metadata in self.entries])
+
+
+class HandoffResponseMessage(ResponseMessage):
+    __slots__ = ()
+
+    def __str__(self):
+        return "HandoffRsp(%d keys)" % len(self.response_to.entries)
+
+
+class _SyncContent(object):
+    """
+    Payload shared by the anti-entropy messages:
+      digests   - (key range, position, digest) for positions of the local store's range trees
+      summaries - (key range, leaf position) -> {key: entry hash} for leaves that differed
+      entries   - (key, value, metadata) for keys the receiver should reconcile
+      wanted    - keys the sender wants the receiver's version of
+    The slots themselves live on the concrete message classes, as two slotted
+    bases cannot be combined.
+    """
+    __slots__ = ()
+
+    def _set_content(self, digests, summaries, entries, wanted):
+        self.digests = digests or []
+        self.summaries = summaries or {}
+        self.entries = entries or []
+        self.wanted = wanted or []
+
+    def payload_size(self):
+        """Approximate number of bytes this message would occupy on the wire."""
+        size = 0
+        for _, _, digest in self.digests:
+            size = size + 4 + 4 + len(digest)
+        for leaf_summary in self.summaries.values():
+            size = size + 4 + 4
+            for key in leaf_summary:
+                size = size + len(str(key)) + 16
+        for key, value, metadata in self.entries:
+            size = size + len(str(key)) + len(str(value)) + len(str(metadata))
+        for key in self.wanted:
+            size = size + len(str(key))
+        return size
+
+    def __str__(self):
+        parts = []
+        if self.digests:
+            parts.append("%d digests" % len(self.digests))
+        if self.summaries:
+            parts.append("%d leaves" % len(self.summaries))
+        if self.entries:
+            parts.append("%d keys" % len(self.entries))
+        if self.wanted:
+            parts.append("%d wanted" % len(self.wanted))
+        return "%s(%s)" % (self.__class__.__name__[:-len("Message")], ", ".join(parts))
+
+
+class SyncRequestMessage(_SyncContent, BaseMessage):
+    """Opens an anti-entropy exchange, normally with the root digests of the ranges both sides own."""
+    __slots__ = ('digests', 'summaries', 'entries', 'wanted')
+
+    def __init__(self, from_node, to_node, digests, msg_id=None):
+        super(SyncRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
+        self._set_content(digests, None, None, None)
+
+
+class SyncResponseMessage(_SyncContent, ResponseMessage):
+    """Next step of an anti-entropy exchange, answering the previous step."""
+    __slots__ = ('digests', 'summaries', 'entries', 'wanted')
+
+    def __init__(self, req, digests=None, summaries=None, entries=None, wanted=None):
+        super(SyncResponseMessage, self).__init__(req)
+        self._set_content(digests, summaries, entries, wanted)
 
 
 _show_metadata = False
 
 
+def _show_keys(keys):
+    keys = list(keys)
+    if len(keys) > 3:
+        return "%d keys" % len(keys)
+    return ",".join([str(key) for key in keys])
+
+
 def _show_value(value, metadata):
     if _show_metadata:
         try:
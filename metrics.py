@@ -0,0 +1,112 @@
+"""
+Coordinator-side request metrics for dynamo.Node: how long each client put or
+get waits for its W (or R) replica responses, how long until every replica it
+asked has answered, how many retries it took, and how many responses arrive
+after the quorum was reached.  Times come from Emulation.now(), so they are in
+virtual time, or in messages processed when running with FIFO delivery.
+"""
+from collections import OrderedDict
+
+from emulation import Emulation
+from utils import Stats
+
+KINDS = ('put', 'get')
+
+
+class RequestRecord(object):
+    __slots__ = ('kind', 'start', 'quorum', 'sent', 'received', 'retries')
+
+    def __init__(self, kind, start):
+        self.kind = kind
+        self.start = start
+        self.quorum = None
+        self.sent = 0
+        self.received = 0
+        self.retries = 0
+
+
+class RequestMetrics(object):
+    # Requests past quorum that are still waiting on replica responses.  Beyond
+    # this many the oldest is dropped, as its replicas have probably failed.
+    completing_limit = 1024
+
+    def __init__(self):
+        self.quorum_wait = dict([(kind, Stats(streaming=True)) for kind in KINDS])
+        self.completion = dict([(kind, Stats(streaming=True)) for kind in KINDS])
+        self.retries = dict([(kind, Stats(streaming=True)) for kind in KINDS])
+        self.late_responses = dict([(kind, 0) for kind in KINDS])
+        self.read_repairs = 0  # Repairs sent to replicas found holding an older version after a get
+        self.read_repair_conflicts = 0  # Gets whose replicas held concurrent versions, so were not repaired
+        self.pending = {}  # seqno -> RequestRecord, until quorum
+        self.completing = OrderedDict()  # seqno -> RequestRecord, from quorum until all responses are in
+
+    def start(self, kind, seqno):
+        self.pending[seqno] = RequestRecord(kind, Emulation.now())
+
+    def sent(self, seqno, retry=False):
+        record = self.pending.get(seqno)
+        if record is not None:
+            record.sent = record.sent + 1
+            if retry:
+                record.retries = record.retries + 1
+
+    def _record(self, seqno):
+        record = self.pending.get(seqno)
+        if record is None:
+            record = self.completing.get(seqno)
+        return record
+
+    def responded(self, seqno):
+        record = self._record(seqno)
+        if record is None:
+            return
+        if record.quorum is not None:
+            self.late_responses[record.kind] = self.late_responses[record.kind] + 1
+        record.received = record.received + 1
+        self._check_complete(seqno, record)
+
+    def timed_out(self, seqno):
+        """A replica request for seqno got no response in time, so stop waiting for it."""
+        record = self._record(seqno)
+        if record is not None:
+            record.sent = record.sent - 1
+            self._check_complete(seqno, record)
+
+    def _check_complete(self, seqno, record):
+        if record.quorum is not None and record.received >= record.sent:
+            del self.completing[seqno]
+            self._complete(record)
+
+    def reached_quorum(self, seqno):
+        record = self.pending.pop(seqno)
+        record.quorum = Emulation.now()
+        self.quorum_wait[record.kind].record(record.quorum - record.start)
+        self.retries[record.kind].record(record.retries)
+        if record.received >= record.sent:
+            self._complete(record)
+        else:
+            self.completing[seqno] = record
+            if len(self.completing) > self.completing_limit:
+                self.completing.popitem(last=False)
+
+    def _complete(self, record):
+        self.completion[record.kind].record(Emulation.now() - record.start)
+
+    def merge(self, other):
+        for kind in KINDS:
+            self.quorum_wait[kind].merge(other.quorum_wait[kind])
+            self.completion[kind].merge(other.completion[kind])
+            self.retries[kind].merge(other.retries[kind])
+            self.late_responses[kind] = self.late_responses[kind] + other.late_responses[kind]
+        self.read_repairs = self.read_repairs + other.read_repairs
+        self.read_repair_conflicts = self.read_repair_conflicts + other.read_repair_conflicts
+        return self
+
+    def __str__(self):
+        lines = []
+        for kind in KINDS:
+            lines.append("%s quorum wait: %s" % (kind, self.quorum_wait[kind]))
+            lines.append("%s completion: %s" % (kind, self.completion[kind]))
+            lines.append("%s retries: %s, late responses: %d" % (kind, self.retries[kind], self.late_responses[kind]))
+        lines.append("read repairs: %d, conflicts left alone: %d" % (self.read_repairs, self.read_repair_conflicts))
+        return "\n".join(lines)
@@ -1,4 +1,7 @@
+import os
 import sys
+import copy
+import tempfile
 import random
 import unittest
 import logging
@@ -11,6 +14,9 @@ import history
 import logconfig
 
 import dynamo
+import timer
+from latency import Constant
+from vectorclock import VectorClock
 
 logconfig.init_logging()
 _logger = logging.getLogger('dynamo')
@@ -346,6 +352,499 @@ class TestDynamo(unittest.TestCase):
         Emulation.run(timers_to_process=0)
         print(putmsg.metadata)
 
+    def test_anti_entropy(self):
+        for _ in range(3):
+            dynamo.Node()
+        a = dynamo.Client('a')
+        a.put('K1', None, 1)
+        a.put('K2', None, 2)
+        Emulation.run(timers_to_process=0)
+        (A, B, C) = dynamo.Node.node_list
+        self.assertEqual(A.local_store.root_digests(), B.local_store.root_digests())
+
+        A.put('K3', 3, VectorClock().update('A', 100))
+        newer = copy.deepcopy(B.get('K1')[1]).update('B', 100)
+        B.put('K1', 11, newer)
+        C.put('K2', 22, VectorClock().update('Z', 100))
+        from_line = len(History.history)
+        A.sync_with(B)
+        Emulation.run(timers_to_process=0)
+        print(History.ladder(start_line=from_line))
+
+        self.assertEqual(B.get('K3')[0], 3)
+        self.assertEqual(A.get('K1'), (11, newer))
+        self.assertEqual(A.local_store.root_digests(), B.local_store.root_digests())
+        self.assertEqual(A.get('K2')[0], 2)
+        A.sync_with(C)
+        Emulation.run(timers_to_process=0)
+        self.assertEqual(A.get('K2')[0], 2)
+        self.assertEqual(C.get('K2')[0], 22)
+        self.assertEqual(C.get('K3')[0], 3)
+
+        syncs = [msg for (action, msg) in History.history
+                 if action == "send" and isinstance(msg, (messages.SyncRequestMessage, messages.SyncResponseMessage))]
+        from_line = len(syncs)
+        A.sync_with(B)
+        Emulation.run(timers_to_process=0)
+        syncs = [msg for (action, msg) in History.history
+                 if action == "send" and isinstance(msg, (messages.SyncRequestMessage, messages.SyncResponseMessage))]
+        self.assertEqual(len(syncs) - from_line, 1)
+
+    def test_anti_entropy_new_node(self):
+        for _ in range(6):
+            dynamo.Node()
+        a = dynamo.Client('a')
+        keys = ['K%d' % ii for ii in range(20)]
+        for key in keys:
+            a.put(key, None, key)
+        Emulation.run(timers_to_process=0)
+
+        G = dynamo.Node()
+        peers = dynamo.Node.consistent_hash_tbl.peers(G, dynamo.Node.N)
+        for peer in peers:
+            G.sync_with(peer)
+        Emulation.run(timers_to_process=0)
+        for key in keys:
+            in_range = G in dynamo.Node.consistent_hash_tbl.find_nodes(key, dynamo.Node.N)[0]
+            self.assertEqual(key in G.local_store, in_range)
+            if in_range:
+                self.assertEqual(G.get(key)[0], key)
+        for peer in peers:
+            for key_range in G.shared_ranges(peer):
+                self.assertEqual(G.local_store.tree(key_range).root_digest(),
+                                 peer.local_store.tree(key_range).root_digest())
+
+    def test_anti_entropy_in_sync(self):
+        (A, B, C) = [dynamo.Node() for _ in range(3)]
+        a = dynamo.Client('a')
+        a.put('K1', None, 1)
+        Emulation.run(timers_to_process=0)
+        self.assertEqual(A.local_store.root_digests(), C.local_store.root_digests())
+        A.sync_with(C)
+        self.assertEqual(Emulation.pending_timers, {})
+        Emulation.run(timers_to_process=1)
+        # Nothing needs sending back, and the silence must not look like a failure.
+        self.assertEqual(list(A.failed_nodes), [])
+
+    def test_dispatch(self):
+        self.assertEqual(dynamo.Node.handler_for(messages.PutRequestMessage), dynamo.Node.process_PutReq)
+        self.assertEqual(dynamo.Node.handler_for(messages.SyncResponseMessage), dynamo.Node.process_Sync)
+        self.assertIsNone(dynamo.Node.handler_for(messages.ClientPutResponseMessage))
+        self.assertIsNone(dynamo.Client.handler_for(messages.ClientPutResponseMessage))
+        self.assertTrue(dynamo.Node.expects_response_timer())
+        self.assertFalse(BaseNode.expects_response_timer())
+        a = dynamo.Node()
+        self.assertRaises(TypeError, a.process_msg, messages.ResponseMessage(messages.BaseMessage(a, a)))
+
+    def test_message_clone(self):
+        (a, b, c) = (dynamo.Node(), dynamo.Node(), dynamo.Node())
+        msg = messages.PutRequestMessage(a, b, 'K1', 1, None, msg_id=7, handoff=set([c]))
+        copy_msg = msg.clone()
+        self.assertIsNot(copy_msg, msg)
+        self.assertEqual((copy_msg.from_node, copy_msg.to_node, copy_msg.key, copy_msg.value, copy_msg.msg_id),
+                         (a, b, 'K1', 1, 7))
+        self.assertIs(copy_msg.handoff, msg.handoff)
+        self.assertFalse(hasattr(copy_msg, 'original_msg'))
+        self.assertFalse(hasattr(copy_msg, '__dict__'))
+
+    def test_history_window(self):
+        sink = history.MemorySink()
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            History.configure(limit=40, sinks=[sink, history.FileSink(filename)])
+            for _ in range(6):
+                dynamo.Node()
+            a = dynamo.Client('a')
+            for ii in range(5):
+                a.put('K%d' % ii, None, ii)
+                Emulation.run(timers_to_process=0)
+            self.assertEqual(len(History.history), 40)
+            self.assertEqual(len(sink.events), History.count)
+            self.assertEqual(sink.events[-1][0], History.count - 1)
+            self.assertIn("ClientPut(K4=4)", History.ladder(start_line=History.count - 30))
+            History.configure(enabled=False)
+            a.put('K9', None, 9)
+            Emulation.run(timers_to_process=0)
+            self.assertEqual(History.count, 0)
+            with open(filename) as infile:
+                self.assertEqual([line.split(' ', 2)[1] for line in infile],
+                                 [action for (_, action, _) in sink.events])
+        finally:
+            History.configure()
+            os.remove(filename)
+
+    def test_history_query(self):
+        try:
+            for limit in (None, 60):
+                History.configure(limit=limit, indexed=True)
+                reset_all()
+                nodes = [dynamo.Node() for _ in range(6)]
+                a = dynamo.Client('a')
+                for ii in range(6):
+                    a.put('K%d' % (ii % 3), None, ii)
+                    Emulation.run(timers_to_process=0)
+                first = History.count - len(History.history)
+                indexed = History.query(key='K1', start=first + 10)
+                self.assertTrue(indexed)
+                self.assertEqual(indexed, [(seq, action, obj) for (seq, action, obj) in History.query(action=None)
+                                           if getattr(getattr(obj, 'reason', obj), 'key', None) == 'K1' and seq >= first + 10])
+                for node in nodes:
+                    self.assertEqual(History.query(node=node, action='deliver'),
+                                     [(seq, action, msg) for (seq, action, msg) in History.query(action='deliver')
+                                      if node in (msg.from_node, msg.to_node, getattr(msg, 'intermediate_node', None))])
+                (seq, _, putreq) = [event for event in History.query(action='send')
+                                    if isinstance(event[2], messages.PutRequestMessage)][-1]
+                self.assertEqual(History.event(seq)[1], putreq)
+                coordinator = putreq.from_node
+                lifecycle = History.lifecycle(putreq.msg_id, coordinator)
+                self.assertIn((seq, 'send', putreq), lifecycle)
+                self.assertEqual(set(action for (_, action, _) in lifecycle), set(['send', 'deliver', 'start', 'cancel']))
+                # Entries for discarded events are pruned every `limit` events.
+                self.assertLessEqual(sum(len(seqs) for seqs in History.by_action.values()), 2 * (limit or History.count))
+        finally:
+            History.configure()
+
+    def test_ladder_lines(self):
+        for _ in range(6):
+            dynamo.Node()
+        a = dynamo.Client('a')
+        a.put('K1', None, 1)
+        Emulation.run(timers_to_process=0)
+        from_seq = History.count
+        coordinator = dynamo.Node.consistent_hash_tbl.find_nodes('K2', 1)[0][0]
+        a.put('K2', None, 2, destnode=coordinator)
+        Emulation.run(timers_to_process=0)
+        self.assertEqual('\n'.join(History.ladder_lines(start_line=from_seq)), History.ladder(start_line=from_seq))
+        window = list(History.ladder_lines(start=from_seq))
+        self.assertTrue(any('ClientPut(K2=2)' in line for line in window))
+        self.assertFalse(any('ClientPut(K1=1)' in line for line in window))
+        lines = list(History.ladder_lines(start=from_seq, nodes=[a, coordinator]))
+        self.assertEqual(lines[0], "%s%s%s" % (coordinator, ' ' * 20, a))
+        self.assertEqual(len([line for line in lines if 'ClientPut' in line]), 2)
+        local_puts = [msg for (_, _, msg) in History.query(action='send', start=from_seq)
+                      if isinstance(msg, messages.PutRequestMessage) and msg.to_node is coordinator]
+        self.assertEqual(len([line for line in lines if 'PutReq' in line]), len(local_puts))
+
+    def test_virtual_time(self):
+        Emulation.set_virtual_time(True, Constant(1.0))
+        try:
+            nodes = [dynamo.Node() for _ in range(6)]
+            a = dynamo.Client('a')
+            coordinator = dynamo.Node.consistent_hash_tbl.find_nodes('K1', 1)[0][0]
+            a.put('K1', None, 1, destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            # client -> coordinator -> replicas -> coordinator -> client
+            self.assertEqual(Emulation.now(), 4.0)
+            self.assertIsInstance(a.prev_msg, messages.ClientPutResponseMessage)
+
+            slow = [node for node in nodes if node is not coordinator][0]
+            Emulation.set_latency(Constant(10.0), [a], [slow])
+            start = Emulation.now()
+            a.get('K1', destnode=slow)
+            Emulation.run(until=start + 5)
+            self.assertEqual(Emulation.now(), start + 5)
+            self.assertEqual(timer.TimerManager.pending_count(), len(nodes) + 1)
+
+            # Both requests to the failed node end with their response timers popping.
+            slow.fail()
+            a.get('K1', destnode=slow)
+            Emulation.run(until=start + timer.DEFAULT_DURATION + 5)
+            self.assertIn(('drop', 'ClientGetRequestMessage'), [(action, msg.__class__.__name__) for (action, msg) in History.history])
+            pops = [msg for (action, msg) in History.history if action == 'pop' and msg.from_node is a]
+            self.assertEqual(len(pops), 2)
+
+            # Resetting goes back to FIFO delivery and the default latency.
+            Emulation.set_virtual_time(True, Constant(5.0))
+            reset_all()
+            self.assertFalse(Emulation.virtual_time)
+            self.assertIsNone(timer.TimerManager.scheduler)
+            self.assertEqual(Emulation.latency(), 1.0)
+        finally:
+            Emulation.set_virtual_time(False)
+
+    def test_reconnect(self):
+        (A, B, C, D) = [dynamo.Node() for _ in range(4)]
+        Emulation.disconnect((A, B), (C, D))
+        Emulation.disconnect((C,), (A,))
+        self.assertFalse(Emulation.is_reachable(B, D))
+        self.assertFalse(Emulation.is_reachable(C, A))
+        self.assertTrue(Emulation.is_reachable(C, B))
+        self.assertTrue(Emulation.is_reachable(D, A))
+
+        Emulation.reconnect((A, C), (D, A))
+        self.assertTrue(Emulation.is_reachable(A, D))
+        self.assertTrue(Emulation.is_reachable(C, A))
+        self.assertFalse(Emulation.is_reachable(A, C))
+        self.assertFalse(Emulation.is_reachable(B, D))
+
+        Emulation.unreachable_nodes = [((D,), (A,))]
+        self.assertFalse(Emulation.is_reachable(D, A))
+        self.assertTrue(Emulation.is_reachable(B, D))
+        Emulation.reconnect()
+        self.assertTrue(Emulation.is_reachable(D, A))
+        self.assertIn(('announce', 'Reconnect all'), History.history)
+
+        # Leaving out one side restores that node's links to or from everyone.
+        Emulation.disconnect((A, B), (C, D))
+        Emulation.reconnect(to_nodes=(C,))
+        self.assertTrue(Emulation.is_reachable(A, C))
+        self.assertTrue(Emulation.is_reachable(B, C))
+        self.assertFalse(Emulation.is_reachable(A, D))
+        Emulation.reconnect(from_nodes=(A,))
+        self.assertTrue(Emulation.is_reachable(A, D))
+        self.assertFalse(Emulation.is_reachable(B, D))
+        self.assertIn(('announce', "Reconnect ['A'] -> all"), History.history)
+
+    def test_cancel_timers_for_node(self):
+        (A, B, C) = [dynamo.Node() for _ in range(3)]
+        requests = [messages.GetRequestMessage(A, dest, 'K%d' % ii, msg_id=ii) for ii, dest in enumerate((B, C, B, B, C))]
+        for msg in requests:
+            Emulation.send_message(msg)
+        self.assertEqual(Emulation.cancel_timers_for_node(B), [requests[0], requests[2], requests[3]])
+        self.assertEqual(list(Emulation.pending_timers), [requests[1], requests[4]])
+        self.assertEqual(Emulation.cancel_timers_for_node(B), [])
+        Emulation.run(timers_to_process=0)
+        self.assertEqual(Emulation.pending_timers, {})
+        self.assertEqual(Emulation.timers_by_dest, {})
+
+    def test_failed_nodes(self):
+        nodes = [dynamo.Node() for _ in range(6)]
+        a = dynamo.Client('a')
+        victim = dynamo.Node.consistent_hash_tbl.find_nodes('K1', 2)[0][1]
+        victim.fail()
+        for ii in range(20):
+            a.put('K%d' % (ii % 4 + 1), None, ii)
+            Emulation.run(timers_to_process=3)
+        for node in nodes:
+            self.assertTrue(len(node.failed_nodes) <= 1)
+        suspects = [node for node in nodes if victim in node.failed_nodes]
+        self.assertTrue(suspects)
+        self.assertEqual(suspects[0].failed_nodes.frozen(), frozenset([victim]))
+
+        tracker = dynamo.FailedNodes()
+        for node in nodes[:3] + nodes[:2]:
+            tracker.add(node)
+        self.assertEqual(list(tracker), nodes[:3])
+        self.assertEqual([tracker.next_to_retry() for _ in range(4)], nodes[:3] + nodes[:1])
+        tracker.discard(nodes[0])
+        self.assertNotIn(nodes[0], tracker.frozen())
+        self.assertEqual([tracker.next_to_retry() for _ in range(2)], [nodes[1], nodes[2]])
+
+    def test_handoff_batches(self):
+        saved = (dynamo.Node.handoff_batch, dynamo.Node.handoff_window)
+        (dynamo.Node.handoff_batch, dynamo.Node.handoff_window) = (2, 1)
+        try:
+            nodes = [dynamo.Node() for _ in range(6)]
+            a = dynamo.Client('a')
+            victim = nodes[0]
+            victim.fail()
+            for ii in range(30):
+                a.put('K%d' % ii, None, 1)
+                Emulation.run(timers_to_process=3)
+            hints = dict([(node, len(node.pending_handoffs.get(victim, ()))) for node in nodes])
+            hinted = set([key for node in nodes for key in node.pending_handoffs.get(victim, ())])
+            self.assertTrue(max(hints.values()) > 2)
+
+            victim.recover()
+            from_seq = History.count
+            for _ in range(20):
+                Emulation.run(timers_to_process=10)
+            for node in nodes:
+                self.assertNotIn(victim, node.pending_handoffs)
+                self.assertEqual((node.handoff_queues, node.handoff_in_flight), ({}, {}))
+            sent = [msg for (_, _, msg) in History.query(action='send', start=from_seq)
+                    if isinstance(msg, messages.HandoffRequestMessage)]
+            for node in nodes:
+                self.assertEqual(len([msg for msg in sent if msg.from_node is node]), (hints[node] + 1) // 2)
+            for key in hinted:
+                self.assertEqual(victim.get(key)[0], 1)
+        finally:
+            (dynamo.Node.handoff_batch, dynamo.Node.handoff_window) = saved
+
+    def test_read_repair(self):
+        dynamo.Node.read_repair = True
+        try:
+            for _ in range(6):
+                dynamo.Node()
+            a = dynamo.Client('a')
+            (coordinator, first, second) = dynamo.Node.consistent_hash_tbl.find_nodes('K1', 3)[0]
+            a.put('K1', None, 1, destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            Emulation.disconnect((coordinator,), (second,))
+            a.put('K1', [a.prev_msg.metadata], 2, destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            Emulation.reconnect()
+            self.assertEqual(second.get('K1')[0], 1)
+
+            a.get('K1', destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            self.assertEqual(a.prev_msg.value, [2])
+            self.assertEqual(second.get('K1'), first.get('K1'))
+            self.assertEqual(coordinator.metrics.read_repairs, 1)
+            self.assertEqual(coordinator.read_repairs, {})
+
+            a.get('K1', destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            self.assertEqual(dynamo.Node.cluster_metrics().read_repairs, 1)
+
+            # A repair stops waiting on a replica whichever node's timer gives up on it.
+            (value, metadata) = first.get('K1')
+            coordinator.read_repairs[99] = ('K1', [(first, value, metadata)], set([second]))
+            first.retry_request(messages.GetRequestMessage(coordinator, second, 'K1', msg_id=99))
+            self.assertEqual(coordinator.read_repairs, {})
+        finally:
+            dynamo.Node.read_repair = False
+
+    def test_multi_key(self):
+        nodes = [dynamo.Node() for _ in range(8)]
+        a = dynamo.Client('a')
+        keys = ['K%d' % ii for ii in range(20)]
+        from_seq = History.count
+        a.multi_put([(key, None, ii) for ii, key in enumerate(keys)], destnode=nodes[0])
+        Emulation.run(timers_to_process=0)
+        self.assertIsInstance(a.prev_msg, messages.ClientMultiPutResponseMessage)
+        self.assertEqual(sorted(a.prev_msg.results), sorted(keys))
+        batches = [msg for (_, _, msg) in History.query(action='send', start=from_seq)
+                   if isinstance(msg, messages.MultiPutRequestMessage)]
+        self.assertEqual(len(batches), len(set([msg.to_node for msg in batches])))
+        for ii, key in enumerate(keys):
+            for node in dynamo.Node.consistent_hash_tbl.find_nodes(key, dynamo.Node.N)[0]:
+                self.assertEqual(node.get(key)[0], ii)
+
+        a.multi_get(keys + ['missing', 'K1'], destnode=nodes[1])
+        Emulation.run(timers_to_process=0)
+        results = a.prev_msg.results
+        self.assertEqual(len(results), len(keys) + 1)
+        self.assertEqual(results['K3'][0], [3])
+        self.assertEqual(results['missing'][0], [None])
+
+        # Keys whose replicas include a failed node complete once their batch to it is retried elsewhere.
+        victim = nodes[2]
+        victim.fail()
+        a.multi_put([(key, [results[key][1][0]], 100 + ii) for ii, key in enumerate(keys)], destnode=nodes[0])
+        while not isinstance(a.prev_msg, messages.ClientMultiPutResponseMessage):
+            Emulation.run(timers_to_process=1)
+        self.assertEqual(sorted(a.prev_msg.results), sorted(keys))
+        self.assertIn(victim, nodes[0].failed_nodes)
+        self.assertEqual(nodes[0].pending_multi, {})
+        a.multi_get(keys, destnode=nodes[0])
+        Emulation.run(timers_to_process=0)
+        self.assertEqual([a.prev_msg.results[key][0] for key in keys], [[100 + ii] for ii in range(len(keys))])
+
+    def test_multi_key_shared_failure(self):
+        saved = dynamo.Node.W
+        dynamo.Node.W = dynamo.Node.N
+        try:
+            nodes = [dynamo.Node() for _ in range(8)]
+            clients = [dynamo.Client('a'), dynamo.Client('b')]
+            keys = ['K%d' % ii for ii in range(20)]
+            victim = nodes[2]
+            self.assertTrue([key for key in keys if victim in dynamo.Node.consistent_hash_tbl.find_nodes(key, dynamo.Node.N)[0]])
+            victim.fail()
+            # Both coordinators need the failed node's answer; the first timer to pop hands over both batches.
+            for client, coordinator in zip(clients, nodes):
+                client.multi_put([(key, None, 1) for key in keys], destnode=coordinator)
+            while [client for client in clients if not isinstance(client.prev_msg, messages.ClientMultiPutResponseMessage)]:
+                Emulation.run(timers_to_process=1)
+            for client in clients:
+                self.assertEqual(sorted(client.prev_msg.results), sorted(keys))
+            self.assertEqual(len([msg for (_, _, msg) in History.query(action='send')
+                                  if isinstance(msg, messages.ClientMultiPutRequestMessage)]), 2)
+            for coordinator in nodes[:2]:
+                self.assertIn(victim, coordinator.failed_nodes)
+                self.assertEqual(coordinator.pending_multi, {})
+        finally:
+            dynamo.Node.W = saved
+
+    def test_multi_key_unreachable(self):
+        nodes = [dynamo.Node() for _ in range(3)]
+        a = dynamo.Client('a')
+        coordinator = nodes[0]
+        for node in nodes:
+            coordinator.failed_nodes.add(node)
+        # Every replica is avoided, so each key fails rather than dropping out of the response.
+        from_seq = History.count
+        a.multi_put([('K1', None, 1), ('K2', None, 2)], destnode=coordinator)
+        Emulation.run(timers_to_process=0)
+        self.assertIsInstance(a.prev_msg, messages.ClientMultiPutResponseMessage)
+        self.assertEqual(a.prev_msg.results, {'K1': None, 'K2': None})
+        a.multi_get(['K1', 'K2'], destnode=coordinator)
+        Emulation.run(timers_to_process=0)
+        self.assertIsInstance(a.prev_msg, messages.ClientMultiGetResponseMessage)
+        self.assertEqual(a.prev_msg.results, {'K1': None, 'K2': None})
+        self.assertEqual([msg for (_, _, msg) in History.query(action='send', start=from_seq)
+                          if isinstance(msg, (messages.MultiPutRequestMessage, messages.MultiGetRequestMessage))], [])
+        self.assertEqual(coordinator.pending_multi, {})
+
+    def test_request_metrics(self):
+        Emulation.set_virtual_time(True, Constant(1.0))
+        try:
+            for _ in range(6):
+                dynamo.Node()
+            a = dynamo.Client('a')
+            coordinator = dynamo.Node.consistent_hash_tbl.find_nodes('K1', 1)[0][0]
+            replicas = [node for node in dynamo.Node.consistent_hash_tbl.find_nodes('K1', 3)[0] if node is not coordinator]
+            a.put('K1', None, 1, destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            metrics = coordinator.metrics
+            self.assertEqual(metrics.quorum_wait['put'].max, 2.0)
+            self.assertEqual(metrics.completion['put'].max, 2.0)
+            self.assertEqual(metrics.late_responses['put'], dynamo.Node.N - dynamo.Node.W)
+
+            # A slow replica holds up completion but not the quorum.
+            Emulation.set_latency(Constant(10.0), [coordinator], replicas[:1])
+            a.get('K1', destnode=coordinator)
+            Emulation.run(timers_to_process=0)
+            self.assertEqual(metrics.quorum_wait['get'].max, 2.0)
+            self.assertEqual(metrics.completion['get'].max, 11.0)
+            self.assertEqual(metrics.late_responses['get'], 1)
+
+            # With both other replicas down the quorum needs two retries, after the response timers pop.
+            Emulation.link_latency = {}
+            for node in replicas:
+                node.fail()
+            start = Emulation.now()
+            a.put('K1', None, 2, destnode=coordinator)
+            Emulation.run(until=start + timer.DEFAULT_DURATION + 10)
+            self.assertEqual(metrics.retries['put'].max, 2)
+            self.assertEqual(metrics.quorum_wait['put'].max, timer.DEFAULT_DURATION + 2.0)
+            self.assertEqual(len(metrics.completion['put']), len(metrics.quorum_wait['put']))
+            self.assertFalse(metrics.pending or metrics.completing)
+
+            total = dynamo.Node.cluster_metrics()
+            self.assertEqual(len(total.quorum_wait['put']),
+                             sum([len(node.metrics.quorum_wait['put']) for node in dynamo.Node.node_list]))
+            self.assertEqual(len(total.quorum_wait['get']), 1)
+        finally:
+            Emulation.set_virtual_time(False)
+
+    def test_retry_metrics_coordinator(self):
+        nodes = [dynamo.Node() for _ in range(6)]
+        a = dynamo.Client('a')
+        (A, C) = dynamo.Node.consistent_hash_tbl.find_nodes('K1', 2)[0]
+        B = [node for node in nodes if node not in (A, C)][0]
+        key = [key for key in ['K%d' % ii for ii in range(100)] if dynamo.Node.consistent_hash_tbl.find_nodes(key, 1)[0][0] is B][0]
+        a.get('K1', destnode=A)
+        a.get(key, destnode=B)
+        Emulation.run(msgs_to_process=2, timers_to_process=0)
+        asked = set([req.to_node for req in A.pending_requests[messages.GetRequestMessage][1]])
+        reqmsg = [req for req in Emulation.cancel_timers_for_node(C) if req.from_node is A][0]
+        # B's timer hands over A's request to C, which shares a seqno with B's own request.
+        self.assertEqual(reqmsg.msg_id, 1)
+        self.assertIn(1, B.pending_requests[messages.GetRequestMessage])
+        from_seq = History.count
+        B.retry_request(reqmsg)
+        resent = [msg for (_, _, msg) in History.query(action='send', start=from_seq)]
+        self.assertEqual(len(resent), 1)
+        self.assertIsInstance(resent[0], messages.GetRequestMessage)
+        self.assertIs(resent[0].from_node, A)
+        self.assertNotIn(resent[0].to_node, asked)
+        self.assertIn(C, A.failed_nodes)
+        self.assertEqual(A.metrics.pending[1].retries, 1)
+        self.assertEqual(B.metrics.pending[1].retries, 0)
+        self.assertEqual(len(B.pending_requests[messages.GetRequestMessage][1]), dynamo.Node.N)
+
 
 if __name__ == "__main__":
     ii = 1
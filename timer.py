@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import logging
 
 from messages import TimerMessage
@@ -6,6 +8,15 @@ from history import History
 _logger = logging.getLogger('dynamo')
 
 DEFAULT_PRIORITY = 10
+DEFAULT_DURATION = 100.0  # Simulated time before a timer pops, when running on virtual time
+
+# Heap entry layout: [-priority, sequence, tmsg].  Higher priorities pop first
+# and the sequence number keeps timers of equal priority in FIFO order.  A
+# cancelled entry has its tmsg slot replaced by _CANCELLED and is discarded
+# lazily when it reaches the top of the heap.  On virtual time the entries live
+# in the scheduler's heap instead, as [due time, sequence, tmsg], and are
+# cancelled the same way.
+_CANCELLED = None
 
 
 def _priority(msg):
@@ -16,52 +27,151 @@ def _priority(msg):
     return priority
 
 
+def _duration(msg):
+    duration = DEFAULT_DURATION
+    node = msg.from_node
+    if 'timer_duration' in node.__class__.__dict__:
+        duration = float(node.__class__.__dict__['timer_duration'])
+    return duration
+
+
 class TimerManager(object):
     pending_timers = []
+    timer_index = {}
+    sequence = itertools.count()
+    scheduler = None  # Virtual-time event queue, set by Emulation.set_virtual_time()
 
     @classmethod
     def pending_count(cls):
-        return len(cls.pending_timers)
+        return len(cls.timer_index)
 
     @classmethod
     def reset(cls):
         cls.pending_timers = []
+        cls.timer_index = {}
+        cls.sequence = itertools.count()
+        cls.scheduler = None
 
     @classmethod
-    def start_timer(cls, node, reason=None, callback=None, priority=None):
+    def start_timer(cls, node, reason=None, callback=None, priority=None, duration=None):
         if node.failed:
             return None
         tmsg = TimerMessage(node, reason, callback=callback)
         History.add("start", tmsg)
+        if cls.scheduler is not None:
+            if duration is None:
+                duration = _duration(tmsg)
+            _logger.debug("Start timer %s duration %s for node %s reason %s", id(tmsg), duration, node, reason)
+            cls.timer_index[tmsg] = cls.scheduler.schedule(tmsg, duration)
+            return tmsg
         if priority is None:
             priority = _priority(tmsg)
         _logger.debug("Start timer %s prio %d for node %s reason %s", id(tmsg), priority, node, reason)
-        for ii in range(len(cls.pending_timers)):
-            if priority > cls.pending_timers[ii][0]:
-                cls.pending_timers.insert(ii, (priority, tmsg))
-                return tmsg
-        cls.pending_timers.append((priority, tmsg))
+        entry = [-priority, next(cls.sequence), tmsg]
+        cls.timer_index[tmsg] = entry
+        heapq.heappush(cls.pending_timers, entry)
         return tmsg
 
     @classmethod
     def cancel_timer(cls, tmsg):
-        for (this_prio, this_tmsg) in cls.pending_timers:
-            if this_tmsg == tmsg:
-                _logger.debug("Cancel timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
-                cls.pending_timers.remove((this_prio, this_tmsg))
-                History.add("cancel", tmsg)
-                return
+        entry = cls.timer_index.pop(tmsg, None)
+        if entry is None:
+            return
+        _logger.debug("Cancel timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
+        entry[2] = _CANCELLED
+        History.add("cancel", tmsg)
+        if cls.scheduler is None and len(cls.pending_timers) > 2 * len(cls.timer_index) + 64:
+            cls._compact()
 
     @classmethod
-    def pop_timer(cls):
+    def _compact(cls):
+        """Drop cancelled entries once they make up the bulk of the heap."""
+        cls.pending_timers = [entry for entry in cls.pending_timers if entry[2] is not _CANCELLED]
+        heapq.heapify(cls.pending_timers)
+
+    @classmethod
+    def _pop_entry(cls):
         while True:
-            (_, tmsg) = cls.pending_timers.pop(0)
-            if tmsg.from_node.failed:
-                continue
-            _logger.debug("Pop timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
-            History.add("pop", tmsg)
-            if tmsg.callback is None:
-                tmsg.from_node.timer_pop(tmsg.reason)
-            else:
-                tmsg.callback(tmsg.reason)
-            return
+            entry = heapq.heappop(cls.pending_timers)
+            tmsg = entry[2]
+            if tmsg is not _CANCELLED:
+                del cls.timer_index[tmsg]
+                return tmsg
+
+    @classmethod
+    def pop_timer(cls):
+        while not cls.fire(cls._pop_entry()):
+            pass
+
+    @classmethod
+    def fire(cls, tmsg):
+        """Run a timer whose entry has been taken off the heap; False if its node has failed."""
+        cls.timer_index.pop(tmsg, None)
+        if tmsg.from_node.failed:
+            return False
+        _logger.debug("Pop timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
+        History.add("pop", tmsg)
+        if tmsg.callback is None:
+            tmsg.from_node.timer_pop(tmsg.reason)
+        else:
+            tmsg.callback(tmsg.reason)
+        return True
+
+
+import unittest
+
+
+class _TimerNode(object):
+    timer_priority = 20
+
+    def __init__(self):
+        self.failed = False
+        self.popped = []
+
+    def timer_pop(self, reason=None):
+        self.popped.append(reason)
+
+
+class TimerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        TimerManager.reset()
+        History.reset()
+        self.node = _TimerNode()
+
+    def testOrder(self):
+        TimerManager.start_timer(self.node, reason="a", priority=10)
+        TimerManager.start_timer(self.node, reason="b", priority=20)
+        TimerManager.start_timer(self.node, reason="c", priority=10)
+        TimerManager.start_timer(self.node, reason="d")
+        self.assertEqual(TimerManager.pending_count(), 4)
+        while TimerManager.pending_count() > 0:
+            TimerManager.pop_timer()
+        self.assertEqual(self.node.popped, ["b", "d", "a", "c"])
+
+    def testCancel(self):
+        tmsgs = [TimerManager.start_timer(self.node, reason=ii, priority=10) for ii in range(200)]
+        for tmsg in tmsgs[:150]:
+            TimerManager.cancel_timer(tmsg)
+        TimerManager.cancel_timer(tmsgs[0])
+        TimerManager.cancel_timer(None)
+        self.assertEqual(TimerManager.pending_count(), 50)
+        while TimerManager.pending_count() > 0:
+            TimerManager.pop_timer()
+        self.assertEqual(self.node.popped, list(range(150, 200)))
+        self.assertEqual(len([action for (action, _) in History.history if action == "cancel"]), 150)
+
+    def testFailedNode(self):
+        failed = _TimerNode()
+        TimerManager.start_timer(failed, reason="x", priority=30)
+        TimerManager.start_timer(self.node, reason="y", priority=10)
+        failed.failed = True
+        self.assertIsNone(TimerManager.start_timer(failed, reason="z"))
+        TimerManager.pop_timer()
+        self.assertEqual(failed.popped, [])
+        self.assertEqual(self.node.popped, ["y"])
+        self.assertEqual(TimerManager.pending_count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
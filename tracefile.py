@@ -0,0 +1,306 @@
+"""
+Compact binary traces of History.
+
+A trace is two files: `<name>` holds a short magic header followed by one fixed-width
+record per event, and `<name>.str` holds the interned string table (node names,
+message types, keys) as length-prefixed UTF-8, in id order.  TraceSink writes a trace
+as the events happen (see History.configure); TraceReader memory-maps one for offline
+analysis.
+"""
+import mmap
+import struct
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'DYTRACE2'
+ACTIONS = ('send', 'forward', 'drop', 'cut', 'deliver', 'start', 'cancel', 'pop',
+           'fail', 'recover', 'add', 'remove', 'announce')
+ACTION_CODES = dict((action, code) for (code, action) in enumerate(ACTIONS))
+NONE = 0xFFFFFFFF  # String id for "no node/type/key"
+NO_MSG_ID = -1
+
+# seq, action, from node, to node, message type, msg_id, key (or announcement text).  seq and
+# msg_id are 64-bit, as long runs number more events and messages than fit in 32 bits.
+RECORD = struct.Struct('<QB3xIIIqI')
+_LENGTH = struct.Struct('<I')
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([('seq', '<u8'), ('action', 'u1'), ('pad', 'V3'),
+                                ('from_node', '<u4'), ('to_node', '<u4'), ('msg_type', '<u4'),
+                                ('msg_id', '<i8'), ('key', '<u4')])
+
+TraceRecord = namedtuple('TraceRecord', ['seq', 'action', 'from_node', 'to_node', 'msg_type', 'msg_id', 'key'])
+
+
+class TraceSink(object):
+    """History sink writing a binary trace, buffering `buffer_records` records per write()."""
+    def __init__(self, filename, buffer_records=4096):
+        self.filename = filename
+        self.outfile = open(filename, 'wb')
+        self.outfile.write(MAGIC)
+        self.strfile = open(filename + '.str', 'wb')
+        self.strings = {}
+        self.node_ids = {}
+        self.type_ids = {}
+        self.buffer = bytearray(buffer_records * RECORD.size)
+        self.offset = 0
+
+    def intern(self, text):
+        try:
+            return self.strings[text]
+        except KeyError:
+            string_id = len(self.strings)
+            self.strings[text] = string_id
+            data = text.encode('utf-8')
+            self.strfile.write(_LENGTH.pack(len(data)))
+            self.strfile.write(data)
+            return string_id
+
+    def _node_id(self, node):
+        try:
+            return self.node_ids[node]
+        except KeyError:
+            self.node_ids[node] = self.intern(str(node))
+            return self.node_ids[node]
+
+    def _type_id(self, kls):
+        try:
+            return self.type_ids[kls]
+        except KeyError:
+            self.type_ids[kls] = self.intern(kls.__name__)
+            return self.type_ids[kls]
+
+    def write(self, index, action, obj):
+        if hasattr(obj, 'from_node'):
+            from_id = self._node_id(obj.from_node)
+            to_id = self._node_id(obj.to_node)
+            type_id = self._type_id(obj.__class__)
+            msg_id = obj.msg_id
+            if msg_id is None:
+                msg_id = NO_MSG_ID
+            key = getattr(obj, 'key', None)
+            if key is None:
+                key = getattr(obj, 'reason', None)
+                if not isinstance(key, str):
+                    # A response timer's reason is the request it is waiting on.
+                    key = getattr(key, 'key', None)
+            key_id = NONE if key is None else self.intern(str(key))
+        else:
+            from_id = to_id = type_id = NONE
+            msg_id = NO_MSG_ID
+            key_id = self.intern(str(obj))
+        if self.offset == len(self.buffer):
+            self.flush()
+        RECORD.pack_into(self.buffer, self.offset, index, ACTION_CODES[action],
+                         from_id, to_id, type_id, msg_id, key_id)
+        self.offset = self.offset + RECORD.size
+
+    def flush(self):
+        self.outfile.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+        self.outfile.flush()
+        self.strfile.flush()
+
+    def close(self):
+        if self.outfile.closed:
+            return
+        self.flush()
+        self.outfile.close()
+        self.strfile.close()
+
+
+class TraceReader(object):
+    """
+    Memory-mapped view of a trace.  Filtering works on the raw records (with numpy if
+    it is available) and only the matching records are decoded into TraceRecords.
+    """
+    def __init__(self, filename):
+        self.strings = []
+        with open(filename + '.str', 'rb') as strfile:
+            data = strfile.read()
+        offset = 0
+        while offset < len(data):
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset = offset + _LENGTH.size
+            self.strings.append(data[offset:offset + length].decode('utf-8'))
+            offset = offset + length
+        self.string_ids = dict((text, string_id) for (string_id, text) in enumerate(self.strings))
+
+        self.infile = open(filename, 'rb')
+        self.mmap = mmap.mmap(self.infile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a trace file" % filename)
+        self.count = (len(self.mmap) - len(MAGIC)) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mmap.close()
+        self.infile.close()
+
+    def _string(self, string_id):
+        if string_id == NONE:
+            return None
+        return self.strings[string_id]
+
+    def decode(self, raw):
+        seq, action, from_id, to_id, type_id, msg_id, key_id = raw
+        return TraceRecord(seq, ACTIONS[action], self._string(from_id), self._string(to_id),
+                           self._string(type_id), None if msg_id == NO_MSG_ID else msg_id, self._string(key_id))
+
+    def record(self, ii):
+        if not 0 <= ii < self.count:
+            raise IndexError(ii)
+        return self.decode(RECORD.unpack_from(self.mmap, len(MAGIC) + ii * RECORD.size))
+
+    def __iter__(self):
+        for raw in RECORD.iter_unpack(memoryview(self.mmap)[len(MAGIC):len(MAGIC) + self.count * RECORD.size]):
+            yield self.decode(raw)
+
+    def _criteria(self, action, node, msg_type, msg_id, key):
+        """Translate a filter into (raw field index, value) pairs; None if it cannot match anything."""
+        criteria = []
+        if action is not None:
+            criteria.append((1, ACTION_CODES[action]))
+        for (field, text) in ((4, msg_type), (6, key)):
+            if text is not None:
+                if text not in self.string_ids:
+                    return None
+                criteria.append((field, self.string_ids[text]))
+        if msg_id is not None:
+            criteria.append((5, msg_id))
+        node_id = None
+        if node is not None:
+            if node not in self.string_ids:
+                return None
+            node_id = self.string_ids[node]
+        return criteria, node_id
+
+    def select(self, action=None, node=None, msg_type=None, msg_id=None, key=None):
+        """Yield the records matching every given criterion; node matches either end of a message."""
+        found = self._criteria(action, node, msg_type, msg_id, key)
+        if found is None:
+            return
+        criteria, node_id = found
+        if numpy is not None:
+            for ii in self._numpy_select(criteria, node_id):
+                yield self.record(int(ii))
+            return
+        for raw in RECORD.iter_unpack(memoryview(self.mmap)[len(MAGIC):len(MAGIC) + self.count * RECORD.size]):
+            if node_id is not None and raw[2] != node_id and raw[3] != node_id:
+                continue
+            for field, value in criteria:
+                if raw[field] != value:
+                    break
+            else:
+                yield self.decode(raw)
+
+    def _numpy_select(self, criteria, node_id):
+        records = numpy.frombuffer(self.mmap, dtype=RECORD_DTYPE, count=self.count, offset=len(MAGIC))
+        mask = numpy.ones(self.count, dtype=bool)
+        for field, value in criteria:
+            mask &= (records[TraceRecord._fields[field]] == value)
+        if node_id is not None:
+            mask &= (records['from_node'] == node_id) | (records['to_node'] == node_id)
+        return numpy.flatnonzero(mask)
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class _Node(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class _Message(object):
+    def __init__(self, from_node, to_node, key, msg_id):
+        self.from_node = from_node
+        self.to_node = to_node
+        self.key = key
+        self.msg_id = msg_id
+
+
+class _Timer(object):
+    def __init__(self, node, reason):
+        self.from_node = node
+        self.to_node = node
+        self.reason = reason
+        self.msg_id = None
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "trace")
+        a, b = _Node("A"), _Node("B")
+        self.events = [("announce", "start"),
+                       ("send", _Message(a, b, "K1", 1)),
+                       ("deliver", _Message(a, b, "K1", 1)),
+                       ("send", _Message(b, a, "K2", None)),
+                       ("drop", _Message(b, a, "K2", None))]
+        sink = TraceSink(self.filename, buffer_records=2)
+        for ii, (action, obj) in enumerate(self.events):
+            sink.write(ii, action, obj)
+        sink.close()
+        self.reader = TraceReader(self.filename)
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testRoundTrip(self):
+        self.assertEqual(len(self.reader), 5)
+        self.assertEqual(self.reader.record(0), TraceRecord(0, "announce", None, None, None, None, "start"))
+        self.assertEqual(self.reader.record(2), TraceRecord(2, "deliver", "A", "B", "_Message", 1, "K1"))
+        self.assertEqual([record.action for record in self.reader], [action for (action, _) in self.events])
+        self.assertRaises(IndexError, self.reader.record, 5)
+
+    def testSelect(self):
+        self.assertEqual([record.seq for record in self.reader.select(key="K1")], [1, 2])
+        self.assertEqual([record.seq for record in self.reader.select(action="send", node="A")], [1, 3])
+        self.assertEqual([record.seq for record in self.reader.select(msg_id=1, action="deliver")], [2])
+        self.assertEqual([record.seq for record in self.reader.select(msg_type="_Message", node="B", action="drop")], [4])
+        self.assertEqual(list(self.reader.select(key="missing")), [])
+
+    def testWideFields(self):
+        a, b = _Node("A"), _Node("B")
+        request = _Message(a, b, "K3", 2 ** 40)
+        filename = os.path.join(self.tmpdir, "wide")
+        sink = TraceSink(filename)
+        sink.write(2 ** 33, "send", request)
+        sink.write(2 ** 33 + 1, "start", _Timer(a, request))
+        sink.write(2 ** 33 + 2, "start", _Timer(a, "retry"))
+        sink.close()
+        reader = TraceReader(filename)
+        try:
+            self.assertEqual(reader.record(0), TraceRecord(2 ** 33, "send", "A", "B", "_Message", 2 ** 40, "K3"))
+            self.assertEqual([record.seq for record in reader.select(key="K3")], [2 ** 33, 2 ** 33 + 1])
+            self.assertEqual([record.seq for record in reader.select(msg_id=2 ** 40)], [2 ** 33])
+            self.assertEqual(reader.record(2).key, "retry")
+        finally:
+            reader.close()
+
+    def testSelectWithoutNumpy(self):
+        global numpy
+        saved, numpy = numpy, None
+        try:
+            self.testSelect()
+        finally:
+            numpy = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,33 +8,202 @@ def random_3str():
             chr(ord('A') + random.randint(0, 25)))
 
 
-class Stats(object):
-    def __init__(self):
+class Histogram(object):
+    """
+    Log-bucketed histogram in the style of HdrHistogram: each power-of-two range
+    of magnitudes is split into enough equal-width buckets to keep
+    significant_digits decimal digits, so memory depends on the range of the
+    values rather than on how many are recorded.  Histograms with the same
+    precision can be merged.
+    """
+    def __init__(self, significant_digits=2):
+        self.significant_digits = significant_digits
+        self.sub_buckets = 1 << int(math.ceil(math.log(10 ** significant_digits, 2)))
+        self.counts = {}  # (sign, exponent, sub-bucket) -> count
+        self.count = 0
         self.total = 0.0
-        self.values = []
-        self._mean = None
-        self._variance = None
+        self.min = None
+        self.max = None
 
-    def add(self, value):
-        self.values.append(float(value))
-        self.total = self.total + float(value)
-        self._mean = None
-        self._variance = None
+    def _bucket(self, value):
+        if value == 0:
+            return (0, 0, 0)
+        mantissa, exponent = math.frexp(abs(value))
+        return (1 if value > 0 else -1, exponent, int((mantissa - 0.5) * 2 * self.sub_buckets))
+
+    def _bucket_value(self, bucket):
+        """Midpoint of the values that fall in bucket."""
+        sign, exponent, sub_bucket = bucket
+        return sign * math.ldexp(0.5 + (sub_bucket + 0.5) / (2.0 * self.sub_buckets), exponent)
+
+    def record(self, value, count=1):
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count = self.count + count
+        self.total = self.total + value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.sub_buckets != self.sub_buckets:
+            raise ValueError("Cannot merge histograms of different precision")
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count = self.count + other.count
+        self.total = self.total + other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
 
     def mean(self):
-        if self._mean is None:
-            self._mean = self.total / float(len(self.values))
-        return self._mean
+        return self.total / float(self.count)
+
+    def percentile(self, percent):
+        """The value below which percent% of the recorded values fall, to the histogram's precision."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts, key=lambda bucket: (bucket[0], bucket[0] * bucket[1], bucket[0] * bucket[2])):
+            seen = seen + self.counts[bucket]
+            if seen >= rank:
+                return min(max(self._bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def percentiles(self, percents=(50, 90, 99, 99.9)):
+        return [self.percentile(percent) for percent in percents]
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        if not self.count:
+            return "n=0"
+        return "n=%d min=%.4g p50=%.4g p90=%.4g p99=%.4g p99.9=%.4g max=%.4g" % (
+            (self.count, self.min) + tuple(self.percentiles()) + (self.max,))
+
+
+class Stats(Histogram):
+    """
+    Mean, variance and percentiles of a series of values.  The variance is kept
+    up to date as values arrive (Welford's method), and percentiles come from the
+    values themselves or, when streaming, from the histogram alone, so that
+    memory stays constant however many values are added.  Stats can be merged.
+    """
+    def __init__(self, streaming=False, significant_digits=2):
+        super(Stats, self).__init__(significant_digits)
+        if streaming:
+            self.values = None
+        else:
+            self.values = []
+        self._mean = 0.0
+        self._sum_squares = 0.0  # Sum of squared differences from the mean
+
+    def add(self, value):
+        self.record(float(value))
+
+    def record(self, value, count=1):
+        self._combine(count, value, 0.0)
+        if self.values is not None:
+            self.values.extend([value] * count)
+        super(Stats, self).record(value, count)
+
+    def _combine(self, count, mean, sum_squares):
+        total_count = self.count + count
+        delta = mean - self._mean
+        self._mean = self._mean + delta * count / total_count
+        self._sum_squares = self._sum_squares + sum_squares + delta * delta * self.count * count / total_count
+
+    def merge(self, other):
+        if other.count:
+            self._combine(other.count, other._mean, other._sum_squares)
+        if self.values is not None:
+            if other.values is None:
+                self.values = None
+            else:
+                self.values.extend(other.values)
+        return super(Stats, self).merge(other)
 
     def variance(self):
-        if self._variance is None:
-            mean = self.mean()
-            self._variance = 0.0
-            for value in self.values:
-                diffval = (value - mean)
-                self._variance = self._variance + (diffval * diffval)
-            self._variance = self._variance / float(len(self.values) - 1)
-        return self._variance
+        return self._sum_squares / float(self.count - 1)
 
     def stddev(self):
         return math.sqrt(self.variance())
+
+    def percentile(self, percent):
+        if self.values is None or not self.values:
+            return super(Stats, self).percentile(percent)
+        values = sorted(self.values)
+        return values[max(1, int(math.ceil(percent / 100.0 * len(values)))) - 1]
+
+
+import unittest
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def testPercentiles(self):
+        hist = Histogram()
+        for value in range(1, 1001):
+            hist.record(value)
+        hist.record(0)
+        self.assertEqual(len(hist), 1001)
+        self.assertEqual((hist.min, hist.max), (0, 1000))
+        for percent, expected in ((50, 500), (90, 900), (99, 990), (100, 1000)):
+            self.assertAlmostEqual(hist.percentile(percent), expected, delta=expected / 100.0)
+        self.assertEqual(hist.percentile(0), 0)
+
+    def testMerge(self):
+        low, high, both = Histogram(), Histogram(), Histogram()
+        for value in (0.001, 0.5, 2.0, 7.0):
+            low.record(value)
+            both.record(value)
+        for value in (1e6, 3e6):
+            high.record(value, count=2)
+            both.record(value, count=2)
+        low.merge(high)
+        self.assertEqual(low.counts, both.counts)
+        self.assertEqual((low.count, low.min, low.max), (8, 0.001, 3e6))
+        self.assertEqual(low.percentiles(), both.percentiles())
+        self.assertRaises(ValueError, low.merge, Histogram(3))
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def testStreaming(self):
+        values = [random.gauss(10.0, 3.0) for _ in range(2000)]
+        exact, streaming, left, right = Stats(), Stats(streaming=True), Stats(streaming=True), Stats(streaming=True)
+        for ii, value in enumerate(values):
+            exact.add(value)
+            streaming.add(value)
+            (left if ii % 3 else right).add(value)
+        mean = sum(values) / len(values)
+        variance = sum([(value - mean) ** 2 for value in values]) / (len(values) - 1)
+        self.assertIsNone(streaming.values)
+        for stats in (exact, streaming, left.merge(right)):
+            self.assertEqual(len(stats), len(values))
+            self.assertAlmostEqual(stats.mean(), mean)
+            self.assertAlmostEqual(stats.variance(), variance)
+        self.assertEqual(exact.percentile(50), sorted(values)[999])
+        for percent in (1, 50, 90, 99, 99.9):
+            self.assertAlmostEqual(streaming.percentile(percent), exact.percentile(percent),
+                                   delta=abs(exact.percentile(percent)) / 50.0)
+
+    def testMergeKeepsValues(self):
+        left, right = Stats(), Stats()
+        for value in (-2, 0, 3):
+            left.add(value)
+            right.add(value * 10)
+        left.merge(right)
+        self.assertEqual(sorted(left.values), [-20.0, -2.0, 0.0, 0.0, 3.0, 30.0])
+        self.assertEqual((left.min, left.max, left.percentile(50)), (-20.0, 30.0, 0.0))
+        left.merge(Stats(streaming=True))
+        self.assertIsNone(left.values)
+
+
+if __name__ == "__main__":
+    unittest.main()